@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+"""Per-request Basic-Auth overhead: htpasswd subprocess vs. htauth
+
+Run inside the container (``make bench BENCH=auth``) or with the Bonito
+sources on the path::
+
+    PYTHONPATH=noske_files/bonito-open-5.71.15 python3 benchmarks/bench_auth.py
+
+Measures the time to verify one set of credentials
+
+- ``htpasswd -vb`` subprocess (as done by run.cgi before),
+- in-process bcrypt check without any cache,
+- cached check in a new process (plain CGI, file cache),
+- cached check in a persistent worker (memory cache).
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BONITO_DIR = '/usr/lib/python3/dist-packages/bonito'
+if os.path.isdir(BONITO_DIR) and BONITO_DIR not in sys.path:
+    sys.path.insert(0, BONITO_DIR)
+
+import htauth
+
+USER = 'benchuser'
+PASSWORD = 'correct horse battery staple'
+
+
+def make_htpasswd (path, cost):
+    if htauth.bcrypt is not None:
+        pwhash = htauth.bcrypt.hashpw(PASSWORD.encode(), htauth.bcrypt.gensalt(cost, b'2b'))
+        line = '%s:%s\n' % (USER, pwhash.decode().replace('$2b$', '$2y$', 1))
+    elif shutil.which('htpasswd'):
+        line = subprocess.run(['htpasswd', '-nbB', '-C', str(cost), USER, PASSWORD],
+                              check=True, capture_output=True, text=True).stdout.strip() + '\n'
+    else:
+        sys.exit('bcrypt module or htpasswd command required')
+    with open(path, 'w') as f:
+        f.write(line)
+
+
+def measure (name, func, rounds):
+    assert func(), '%s: verification failed' % name
+    start = time.perf_counter()
+    for i in range(rounds):
+        func()
+    per_call = (time.perf_counter() - start) / rounds
+    print('%-40s %10.3f ms' % (name, per_call * 1000))
+    return per_call
+
+
+def main ():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--rounds', type=int, default=50)
+    parser.add_argument('-C', '--cost', type=int, default=5,
+                        help='bcrypt cost (htpasswd -B default: %(default)s)')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='bench_auth')
+    try:
+        htpasswd_file = os.path.join(tmpdir, 'htpasswd')
+        cache_dir = os.path.join(tmpdir, 'authcache')
+        make_htpasswd(htpasswd_file, args.cost)
+
+        results = {}
+        if shutil.which('htpasswd'):
+            results['before'] = measure('htpasswd -vb subprocess',
+                lambda: htauth.HtpasswdVerifier(htpasswd_file)._verify_htpasswd(USER, PASSWORD),
+                args.rounds)
+        if htauth.bcrypt is not None:
+            measure('htauth, no cache',
+                lambda: htauth.HtpasswdVerifier(htpasswd_file).verify(USER, PASSWORD),
+                args.rounds)
+        results['cgi'] = measure('htauth, CGI (file cache)',
+            lambda: htauth.HtpasswdVerifier(htpasswd_file, cache_dir).verify(USER, PASSWORD),
+            args.rounds)
+        verifier = htauth.HtpasswdVerifier(htpasswd_file, cache_dir)
+        results['worker'] = measure('htauth, persistent worker (memory cache)',
+            lambda: verifier.verify(USER, PASSWORD), args.rounds * 100)
+
+        if 'before' in results:
+            for mode in ('cgi', 'worker'):
+                print('speedup %-32s %10.0fx' % (mode, results['before'] / results[mode]))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+"""Cold-start import time of run.cgi (Bonito modules)
+
+Loads run.cgi (without serving a request) in a fresh interpreter with
+``-X importtime``, prints the modules with the largest cumulative import time
+and exits with status 1 if
+
+- the total import time exceeds the budget (``--budget`` ms), or
+- one of the lazily imported modules (``--lazy``, e.g. ``gdex``, ``annotlib``,
+  ``cgitb``) is imported at start-up again.
+
+Run inside the container (``make bench BENCH=imports``). The fastest of
+``--runs`` runs is used to reduce noise. The same checks are part of the test
+suite (``tests/test_imports.py``, ``make test``).
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+RUNCGI = '/var/www/bonito/run.cgi'
+LAZY_MODULES = ['gdex', 'yaml', 'annotlib', 'sqlite3', 'cgitb', 'pydoc', 'numpy']
+
+LOADER = '''
+import sys, types
+from importlib.machinery import SourceFileLoader
+loader = SourceFileLoader('runcgi', sys.argv[1])
+loader.exec_module(types.ModuleType(loader.name))
+'''
+
+
+def import_times (runcgi, registry):
+    "run one cold start, returns list of (module, self_us, cumulative_us)"
+    env = dict(os.environ, MANATEE_REGISTRY=registry)
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', LOADER, runcgi],
+                          env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError('loading %s failed:\n%s' % (runcgi, proc.stderr))
+    times = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times.append((name.strip(), int(self_us), int(cumulative_us)))
+    return times
+
+
+def measure (runcgi, runs):
+    """fastest of runs cold starts, returns list of (module, self_us,
+    cumulative_us) and total import time in ms"""
+    with tempfile.TemporaryDirectory() as registry:
+        runs = [import_times(runcgi, registry) for i in range(runs)]
+    times = min(runs, key=lambda t: sum(s for n, s, c in t))
+    return times, sum(s for n, s, c in times) / 1000.0
+
+
+def eager_modules (times, lazy=LAZY_MODULES):
+    "modules of lazy imported at start-up"
+    imported = set(n for n, s, c in times)
+    return [m for m in lazy if m in imported]
+
+
+def default_budget ():
+    "import time budget in ms"
+    return float(os.environ.get('BONITO_IMPORT_BUDGET_MS', 400))
+
+
+def main ():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runcgi', default=RUNCGI)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--budget', type=float,
+                        default=default_budget(),
+                        help='maximum total import time in ms (default: %(default)s)')
+    parser.add_argument('--lazy', nargs='*', default=LAZY_MODULES,
+                        help='modules which must not be imported at start-up')
+    args = parser.parse_args()
+
+    try:
+        times, total_ms = measure(args.runcgi, args.runs)
+    except RuntimeError as e:
+        sys.exit(str(e))
+
+    print('%-40s %12s %12s' % ('module', 'self [ms]', 'cumul. [ms]'))
+    for name, self_us, cumulative_us in sorted(times, key=lambda t: -t[2])[:args.top]:
+        print('%-40s %12.1f %12.1f' % (name, self_us / 1000.0, cumulative_us / 1000.0))
+    print('%-40s %12.1f   (budget %.0f ms)' % ('total', total_ms, args.budget))
+
+    failed = False
+    eager = eager_modules(times, args.lazy)
+    if eager:
+        print('FAIL: imported at start-up: %s' % ', '.join(eager))
+        failed = True
+    if total_ms > args.budget:
+        print('FAIL: import time %.1f ms exceeds budget of %.0f ms' % (total_ms, args.budget))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
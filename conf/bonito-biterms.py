@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+"""Compile bilingual terminology files for Bonito
+
+Converts every ``<aligned corpus>.biterms`` file below the given
+directories (default: ``/corpora/data``) into the indexed binary form read
+by the ``biterms`` API method, see ``bitermsindex.py``. Files whose index
+is current are skipped. Bonito compiles missing or outdated indexes on
+first use, running this after compilation keeps that cost out of the first
+request. Called from ``compile.sh``.
+"""
+
+import argparse
+import os
+import sys
+
+BONITO_DIR = '/usr/lib/python3/dist-packages/bonito'
+if os.path.isdir(BONITO_DIR) and BONITO_DIR not in sys.path:
+    sys.path.insert(0, BONITO_DIR)
+
+import bitermsindex
+
+INDEX_DIR = '/var/lib/bonito/cache/.biterms'
+DATA_DIR = '/corpora/data'
+
+
+def main ():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('data_dirs', nargs='*', default=[DATA_DIR],
+                        help='directories to search for .biterms files (default: %s)' % DATA_DIR)
+    parser.add_argument('--index-dir', default=INDEX_DIR,
+                        help='index directory (default: %(default)s)')
+    args = parser.parse_args()
+
+    failed = 0
+    for data_dir in args.data_dirs:
+        for dirpath, dirnames, filenames in os.walk(data_dir):
+            for name in sorted(filenames):
+                if not name.endswith('.biterms'):
+                    continue
+                fname = os.path.join(os.path.abspath(dirpath), name)
+                try:
+                    bitermsindex.get_index(fname, args.index_dir)
+                    print('%s: done' % fname)
+                except Exception as e:
+                    print('%s: failed: %s' % (fname, e), file=sys.stderr)
+                    failed += 1
+    sys.exit(failed and 1 or 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+#!/usr/bin/python3
+"""Pre-forking SCGI server for Bonito
+
+Serves the API from long-lived worker processes instead of starting a new
+CGI process for every request. The master process loads ``run.cgi`` once
+(importing ``conccgi``, ``manatee`` etc. and building the ``BonitoCGI`` class)
+and then forks workers that inherit the warm interpreter. Each request is
+passed through the unchanged ``run.cgi`` request path (``parse_parameters`` /
+``run_unprotected``), with ``os.environ``, stdin and stdout set up exactly as
+for a CGI process, so the response is plain CGI output that Apache's
+``mod_proxy_scgi`` forwards to the client.
+
+Workers are recycled after serving ``--max-requests`` requests or once their
+resident memory exceeds ``--max-rss`` MB. Send SIGHUP to the master to recycle
+all workers (e.g. after changing ``run.cgi``), SIGTERM or SIGINT to stop.
+
+The plain CGI entry point (``/var/www/bonito/run.cgi``) stays fully functional,
+Apache only routes requests here if started with ``-D BONITO_SCGI``, see
+``entrypoint.sh`` and ``000-default.conf``.
+"""
+
+import atexit
+import copy
+import io
+import os
+import pwd
+import signal
+import socket
+import sys
+import time
+import traceback
+import types
+from importlib.machinery import SourceFileLoader
+from urllib.parse import unquote, urlsplit
+
+DEFAULT_RUNCGI = '/var/www/bonito/run.cgi'
+DEFAULT_SCRIPT_NAME = '/bonito/run.cgi'
+
+
+def log (message):
+    sys.stderr.write('[bonito-scgi %d] %s\n' % (os.getpid(), message))
+    sys.stderr.flush()
+
+
+def load_runcgi (path):
+    "load run.cgi as a module without running its __main__ part"
+    loader = SourceFileLoader('runcgi', path)
+    runcgi = types.ModuleType(loader.name)
+    runcgi.__file__ = path
+    loader.exec_module(runcgi)
+    return runcgi
+
+
+class ClassState:
+    """Snapshot of mutable class attributes
+
+    Bonito keeps request state in class level lists and dicts (e.g.
+    ``corplist``, ``subcpath``, ``reflinks``, ``q``, ``_headers``) which are
+    modified in place while serving a request. A CGI process dies afterwards,
+    a worker has to put them back before serving the next request.
+    """
+
+    def __init__ (self, cls):
+        self.saved = []
+        for klass in cls.__mro__:
+            for name, value in list(vars(klass).items()):
+                if isinstance(value, (list, dict, set)):
+                    self.saved.append((klass, name, copy.deepcopy(value)))
+
+    def restore (self):
+        for klass, name, value in self.saved:
+            setattr(klass, name, copy.deepcopy(value))
+
+
+def rss_mb ():
+    "current resident set size of this process in MB"
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 1048576.0
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def read_netstring (rfile):
+    length = b''
+    while True:
+        c = rfile.read(1)
+        if c == b':':
+            break
+        if not c.isdigit() or len(length) > 10:
+            raise ValueError('Malformed SCGI netstring')
+        length += c
+    data = rfile.read(int(length))
+    if rfile.read(1) != b',':
+        raise ValueError('Malformed SCGI netstring')
+    return data
+
+
+def read_request (rfile, script_name):
+    "parse SCGI request headers into CGI environment, read request body"
+    items = read_netstring(rfile).split(b'\0')
+    environ = {}
+    for i in range(0, len(items) - 1, 2):
+        environ[items[i].decode('latin-1')] = items[i+1].decode('latin-1')
+    # mod_proxy_scgi does not split the URL into SCRIPT_NAME and PATH_INFO
+    # the way mod_cgi does, Bonito dispatches on PATH_INFO
+    path = unquote(urlsplit(environ.get('REQUEST_URI', '')).path)
+    if path.startswith(script_name):
+        environ['SCRIPT_NAME'] = script_name
+        environ['PATH_INFO'] = path[len(script_name):]
+    environ.setdefault('QUERY_STRING', '')
+    environ.setdefault('REQUEST_METHOD', 'GET')
+    environ['GATEWAY_INTERFACE'] = 'CGI/1.1'
+    length = int(environ.get('CONTENT_LENGTH') or 0)
+    body = rfile.read(length) if length > 0 else b''
+    return environ, body
+
+
+class Worker:
+    def __init__ (self, listener, runcgi, options):
+        self.listener = listener
+        self.runcgi = runcgi
+        self.options = options
+        self.state = ClassState(runcgi.BonitoCGI)
+        self.base_environ = dict(os.environ)
+        self.busy = False
+        self.stopping = False
+
+    def stop (self, signum, frame):
+        self.stopping = True
+        if not self.busy:
+            raise SystemExit(0)
+
+    def run (self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGHUP, self.stop)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        served = 0
+        while not self.stopping:
+            conn, _ = self.listener.accept()
+            self.busy = True
+            try:
+                self.handle(conn)
+            finally:
+                self.busy = False
+            served += 1
+            self.reap_children()
+            if self.options.max_requests and served >= self.options.max_requests:
+                break
+            if self.options.max_rss and rss_mb() > self.options.max_rss:
+                log('recycling after %d requests, RSS %.0f MB' % (served, rss_mb()))
+                break
+
+    def handle (self, conn):
+        rfile = conn.makefile('rb')
+        try:
+            environ, body = read_request(rfile, self.options.script_name)
+        except (ValueError, OSError) as e:
+            log('bad request: %s' % e)
+            rfile.close()
+            conn.close()
+            return
+        rfile.close()
+
+        os.environ.clear()
+        os.environ.update(self.base_environ)
+        os.environ.update(environ)
+        self.state.restore()
+        sys.stdin = io.TextIOWrapper(io.BytesIO(body), encoding='utf-8')
+        sys.stdout.flush()
+        saved_stdout = os.dup(1)
+        # the connection is reachable through fd 1 only, as under CGI;
+        # concordances are computed by the concordance daemon (concd.py),
+        # forked children (conclib.fork_map) leave with os._exit and never
+        # flush or close it
+        os.dup2(conn.fileno(), 1)
+        conn.close()
+        try:
+            self.runcgi.handle_request()
+        except SystemExit:
+            pass
+        except Exception:
+            log('error while serving %s\n%s' % (environ.get('REQUEST_URI', ''),
+                                                traceback.format_exc()))
+        finally:
+            try:
+                sys.stdout.flush()
+            except OSError: # client went away
+                pass
+            os.dup2(saved_stdout, 1)
+            os.close(saved_stdout)
+            sys.stdin = sys.__stdin__
+
+    def reap_children (self):
+        # asynchronous concordance processes are forked from the worker,
+        # collect them between requests (never during a request, so that
+        # subprocess calls still see their own exit status)
+        try:
+            while os.waitpid(-1, os.WNOHANG)[0] > 0:
+                pass
+        except ChildProcessError:
+            pass
+
+
+class Master:
+    def __init__ (self, listener, runcgi, options):
+        self.listener = listener
+        self.runcgi = runcgi
+        self.options = options
+        self.workers = {}
+        self.running = True
+        self.last_spawn = 0
+
+    def spawn (self):
+        # throttle respawning of workers failing at startup
+        delay = self.last_spawn + 0.1 - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        self.last_spawn = time.time()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                Worker(self.listener, self.runcgi, self.options).run()
+            except SystemExit:
+                pass
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                # os._exit skips atexit handlers (e.g. flushing buffered
+                # subcorpus access times), run them for the worker here
+                atexit._run_exitfuncs()
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        self.workers[pid] = time.time()
+
+    def signal_workers (self, signum):
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def terminate (self, signum, frame):
+        self.running = False
+        self.signal_workers(signal.SIGTERM)
+
+    def recycle (self, signum, frame):
+        log('recycling all workers')
+        self.signal_workers(signal.SIGHUP)
+
+    def run (self):
+        signal.signal(signal.SIGTERM, self.terminate)
+        signal.signal(signal.SIGINT, self.terminate)
+        signal.signal(signal.SIGHUP, self.recycle)
+        for i in range(self.options.workers):
+            self.spawn()
+        log('serving on %s with %d workers' % (self.options.bind,
+                                               self.options.workers))
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            if pid not in self.workers:
+                continue
+            del self.workers[pid]
+            if self.running:
+                self.spawn()
+
+
+def make_listener (bind):
+    host, port = bind.rsplit(':', 1)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, int(port)))
+    listener.listen(128)
+    return listener
+
+
+def drop_privileges (username):
+    if os.getuid() != 0 or not username:
+        return
+    pw = pwd.getpwnam(username)
+    os.setgroups([])
+    os.setgid(pw.pw_gid)
+    os.setuid(pw.pw_uid)
+    os.environ['HOME'] = pw.pw_dir
+
+
+def main ():
+    import argparse
+    parser = argparse.ArgumentParser(description='Pre-forking SCGI server for Bonito')
+    parser.add_argument('--runcgi', default=DEFAULT_RUNCGI,
+                        help='path to run.cgi (default: %(default)s)')
+    parser.add_argument('--bind', default='127.0.0.1:8090',
+                        help='address to listen on (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of worker processes (default: %(default)s)')
+    parser.add_argument('--max-requests', type=int, default=1000,
+                        help='recycle a worker after this many requests, 0 = never (default: %(default)s)')
+    parser.add_argument('--max-rss', type=int, default=1024,
+                        help='recycle a worker once its RSS exceeds this many MB, 0 = never (default: %(default)s)')
+    parser.add_argument('--script-name', default=DEFAULT_SCRIPT_NAME,
+                        help='URL path of run.cgi, used to derive PATH_INFO (default: %(default)s)')
+    parser.add_argument('--user', default='www-data',
+                        help='user to run as when started as root (default: %(default)s)')
+    options = parser.parse_args()
+
+    listener = make_listener(options.bind)
+    drop_privileges(options.user)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(options.runcgi)))
+    runcgi = load_runcgi(options.runcgi)
+    Master(listener, runcgi, options).run()
+
+
+if __name__ == '__main__':
+    main()
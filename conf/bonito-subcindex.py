@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+"""Register existing subcorpora in the Bonito subcorpus content index
+
+Bonito registers subcorpora in the content index (``.subcindex``, see
+``subcindex.py``) when it creates them, so subcorpora created before the
+index existed are never found as identical to a new one. This walks the
+subcorpus directory (``/var/lib/bonito/subcorp/<user>/<corpus>/``, including
+``GLOBAL``), computes the content hash of every ``.subc`` file (stored in its
+``.subchash`` sidecar, see ``corplib.get_subchash``) and registers it with
+its statistics files. Once done, ``.subcindex/.backfilled`` is created and
+later runs do nothing unless ``--force`` is given. Started in the background
+by ``entrypoint.sh``.
+"""
+
+import argparse
+import os
+import pwd
+import sys
+
+BONITO_DIR = '/usr/lib/python3/dist-packages/bonito'
+if os.path.isdir(BONITO_DIR) and BONITO_DIR not in sys.path:
+    sys.path.insert(0, BONITO_DIR)
+
+import corplib
+import subcindex
+
+SUBCORP_DIR = '/var/lib/bonito/subcorp'
+MARKER = '.backfilled'
+# files making up a subcorpus, everything else with its prefix is derived
+CORE_SUFFIXES = ('.subc', '.subcdef', '.used', '.subchash')
+
+
+def drop_privileges (username):
+    if os.getuid() != 0 or not username:
+        return
+    pw = pwd.getpwnam(username)
+    os.setgroups([])
+    os.setgid(pw.pw_gid)
+    os.setuid(pw.pw_uid)
+    os.environ['HOME'] = pw.pw_dir
+
+
+def subcorpora (subcorp_dir):
+    "yields (corpus name, path of .subc file, derived file suffixes)"
+    for user in sorted(os.listdir(subcorp_dir)):
+        userdir = os.path.join(subcorp_dir, user)
+        if user.startswith('.') or not os.path.isdir(userdir):
+            continue
+        for dirpath, dirnames, filenames in os.walk(userdir):
+            corpname = os.path.relpath(dirpath, userdir)
+            if corpname == '.':
+                continue
+            # subcorpus names may contain dots: assign files to the longest
+            # subcorpus name which is a prefix
+            bases = sorted((f[:-len('.subc')] for f in filenames
+                            if f.endswith('.subc')), key=len, reverse=True)
+            suffixes = dict((base, []) for base in bases)
+            for f in filenames:
+                if f.endswith(CORE_SUFFIXES):
+                    continue
+                for base in bases:
+                    if f.startswith(base + '.'):
+                        suffixes[base].append(f[len(base) + 1:])
+                        break
+            for base in bases:
+                yield (corpname, os.path.join(dirpath, base + '.subc'),
+                       suffixes[base])
+
+
+def main ():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--subcorp-dir', default=SUBCORP_DIR,
+                        help='subcorpus directory (default: %(default)s)')
+    parser.add_argument('--user', default='www-data',
+                        help='user to run as when started as root (default: %(default)s)')
+    parser.add_argument('--force', action='store_true',
+                        help='register subcorpora even if done before')
+    args = parser.parse_args()
+    drop_privileges(args.user)
+
+    index_dir = os.path.join(args.subcorp_dir, '.subcindex')
+    marker = os.path.join(index_dir, MARKER)
+    if os.path.exists(marker) and not args.force:
+        return
+    registered = failed = 0
+    for corpname, spath, suffixes in subcorpora(args.subcorp_dir):
+        try:
+            digest = corplib.get_subchash(spath).hex()
+        except OSError as e:
+            print('%s: failed: %s' % (spath, e), file=sys.stderr)
+            failed += 1
+            continue
+        subcindex.add(index_dir, corpname, spath, digest, suffixes)
+        registered += 1
+    print('%d subcorpora registered in %s' % (registered, index_dir))
+    if not failed:
+        os.makedirs(index_dir, exist_ok=True)
+        open(marker, 'w').close()
+    sys.exit(failed and 1 or 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+"""Enforce disk budgets for Bonito subcorpora
+
+Scans the subcorpus directory (``/var/lib/bonito/subcorp/<user>/<corpus>/``)
+and frees space, least recently used subcorpora first (last access is the
+modification time of ``<name>.used``, see ``corplib.track_subcorp_access``):
+
+1. derived statistics (``<name>.<attr>.frq``, ``.docf``, ``.token``, trends,
+   n-grams, ...) are removed, they are recomputed on demand,
+2. if that is not enough, whole subcorpora which have a ``<name>.subcdef``
+   definition are removed except the definition, so Bonito can rebuild them
+   on next access; subcorpora without a definition are never removed.
+
+Shared subcorpora in the ``GLOBAL`` directory are left alone, Bonito only
+rebuilds subcorpora in the user's own directory.
+
+Entries of removed files in the subcorpus content index (``.subcindex``, see
+``subcindex.py``) are dropped by Bonito on the next lookup. Statistics shared
+by identical subcorpora are hardlinked (see ``corplib.link_file``): they are
+counted once and their space is freed only with the last link.
+
+The per-user budget (``--user-quota``) is enforced first, then the global
+budget (``--global-quota``). Subcorpora used within the last ``--min-age``
+minutes are never touched. Use ``--dry-run`` to only list what would be done.
+
+Run e.g. periodically with ``docker exec noske bonito-subcorp-evict.py
+--user-quota 2048 --global-quota 51200``.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+SUBCORP_DIR = '/var/lib/bonito/subcorp'
+# files making up a subcorpus, everything else with its prefix is derived
+CORE_SUFFIXES = ('.subc', '.subcdef', '.used', '.subchash')
+
+
+class Subcorpus:
+    def __init__ (self, user, path):
+        self.user = user
+        self.path = path # without suffix
+        self.core = [] # (file, size, (device, inode))
+        self.derived = []
+        self.last_used = 0
+
+    def add (self, filename, st):
+        suffix = filename[len(self.path):]
+        entry = (filename, st.st_blocks * 512, (st.st_dev, st.st_ino))
+        if suffix in CORE_SUFFIXES:
+            self.core.append(entry)
+            if suffix in ('.subc', '.used'):
+                self.last_used = max(self.last_used, st.st_mtime)
+        else:
+            self.derived.append(entry)
+
+    def removable (self, level):
+        "files to remove: level 1 derived files, level 2 subcorpus itself"
+        if level == 1:
+            return self.derived
+        if not any(e[0].endswith('.subcdef') for e in self.core):
+            return [] # could not be rebuilt
+        return [e for e in self.core if not e[0].endswith('.subcdef')]
+
+
+def scan (subcorp_dir):
+    """returns list of Subcorpus objects and number of links of their files
+    by (device, inode)"""
+    subcorpora = []
+    nlinks = {}
+    for user in sorted(os.listdir(subcorp_dir)):
+        userdir = os.path.join(subcorp_dir, user)
+        if user in ('.subcindex', 'GLOBAL') or not os.path.isdir(userdir):
+            continue
+        for dirpath, dirnames, filenames in os.walk(userdir):
+            files = {}
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+                files[path] = st
+            # subcorpus names may contain dots: assign files to the longest
+            # subcorpus name which is a prefix
+            bases = set(p[:-len('.subcdef')] for p in files if p.endswith('.subcdef'))
+            bases.update(p[:-len('.subc')] for p in files if p.endswith('.subc'))
+            by_base = dict((b, Subcorpus(user, b)) for b in bases)
+            for path, st in files.items():
+                base = path
+                while True:
+                    base = base.rsplit('.', 1)[0]
+                    if base in by_base or '.' not in os.path.basename(base):
+                        break
+                if base in by_base:
+                    by_base[base].add(path, st)
+                    nlinks[st.st_dev, st.st_ino] = st.st_nlink
+            subcorpora.extend(by_base.values())
+    return subcorpora, nlinks
+
+
+def usage (subcorpora):
+    "bytes used by files of subcorpora, hardlinked files counted once"
+    sizes = dict((inode, size) for sc in subcorpora
+                 for f, size, inode in sc.core + sc.derived)
+    return sum(sizes.values())
+
+
+def evict (subcorpora, nlinks, quota, min_age, dry_run, label):
+    """remove files of LRU subcorpora until usage <= quota, returns freed
+    bytes (space of a hardlinked file is freed with its last link only)"""
+    used = usage(subcorpora)
+    freed = 0
+    now = time.time()
+    candidates = sorted((sc for sc in subcorpora
+                         if now - sc.last_used > min_age),
+                        key=lambda sc: sc.last_used)
+    for level in (1, 2):
+        for sc in candidates:
+            if used - freed <= quota:
+                return freed
+            for filename, size, inode in sc.removable(level):
+                print('%s%s: remove %s (%d kB)' % (dry_run and '[dry-run] ' or '',
+                                                    label, filename, size // 1024))
+                if not dry_run:
+                    try:
+                        os.remove(filename)
+                    except OSError as e:
+                        print('  failed: %s' % e, file=sys.stderr)
+                        continue
+                nlinks[inode] -= 1
+                if not nlinks[inode]:
+                    freed += size
+            if level == 1:
+                sc.derived = []
+            else:
+                sc.core = [e for e in sc.core if e[0].endswith('.subcdef')]
+    if used - freed > quota:
+        print('%s: still %d MB over budget (recently used subcorpora and those '
+              'without a definition are kept)'
+              % (label, (used - freed - quota) // 1048576), file=sys.stderr)
+    return freed
+
+
+def main ():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--subcorp-dir', default=SUBCORP_DIR,
+                        help='subcorpus directory (default: %(default)s)')
+    parser.add_argument('--user-quota', type=float, default=0,
+                        help='disk budget per user in MB, 0 = unlimited')
+    parser.add_argument('--global-quota', type=float, default=0,
+                        help='disk budget for all subcorpora in MB, 0 = unlimited')
+    parser.add_argument('--min-age', type=float, default=60,
+                        help='keep subcorpora used in the last MIN_AGE minutes (default: %(default)s)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only print what would be removed')
+    args = parser.parse_args()
+
+    subcorpora, nlinks = scan(args.subcorp_dir)
+    min_age = args.min_age * 60
+    freed = 0
+    if args.user_quota:
+        users = sorted(set(sc.user for sc in subcorpora))
+        for user in users:
+            freed += evict([sc for sc in subcorpora if sc.user == user], nlinks,
+                           args.user_quota * 1048576, min_age, args.dry_run, user)
+    if args.global_quota:
+        freed += evict(subcorpora, nlinks, args.global_quota * 1048576, min_age,
+                       args.dry_run, 'global')
+    print('%s%d MB freed, %d MB used by %d subcorpora' % (
+          args.dry_run and '[dry-run] ' or '', freed // 1048576,
+          usage(subcorpora) // 1048576, len(subcorpora)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+"""Build the Bonito text type and autocomplete indexes of compiled corpora
+
+Materialises the values and value counts (documents, tokens, norm) of all
+structure attributes of the given corpora (registry files, default: all
+files in ``$MANATEE_REGISTRY``), see ``ttindex.py``, and the autocomplete
+indexes of all attributes used by ``attr_vals``, see ``avindex.py``. Bonito
+builds missing text type tables on first use, running this after
+compilation keeps that cost out of the first request; autocomplete indexes
+are only built here, until then ``attr_vals`` uses manatee. Called from
+``compile.sh``.
+"""
+
+import argparse
+import os
+import sys
+
+BONITO_DIR = '/usr/lib/python3/dist-packages/bonito'
+if os.path.isdir(BONITO_DIR) and BONITO_DIR not in sys.path:
+    sys.path.insert(0, BONITO_DIR)
+
+import avindex
+import corplib
+import ttindex
+
+TTINDEX_DIR = '/var/lib/bonito/cache/.ttindex'
+AVINDEX_DIR = '/var/lib/bonito/cache/.avindex'
+
+
+def main ():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('registry_files', nargs='*',
+                        help='registry files of corpora (default: all)')
+    parser.add_argument('--index-dir', default=TTINDEX_DIR,
+                        help='index directory (default: %(default)s)')
+    parser.add_argument('--avindex-dir', default=AVINDEX_DIR,
+                        help='autocomplete index directory (default: %(default)s)')
+    args = parser.parse_args()
+
+    registry_files = args.registry_files
+    if not registry_files:
+        registry = os.environ.get('MANATEE_REGISTRY', '/corpora/registry')
+        registry_files = sorted(os.path.join(dirpath, name)
+                                for dirpath, dirnames, filenames in os.walk(registry)
+                                for name in filenames)
+    failed = 0
+    for path in registry_files:
+        try:
+            corp = corplib.open_corpus(os.path.abspath(path))
+            if not os.path.exists(os.path.join(corp.get_conf('PATH'), 'sizes')):
+                print('%s: not compiled, skipped' % path, file=sys.stderr)
+                continue
+            ttindex.build(corp, args.index_dir)
+            avindex.build(corp, args.avindex_dir)
+            print('%s: done' % path)
+        except Exception as e:
+            print('%s: failed: %s' % (path, e), file=sys.stderr)
+            failed += 1
+    sys.exit(failed and 1 or 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -28,3 +28,13 @@ export -f compile_single_corpus
 
 # Compile corpora
 find ${REGISTRY_DIR} -type f -print0 | sort -z | xargs -r -0 -I {} -n 1 bash -c 'compile_single_corpus "$1"' _ {} \;
+
+# Build text type index (values of structure attributes) and autocomplete
+# index (attr_vals) for Bonito
+# (owned by Bonito even if this failed halfway, otherwise Bonito cannot update it)
+bonito-ttindex.py || echo "Warning: text type or autocomplete index not built" >&2
+chown -R www-data:www-data /var/lib/bonito/cache/.ttindex /var/lib/bonito/cache/.avindex 2> /dev/null
+
+# Compile bilingual terminology (.biterms) indexes for Bonito
+bonito-biterms.py || echo "Warning: .biterms indexes not compiled, Bonito compiles them on first use" >&2
+chown -R www-data:www-data /var/lib/bonito/cache/.biterms 2> /dev/null
@@ -16,8 +16,20 @@ if [ $# -eq 1 ]; then
     # update permissions
     chown -R www-data:www-data /var/lib/bonito/
 
+    # register subcorpora created before the subcorpus content index (once)
+    /usr/local/bin/bonito-subcindex.py &
+
+    # start persistent bonito workers, serve /bonito/run.cgi through them
+    BONITO_WORKERS=${BONITO_WORKERS:=0}
+    if [ "${BONITO_WORKERS}" -gt 0 ]; then
+        echo "Starting ${BONITO_WORKERS} persistent Bonito workers."
+        /usr/local/bin/bonito-scgi.py --workers "${BONITO_WORKERS}" \
+            --max-requests "${BONITO_MAX_REQUESTS:=1000}" --max-rss "${BONITO_MAX_RSS:=1024}" &
+        APACHE_DEFINES="-D BONITO_SCGI"
+    fi
+
     # run apache
-    /usr/sbin/apache2ctl -D FOREGROUND
+    /usr/sbin/apache2ctl ${APACHE_DEFINES} -D FOREGROUND
 else
     shift
     "$@"
@@ -3,10 +3,14 @@
 # Copyright (c) 2003-2020  Pavel Rychly, Vojtech Kovar, Milos Jakubicek,
 #                          Vit Baisa
 
-import cgitb; cgitb.enable()
-
 import sys, os
 
+def cgitb_excepthook (*exc_info):
+    "cgitb.enable(), but cgitb (pydoc, inspect, ...) is imported on error only"
+    import cgitb
+    cgitb.Hook()(*exc_info)
+sys.excepthook = cgitb_excepthook
+
 if '/usr/lib/python3/dist-packages' not in sys.path:
     sys.path.insert (0, '/usr/lib/python3/dist-packages')
 
@@ -21,7 +25,7 @@ except:
     class WSEval(ConcCGI):
         pass
 
-from conccgi import USER_SCOPED_CORPORA_SEP
+import regcatalog
 
 # Following might be needed for CORS compliance if XHR requests are coming from a different domain
 # You may also set it in the webserver configuration instead, see the .htaccess file in
@@ -48,30 +52,20 @@ class BonitoCGI (WSEval, UserCGI):
 
     # ConcCGI options
     _cache_dir = _data_dir + '/cache'
+    _conc_cache_quota = 20 * 1024**3 # bytes, saved concordances beyond are evicted
     _tmp_dir = _data_dir + '/tmp'
     subcpath = [_data_dir + '/subcorp/GLOBAL']
     gdexpath = [] # [('confname', '/path/to/gdex.conf'), ...]
     user_gdex_path = "" # /path/to/%s/gdex/ %s to be replaced with username
 
-    # Read corpora list runtime from registry
+    # Read corpora list runtime from registry (cached in the registry catalog,
+    # rescanned only if the registry changed)
     # set available corpora, e.g.: corplist = ['susanne', 'bnc', 'biwec']
     if 'MANATEE_REGISTRY' not in os.environ:
         # TODO: SET THIS APROPRIATELY!
         os.environ['MANATEE_REGISTRY'] = '/corpora/registry'
-    corplist = [
-        corp_name
-        for corp_name in os.listdir(os.environ['MANATEE_REGISTRY'])
-        if not corp_name.endswith(".disabled") and os.path.isfile(os.path.join(os.environ['MANATEE_REGISTRY'], corp_name))
-    ]
-    corplist_scoped = [
-        os.path.join(scope, corp_name)
-        for scope in os.listdir(os.environ['MANATEE_REGISTRY'])
-        if not scope.endswith(".disabled") and os.path.isdir(os.path.join(os.environ['MANATEE_REGISTRY'], scope))
-        for corp_name in os.listdir(os.path.join(os.environ['MANATEE_REGISTRY'], scope))
-        if os.path.isfile(os.path.join(os.environ['MANATEE_REGISTRY'], scope, corp_name))
-    ]
-    corplist += corplist_scoped
-    del corplist_scoped
+    _regcatalog_file = _data_dir + '/registry_catalog.json'
+    corplist = regcatalog.get_corplist(os.environ['MANATEE_REGISTRY'], _regcatalog_file)
 
     # set default corpus
     if len(corplist) > 0:
@@ -96,16 +90,10 @@ class BonitoCGI (WSEval, UserCGI):
         # update user infos
         UserCGI._setup_user(self)
         # filter corplist to only include corpora that user is allowed to see
-        self.corplist[:] = [
-            corp_name
-            for corp_name in self.corplist
-            # free, public corpora
-            if USER_SCOPED_CORPORA_SEP not in corp_name
-            # being superuser
-            or self._superuser
-            # or only my corpora if not anonymous
-            or (not self._anonymous and corp_name.split(USER_SCOPED_CORPORA_SEP, 1)[0] == self._user)
-        ]
+        self.corplist[:] = regcatalog.get_user_corplist(
+            os.environ['MANATEE_REGISTRY'], self._user,
+            superuser=self._superuser, anonymous=self._anonymous,
+            index_file=self._regcatalog_file)
 
     # corpus access check
     def parse_parameters (self, selectorname=None, environ=os.environ, post_fp=None):
@@ -116,6 +104,33 @@ class BonitoCGI (WSEval, UserCGI):
         return named_args
 
 
+def process_authorization ():
+    "verify an optional Basic Authorization header and set REMOTE_USER"
+    if os.environ.get("HTTP_AUTHORIZATION", "").lower().startswith("basic "):
+        import base64, htauth
+
+        digest = os.environ.pop("HTTP_AUTHORIZATION").split(" ", 1)[-1]
+        _username, _password = base64.b64decode(digest).decode("utf-8").split(":", 1)
+        # verified in-process, successful logins are cached for a few minutes
+        verifier = htauth.get_verifier("/var/lib/bonito/htpasswd", cache_dir="/var/lib/bonito/authcache")
+        if verifier.verify(_username, _password):
+            os.environ["REMOTE_USER"] = _username
+        del _username, _password, digest
+
+
+def handle_request (username=None):
+    "serve a single request described by os.environ and sys.stdin"
+    if username is None:
+        # process optional Authorization header
+        process_authorization()
+
+    if 'MANATEE_REGISTRY' not in os.environ:
+        # TODO: SET THIS APROPRIATELY!
+        os.environ['MANATEE_REGISTRY'] = '/corpora/registry'
+
+    BonitoCGI(user=username).run_unprotected (selectorname='corpname')
+
+
 if __name__ == '__main__':
     # use run.cgi <url> <username> for debugging
     if len(sys.argv) > 1:
@@ -130,21 +145,6 @@ if __name__ == '__main__':
     else:
         username = None
 
-        # process optional Authorization header
-        if os.environ.get("HTTP_AUTHORIZATION", "").lower().startswith("basic "):
-            import base64, subprocess
-
-            digest = os.environ.pop("HTTP_AUTHORIZATION").split(" ", 1)[-1]
-            _username, _password = base64.b64decode(digest).decode("utf-8").split(":", 1)
-            proc = subprocess.run(["htpasswd", "-vb", "/var/lib/bonito/htpasswd", _username, _password], stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
-            if proc.returncode == 0:
-                os.environ["REMOTE_USER"] = _username
-            del _username, _password, digest, proc
-
-    if 'MANATEE_REGISTRY' not in os.environ:
-        # TODO: SET THIS APROPRIATELY!
-        os.environ['MANATEE_REGISTRY'] = '/corpora/registry'
-
-    BonitoCGI(user=username).run_unprotected (selectorname='corpname')
+    handle_request(username)
 
 # vim: ts=4 sw=4 sta et sts=4 si tw=80:
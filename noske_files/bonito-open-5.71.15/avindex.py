@@ -0,0 +1,304 @@
+#!/usr/bin/python3
+# Autocomplete index of attribute values for attr_vals
+#
+# Crystal asks for value suggestions on every keystroke (CQL builder, text
+# type boxes). Running regexp2ids over the whole lexicon and skipping `avfrom`
+# values one by one gets slower with every page and every value. For each
+# attribute the lexicon is stored once, ordered by frequency (rank 0 is the
+# most frequent value), together with the case-folded values and the ranks
+# sorted by case-folded value for prefix lookups
+# (<index_dir>/<registry file>/<attr>.avi). Lexicons with at most
+# NGRAM_MAX_VALUES values also get a trigram index for infix lookups
+# (<attr>.avg: sorted trigrams and their posting lists). Results are returned
+# in rank order, the continuation cursor is the rank of the last returned
+# value.
+#
+# Index files are mapped into memory and searched in place, so a request
+# only reads the pages it touches. They are built by build (bonito-ttindex.py
+# after compilation), never within a request: attributes without a current
+# index (valid until the corpus is recompiled, see ttindex) are passed to
+# manatee.
+#
+# Patterns handled by the index: `.*`, `lit.*` (prefix), `.*lit.*` (infix),
+# `.*lit` (suffix) and `lit` (exact), where lit contains no regular
+# expression operators (escaped characters are allowed). Other patterns are
+# passed to manatee.
+
+import os, re, json, mmap
+from array import array
+from bisect import bisect_right
+from urllib.parse import quote
+import ttindex
+
+MAX_VALUES = 5000000 # larger lexicons are not indexed
+NGRAM_MAX_VALUES = 1000000
+RANGE_SORT_LIMIT = 10000 # larger prefix ranges are scanned in rank order
+FORMAT = 2 # sections aligned, mapped into memory
+
+_PATTERN_RE = re.compile(r'^(\.\*)?((?:[^\\.*+?()\[\]{}|^$]|\\.)*)(\.\*)?$')
+_UNESCAPE_RE = re.compile(r'\\(.)')
+
+_indexes = {}
+
+
+def parse_pattern (pattern):
+    """returns (kind, literal) for patterns handled by the index, kind is
+    one of all, prefix, infix, suffix, exact, or (None, None)"""
+    m = _PATTERN_RE.match(pattern)
+    if not m:
+        return None, None
+    lead, literal, trail = m.groups()
+    literal = _UNESCAPE_RE.sub(r'\1', literal)
+    if not literal:
+        return (lead or trail) and ('all', '') or ('exact', '')
+    if lead and trail:
+        return 'infix', literal
+    if lead:
+        return 'suffix', literal
+    if trail:
+        return 'prefix', literal
+    return 'exact', literal
+
+
+def _trigrams (s):
+    return set(s[i:i+3] for i in range(len(s) - 2))
+
+
+class _Strings:
+    "read-only list of strings stored as offsets and utf-8 blob"
+    def __init__ (self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    @classmethod
+    def from_list (cls, strs):
+        blobs = [s.encode('utf-8') for s in strs]
+        offsets = array('I', [0])
+        for b in blobs:
+            offsets.append(offsets[-1] + len(b))
+        return cls(offsets, b''.join(blobs))
+
+    def __len__ (self):
+        return len(self.offsets) - 1
+
+    def __getitem__ (self, i):
+        return str(self.blob[self.offsets[i]:self.offsets[i+1]], 'utf-8')
+
+
+class _PrefixKeys:
+    "case-folded values in sorted order for bisect"
+    def __init__ (self, folded, prefix):
+        self.folded = folded
+        self.prefix = prefix
+
+    def __len__ (self):
+        return len(self.prefix)
+
+    def __getitem__ (self, i):
+        return self.folded[self.prefix[i]]
+
+
+def _bisect_left (keys, key):
+    lo, hi = 0, len(keys)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if keys[mid] < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _write (path, files, arrays):
+    """saves arrays (of typecode I or bytes) after a JSON header, each
+    starting at a multiple of 8 bytes"""
+    lengths = [len(a) for a in arrays]
+    header = {'format': FORMAT, 'files': files, 'lengths': lengths,
+              'offsets': []}
+    sections = [a if isinstance(a, bytes) else a.tobytes() for a in arrays]
+    header_len = 0
+    while True: # offsets depend on the length of the header
+        pos = header_len
+        header['offsets'] = []
+        for section in sections:
+            header['offsets'].append(pos)
+            pos = (pos + len(section) + 7) // 8 * 8
+        header_bytes = json.dumps(header).encode('utf-8') + b'\n'
+        if len(header_bytes) <= header_len:
+            break
+        header_len = (len(header_bytes) + 7) // 8 * 8
+    tmp_path = '%s.%d' % (path, os.getpid())
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(tmp_path, 'wb') as f:
+        f.write(header_bytes)
+        for offset, section in zip(header['offsets'], sections):
+            f.write(b'\0' * (offset - f.tell()))
+            f.write(section)
+    os.replace(tmp_path, path)
+
+
+def _map (path, typecodes):
+    """header and arrays of the given typecodes (None = bytes) saved by
+    _write, as views of the file mapped into memory; None, None if missing
+    or outdated"""
+    try:
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None, None
+    try:
+        header = json.loads(mm.readline())
+    except ValueError:
+        return None, None
+    if not isinstance(header, dict) or header.get('format') != FORMAT \
+            or not ttindex.is_current(header['files']):
+        return None, None
+    view = memoryview(mm)
+    out = []
+    for typecode, length, offset in zip(typecodes, header['lengths'],
+                                        header['offsets']):
+        if typecode is None:
+            out.append(view[offset:offset + length])
+        else:
+            out.append(view[offset:offset + 4 * length].cast(typecode))
+    return header, out
+
+
+class AutocompleteIndex:
+    def __init__ (self, path):
+        "index saved in path, see build"
+        self.path = path
+        header, arrays = _map(path, ('I', None, 'I', None, 'I'))
+        if header is None:
+            raise ValueError('No current autocomplete index ' + path)
+        self.files = header['files']
+        offsets, blob, foffsets, fblob, self.prefix = arrays
+        self.values = _Strings(offsets, blob)
+        self.folded = _Strings(foffsets, fblob)
+        self.keys = _PrefixKeys(self.folded, self.prefix)
+        self.grams = None
+        if len(self.values) <= NGRAM_MAX_VALUES:
+            header, arrays = _map(path[:-4] + '.avg', ('I', None, 'I', 'I'))
+            if header:
+                koffsets, kblob, self.poffsets, self.postings = arrays
+                self.grams = _Strings(koffsets, kblob)
+
+    def _postings (self, gram):
+        "ranks of values containing trigram, in rank order"
+        i = _bisect_left(self.grams, gram)
+        if i == len(self.grams) or self.grams[i] != gram:
+            return ()
+        return self.postings[self.poffsets[i]:self.poffsets[i+1]]
+
+    def _candidates (self, kind, literal, after):
+        "ranks > after which may match, in rank order"
+        n = len(self.values)
+        if kind in ('prefix', 'exact'):
+            lo = _bisect_left(self.keys, literal)
+            if kind == 'exact':
+                hi = _bisect_left(self.keys, literal + '\0')
+            else:
+                hi = _bisect_left(self.keys, literal + '\U0010ffff')
+            if hi - lo <= RANGE_SORT_LIMIT:
+                return sorted(r for r in self.prefix[lo:hi] if r > after)
+        elif kind in ('infix', 'suffix') and len(literal) >= 3 and self.grams:
+            postings = min((self._postings(g) for g in _trigrams(literal)),
+                           key=len)
+            return postings[bisect_right(postings, after):]
+        return range(after + 1, n)
+
+    def search (self, kind, literal, icase=True, maxitems=20, after=-1):
+        """returns list of (rank, value) of at most maxitems matching values
+        with rank > after, and whether there are no more matching values"""
+        folded_literal = literal.casefold()
+        if kind == 'all':
+            match = lambda v, f: True
+        elif kind == 'prefix':
+            match = icase and (lambda v, f: f.startswith(folded_literal)) \
+                          or (lambda v, f: v.startswith(literal))
+        elif kind == 'suffix':
+            match = icase and (lambda v, f: f.endswith(folded_literal)) \
+                          or (lambda v, f: v.endswith(literal))
+        elif kind == 'infix':
+            match = icase and (lambda v, f: folded_literal in f) \
+                          or (lambda v, f: literal in v)
+        else:
+            match = icase and (lambda v, f: f == folded_literal) \
+                          or (lambda v, f: v == literal)
+        out = []
+        for r in self._candidates(kind, folded_literal, after):
+            if kind != 'all' and not match(self.values[r], self.folded[r]):
+                continue
+            if len(out) == maxitems:
+                return out, False
+            out.append((r, self.values[r]))
+        return out, True
+
+
+def _index_file (index_dir, corp, attrname):
+    return os.path.join(index_dir, quote(corp.get_confpath(), safe=''),
+                        quote(attrname, safe='') + '.avi')
+
+
+def build_index (corp, attrname, index_dir):
+    "saves the index (and trigram index) of attribute, False if too large"
+    attr = corp.get_attr(attrname, True)
+    n = attr.id_range()
+    if n > MAX_VALUES:
+        return False
+    files = ttindex.corpus_mtimes(corp)
+    try:
+        freqs = [attr.freq(i) for i in range(n)]
+    except Exception: # no frequencies compiled, keep lexicon order
+        freqs = [0] * n
+    ids = sorted(range(n), key=lambda i: -freqs[i])
+    strs = [attr.id2str(i) for i in ids]
+    folded = [s.casefold() for s in strs]
+    values = _Strings.from_list(strs)
+    fvalues = _Strings.from_list(folded)
+    prefix = array('I', sorted(range(n), key=lambda r: folded[r]))
+    path = _index_file(index_dir, corp, attrname)
+    if n <= NGRAM_MAX_VALUES:
+        grams = {}
+        for r, f in enumerate(folded):
+            for g in _trigrams(f):
+                grams.setdefault(g, array('I')).append(r)
+        keys = sorted(grams)
+        poffsets = array('I', [0])
+        postings = array('I')
+        for k in keys:
+            postings.extend(grams[k])
+            poffsets.append(len(postings))
+        skeys = _Strings.from_list(keys)
+        _write(path[:-4] + '.avg', files,
+               [skeys.offsets, skeys.blob, poffsets, postings])
+    _write(path, files, [values.offsets, values.blob, fvalues.offsets,
+                         fvalues.blob, prefix])
+    _indexes.pop((corp.get_confpath(), attrname), None)
+    return True
+
+
+def build (corp, index_dir):
+    "saves indexes of all positional and structure attributes of corpus"
+    for attrname in corp.get_conf('ATTRLIST').split(',') + \
+                    corp.get_conf('STRUCTATTRLIST').split(','):
+        if attrname:
+            build_index(corp, attrname, index_dir)
+
+
+def get_index (corp, attrname, index_dir=None):
+    """AutocompleteIndex of attribute, None if there is no current index
+    (not built yet, corpus recompiled or lexicon too large)"""
+    if not index_dir:
+        return None
+    key = (corp.get_confpath(), attrname)
+    index = _indexes.get(key)
+    if index and ttindex.is_current(index.files):
+        return index
+    try:
+        index = AutocompleteIndex(_index_file(index_dir, corp, attrname))
+    except ValueError:
+        _indexes.pop(key, None)
+        return None
+    _indexes[key] = index
+    return index
@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+# Indexed binary form of bilingual terminology (.biterms) files
+#
+# A .biterms file is a TSV with one term pair per line
+# (l1 term, l2 term, f(ab), f(a), f(b), l1 score, l2 score, logDice).
+# compile_biterms converts it once into a memory mapped file
+# (<index_dir>/<.biterms path>.bti, rebuilt if the .biterms file changes):
+#
+#   header   magic line and JSON line with section offsets and counts
+#   rows     fixed size records, term columns are ids into the string table
+#   firsts   row number of the first occurrence of the n-th distinct l1 term
+#   strings  interned terms and their display forms, sorted, as offsets
+#            into an utf-8 blob
+#
+# Pages of l1 terms are then a slice of rows, and filters are evaluated once
+# per distinct display string.
+
+import os, re, json, mmap
+from urllib.parse import quote
+
+MAGIC = b'BITERMS1\n'
+ROW_DTYPE = [('l1t', '<u4'), ('l2t', '<u4'), ('l1str', '<u4'), ('l2str', '<u4'),
+             ('fab', '<i8'), ('fa', '<i8'), ('fb', '<i8'),
+             ('l1s', '<f8'), ('l2s', '<f8'), ('ld', '<f8')]
+_SUFFIX_RE = re.compile('-.$')
+
+_indexes = {}
+
+
+def display_form (term):
+    "term without the -x part of speech suffix and with spaces"
+    return _SUFFIX_RE.sub('', term.replace("_", " "))
+
+
+def _align (n):
+    return (n + 7) // 8 * 8
+
+
+def compile_biterms (fname, outname):
+    "convert .biterms TSV file fname into indexed binary file outname"
+    import numpy as np
+    st = os.stat(fname)
+    records = []
+    strings = set()
+    firsts = []
+    seen = set()
+    with open(fname) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                break # get_biterms stopped at the first empty line as well
+            l1t, l2t, fab, fa, fb, l1s, l2s, ld = line.split('\t')
+            if l1t not in seen:
+                seen.add(l1t)
+                firsts.append(len(records))
+            l1str, l2str = display_form(l1t), display_form(l2t)
+            strings.update((l1t, l2t, l1str, l2str))
+            records.append((l1t, l2t, l1str, l2str, int(fab), int(fa), int(fb),
+                            float(l1s), float(l2s), float(ld)))
+    strings = sorted(strings)
+    sid = dict((s, i) for i, s in enumerate(strings))
+    rows = np.array([(sid[r[0]], sid[r[1]], sid[r[2]], sid[r[3]]) + r[4:]
+                     for r in records], dtype=ROW_DTYPE)
+    firsts = np.array(firsts, dtype='<u4')
+    blobs = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(blobs) + 1, dtype='<u8')
+    offsets[1:] = np.cumsum([len(b) for b in blobs])
+    sections = [rows.tobytes(), firsts.tobytes(), offsets.tobytes(),
+                b''.join(blobs)]
+    header = {'source': [st.st_size, st.st_mtime_ns], 'rows': len(rows),
+              'terms': len(firsts), 'strings': len(strings), 'offsets': []}
+    # offsets depend on the header length, which depends on the offsets
+    start = 0
+    while True:
+        header_bytes = MAGIC + json.dumps(header).encode('utf-8') + b'\n'
+        pos = _align(len(header_bytes))
+        if pos == start:
+            break
+        start = pos
+        header['offsets'] = []
+        for section in sections:
+            header['offsets'].append(pos)
+            pos = _align(pos + len(section))
+    tmp_path = '%s.%d' % (outname, os.getpid())
+    os.makedirs(os.path.dirname(outname), exist_ok=True)
+    with open(tmp_path, 'wb') as f:
+        f.write(header_bytes)
+        for offset, section in zip(header['offsets'], sections):
+            f.write(b'\0' * (offset - f.tell()))
+            f.write(section)
+    os.replace(tmp_path, outname)
+
+
+class BitermsIndex:
+    def __init__ (self, path):
+        import numpy as np
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm.readline() != MAGIC:
+            raise ValueError('Invalid biterms index ' + path)
+        self.header = json.loads(self.mm.readline())
+        o_rows, o_firsts, o_offsets, self.o_blob = self.header['offsets']
+        self.rows = np.frombuffer(self.mm, dtype=ROW_DTYPE,
+                                  count=self.header['rows'], offset=o_rows)
+        self.firsts = np.frombuffer(self.mm, dtype='<u4',
+                                    count=self.header['terms'], offset=o_firsts)
+        self.offsets = np.frombuffer(self.mm, dtype='<u8',
+                                     count=self.header['strings'] + 1,
+                                     offset=o_offsets)
+        self._strings = {}
+
+    def is_current (self, fname):
+        try:
+            st = os.stat(fname)
+        except OSError:
+            return False
+        return self.header['source'] == [st.st_size, st.st_mtime_ns]
+
+    def string (self, i):
+        s = self._strings.get(i)
+        if s is None:
+            start = self.o_blob + int(self.offsets[i])
+            end = self.o_blob + int(self.offsets[i+1])
+            s = self._strings[i] = self.mm[start:end].decode('utf-8')
+        return s
+
+    def page (self, start=0, limit=1000):
+        """rows of the start-th to (start+limit-1)-th distinct l1 term, in
+        file order; every page holds all pairs of its terms, so that the
+        pages starting at 0, limit, 2*limit, ... cover all rows"""
+        if start >= len(self.firsts) or limit <= 0:
+            return self.rows[:0]
+        if start + limit < len(self.firsts):
+            end = int(self.firsts[start + limit])
+        else:
+            end = len(self.rows)
+        return self.rows[int(self.firsts[start]):end]
+
+    def filter (self, rows, patterns):
+        "rows whose display strings match all compiled patterns"
+        if not patterns:
+            return rows
+        import numpy as np
+        cache = {}
+        def ok (i):
+            if i not in cache:
+                s = self.string(i)
+                cache[i] = all(p.match(s) for p in patterns)
+            return cache[i]
+        keep = np.fromiter((ok(a) and ok(b) for a, b in
+                            zip(rows['l1str'].tolist(), rows['l2str'].tolist())),
+                           dtype=bool, count=len(rows))
+        return rows[keep]
+
+    def to_lists (self, rows):
+        "rows in the format of get_biterms"
+        s = self.string
+        return [[s(r[2]), s(r[3]), r[4], r[5], r[6], r[7], r[8], r[9],
+                 s(r[0]), s(r[1])] for r in rows.tolist()]
+
+
+def get_index (fname, index_dir):
+    "BitermsIndex of .biterms file, compiled if missing or outdated"
+    index = _indexes.get(fname)
+    if index and index.is_current(fname):
+        return index
+    path = os.path.join(index_dir, quote(fname, safe='') + '.bti')
+    index = None
+    if os.path.exists(path):
+        try:
+            index = BitermsIndex(path)
+        except (OSError, ValueError):
+            index = None
+    if not index or not index.is_current(fname):
+        compile_biterms(fname, path)
+        index = BitermsIndex(path)
+    _indexes[fname] = index
+    return index
@@ -0,0 +1,324 @@
+# Copyright (c) 2003-2019  Pavel Rychly, Vojtech Kovar, Milos Jakubicek
+#
+# Saved concordances of a corpus (<cache>/<corpus>/<name>.conc) are indexed
+# in an SQLite database (<cache>/<corpus>/00CONCS.db, WAL mode, so readers do
+# not block each other nor the writer), one row per (subchash, query prefix):
+#
+#   name   file name of the concordance (see uniqname)
+#   size   number of lines, -1 while being computed
+#   bytes  size of the file (filled in by evict_cache if not known yet)
+#   cost   seconds the computation took
+#   atime  time of the last access (moved ahead by keep_in_map to retain
+#          a concordance for a while without accessing it)
+#
+# evict_cache (run periodically by the concordance daemon) keeps the
+# concordances under a cache directory within a byte budget. Pages rendered
+# from a concordance (<name>.pages, see rendercache) count towards the budget
+# of the concordance and are removed with it.
+
+import os, json, time, sqlite3, threading, manatee
+from butils import flck_sh_lock, flck_unlock
+from pyconc import PyConc
+import concd, rendercache
+
+MAP_FILE = '00CONCS.db'
+ATIME_RESOLUTION = 60 # seconds, access times are not updated more often
+EVICT_MIN_AGE = 300 # seconds, more recently used concordances are kept
+EVICT_COST_FLOOR = 1.0 # seconds, cost of concordances computed instantly
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS concs (
+    subchash TEXT NOT NULL,
+    q TEXT NOT NULL,
+    name TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    cost REAL NOT NULL DEFAULT 0,
+    atime REAL NOT NULL,
+    PRIMARY KEY (subchash, q));
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+'''
+
+_local = threading.local() # connections are per thread (concd)
+
+def _connect (_cache_dir, create=True):
+    "connection to the map of _cache_dir, None if it does not exist"
+    path = _cache_dir + MAP_FILE
+    conns = _local.__dict__.setdefault('conns', {})
+    try:
+        ino = os.stat(path).st_ino
+    except OSError:
+        ino = None
+    conn, conn_ino = conns.get(path, (None, None))
+    if conn and conn_ino == ino: # not replaced by wiping the cache
+        return conn
+    if conn:
+        conn.close()
+        del conns[path]
+    if ino is None and not create:
+        return None
+    os.makedirs(_cache_dir, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(_SCHEMA)
+    except sqlite3.DatabaseError:
+        conn.close()
+        os.rename(path, '%s00CONCS-broken-%d.db' % (_cache_dir, os.getpid()))
+        for suffix in ('-wal', '-shm'):
+            try:
+                os.remove(path + suffix)
+            except OSError:
+                pass
+        return _connect(_cache_dir, create)
+    conns[path] = (conn, os.stat(path).st_ino)
+    return conn
+
+class _transaction:
+    "BEGIN IMMEDIATE .. COMMIT/ROLLBACK, i.e. with the write lock held"
+    def __init__ (self, conn):
+        self.conn = conn
+    def __enter__ (self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+    def __exit__ (self, exc_type, exc, tb):
+        self.conn.execute(exc_type and 'ROLLBACK' or 'COMMIT')
+
+def _key (subchash, key):
+    if isinstance(subchash, bytes):
+        subchash = subchash.hex()
+    return (subchash or '', json.dumps(list(key), ensure_ascii=False))
+
+def load_map (_cache_dir):
+    "whole map as {(subchash, query prefix): (name, size)}"
+    conn = _connect(_cache_dir, create=False)
+    if not conn:
+        return {}
+    ret = {}
+    for subchash, q, name, size in conn.execute(
+            'SELECT subchash, q, name, size FROM concs'):
+        subchash = subchash and bytes.fromhex(subchash) or None
+        ret[subchash, tuple(json.loads(q))] = (name, size)
+    return ret
+
+def get_from_map (_cache_dir, subchash, key):
+    "(name, size) of key, None if it is not registered"
+    conn = _connect(_cache_dir, create=False)
+    if not conn:
+        return None
+    return conn.execute('SELECT name, size FROM concs WHERE subchash=? AND q=?',
+                        _key(subchash, key)).fetchone()
+
+def touch_map (_cache_dir, subchash, key):
+    "records access to key"
+    now = time.time()
+    conn = _connect(_cache_dir)
+    conn.execute('UPDATE concs SET atime=? WHERE subchash=? AND q=? AND atime<?',
+                 (now,) + _key(subchash, key) + (now - ATIME_RESOLUTION,))
+
+def keep_in_map (_cache_dir, subchash, key, ttl):
+    "keeps key from being evicted for the next ttl seconds"
+    atime = time.time() + ttl - EVICT_MIN_AGE
+    conn = _connect(_cache_dir, create=False)
+    if conn:
+        conn.execute('UPDATE concs SET atime=? WHERE subchash=? AND q=? '
+                     'AND atime<?', (atime,) + _key(subchash, key) + (atime,))
+
+def _basename (key):
+    name = '#'.join ([''.join ([c for c in w if c.isalnum()]) for w in key])
+    return name[1:15] or 'noalnums'
+
+def uniqname (key, used):
+    name = _basename (key)
+    if name in used:
+        used = [w[len(name):] for w in used if w.startswith(name)]
+        i = 0
+        while str(i) in used:
+            i += 1
+        name += str(i)
+    return name
+
+def add_to_map (_cache_dir, subchash, key, size, cost=0):
+    """registers key with size (-1 while it is being computed) and the
+    seconds its computation took, returns the cache file and whether key
+    was not registered before"""
+    now = time.time()
+    k = _key(subchash, key)
+    conn = _connect(_cache_dir)
+    with _transaction(conn):
+        row = conn.execute('SELECT name, size FROM concs WHERE subchash=? '
+                           'AND q=?', k).fetchone()
+        new = row is None
+        if new:
+            base = _basename(key)
+            used = [r[0] for r in conn.execute('SELECT name FROM concs '
+                                               'WHERE name GLOB ?', (base + '*',))]
+            name = uniqname(key, used)
+            conn.execute('INSERT INTO concs (subchash, q, name, size, cost, '
+                         'atime) VALUES (?, ?, ?, ?, ?, ?)',
+                         k + (name, size, cost, now))
+        else:
+            name, storedsize = row
+            if storedsize < size:
+                try:
+                    nbytes = os.path.getsize(_cache_dir + name + '.conc')
+                except OSError:
+                    nbytes = 0
+                conn.execute('UPDATE concs SET size=?, bytes=?, cost=?, atime=? '
+                             'WHERE subchash=? AND q=?',
+                             (size, nbytes, cost, now) + k)
+    return _cache_dir + name + ".conc", new
+
+def del_from_map (_cache_dir, subchash, key):
+    conn = _connect(_cache_dir, create=False)
+    if conn:
+        conn.execute('DELETE FROM concs WHERE subchash=? AND q=?',
+                     _key(subchash, key))
+
+def remove_conc_files (_cache_dir, name):
+    "removes a saved concordance and the pages rendered from it"
+    for f in (name + '.conc', name + '.map'):
+        try:
+            os.remove(_cache_dir + f)
+        except OSError:
+            pass
+    rendercache.remove_pages(_cache_dir + name + '.conc')
+
+def _check_lex (corp, _cache_dir):
+    "removes concordances saved before the corpus was recompiled"
+    attr = "word"
+    if not attr in corp.get_conf("ATTRLIST").split(","):
+        attr = corp.get_conf("DEFAULTATTR")
+    try:
+        lex_mtime = os.stat(corp.get_conf('PATH') + attr + '.lex').st_mtime
+        conn = _connect(_cache_dir)
+    except OSError:
+        return
+    row = conn.execute("SELECT value FROM meta WHERE key='lex_mtime'").fetchone()
+    if row and row[0] == lex_mtime:
+        return
+    with _transaction(conn):
+        names = [r[0] for r in conn.execute('SELECT name FROM concs')]
+        conn.execute('DELETE FROM concs')
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('lex_mtime', ?)",
+                     (lex_mtime,))
+    if row is None: # also files of the former pickled map
+        names = [f[:-5] for f in os.listdir(_cache_dir) if f.endswith('.conc')]
+        names += ['00CONCS']
+    for name in names:
+        remove_conc_files(_cache_dir, name)
+
+def get_cached_conc (corp, subchash, q, _cache_dir, minsize, concd_socket=''):
+    q = tuple (q)
+    _check_lex (corp, _cache_dir)
+    for i in range (len(q), 0, -1):
+        cache_val = get_from_map (_cache_dir, subchash, q[:i])
+        if cache_val:
+            cache_id, size = cache_val[0], cache_val[1]
+            cachefile = os.path.join (_cache_dir, cache_id + '.conc')
+            if size == -1: # not yet finished, join the computation
+                conc = concd.get_conc (concd_socket, corp, subchash, q[:i],
+                                       _cache_dir, minsize=minsize,
+                                       create=False)
+                if conc:
+                    return i, conc
+                # did we finish meanwhile?
+                cache_val = get_from_map (_cache_dir, subchash, q[:i])
+                if cache_val and cache_val[1] == -1: # dead item
+                    del_from_map (_cache_dir, subchash, q[:i])
+                    remove_conc_files (_cache_dir, cache_id)
+                    continue
+            if not os.path.exists (cachefile.encode("utf-8")): # broken cache
+                del_from_map (_cache_dir, subchash, q[:i])
+                rendercache.remove_pages (cachefile)
+                continue
+            conccorp = corp
+            for qq in reversed(q[:i]): # find the right main corp, if aligned
+                if qq.startswith('x-'): conccorp = manatee.Corpus(qq[2:]); break
+            conc = PyConc (conccorp, 'l', cachefile, orig_corp=corp)
+            touch_map (_cache_dir, subchash, q[:i])
+            return i, conc
+    return 0, None
+
+def get_cache_conc_sizes (corp, q, _cache_dir):
+    q = tuple(q)
+    subchash=getattr(corp, "subchash", None)
+    _cache_dir = _cache_dir + '/' + corp.corpname + '/'
+    cache_val = get_from_map (_cache_dir, subchash, q)
+    if not cache_val:
+        return 1, 0, 0
+    cachefile = os.path.join (_cache_dir, cache_val[0] + '.conc')
+    import struct
+    cache = open(cachefile,"rb")
+    flck_sh_lock (cache)
+    cache.seek(15);
+    finished = ord(cache.read(1))
+    (fullsize,) = struct.unpack("q",cache.read(8))
+    cache.seek(32);
+    (concsize,) = struct.unpack("i",cache.read(4))
+    flck_unlock (cache)
+    return finished, concsize, fullsize
+
+def get_existing_conc_sizes (corp, q, _cache_dir, concd_socket=''):
+    sizes = concd.get_conc_sizes (concd_socket, corp, q,
+                                  _cache_dir + '/' + corp.corpname + '/')
+    if sizes:
+        finished, concsize, fullsize = sizes
+    else: # we may have finished meanwhile
+        finished, concsize, fullsize = get_cache_conc_sizes (corp, q,_cache_dir)
+    if fullsize > 0:
+        relconcsize = 1000000.0 * fullsize / corp.search_size()
+    else:
+        relconcsize = 1000000.0 * concsize / corp.search_size()
+        fullsize = concsize
+    return {'finished':finished, 'concsize':concsize, 'fullsize': fullsize,
+            'relconcsize': relconcsize}
+
+def _map_entries (_cache_dir):
+    """(_cache_dir, name, bytes, cost, atime) of finished concordances,
+    bytes include the pages rendered from them"""
+    conn = _connect(_cache_dir, create=False)
+    if not conn:
+        return []
+    entries = []
+    for name, size, nbytes, cost, atime in conn.execute(
+            'SELECT name, size, bytes, cost, atime FROM concs WHERE size!=-1'):
+        if not nbytes: # saved after registering (see conclib.get_conc)
+            try:
+                nbytes = os.path.getsize(_cache_dir + name + '.conc')
+            except OSError:
+                continue
+            conn.execute('UPDATE concs SET bytes=? WHERE name=?', (nbytes, name))
+        nbytes += rendercache.pages_size(_cache_dir + name + '.conc')
+        entries.append((_cache_dir, name, nbytes, cost, atime))
+    return entries
+
+def evict_cache (cache_root, quota, min_age=EVICT_MIN_AGE):
+    """removes saved concordances below cache_root until they take at most
+    quota bytes: least recently used first, weighted by how long they took
+    to compute (an entry twice as expensive survives twice as long unused);
+    concordances used in the last min_age seconds are kept. Returns the
+    bytes used before and the bytes freed."""
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(cache_root):
+        dirnames[:] = [d for d in dirnames
+                       if not d.startswith('.') and not d.endswith('.pages')]
+        if MAP_FILE in filenames:
+            entries.extend(_map_entries(os.path.join(dirpath, '')))
+    used = sum(e[2] for e in entries)
+    freed = 0
+    now = time.time()
+    candidates = sorted((e for e in entries if now - e[4] > min_age),
+                        key=lambda e: (now - e[4]) / (e[3] + EVICT_COST_FLOOR),
+                        reverse=True)
+    for _cache_dir, name, nbytes, cost, atime in candidates:
+        if used - freed <= quota:
+            break
+        conn = _connect(_cache_dir)
+        # unless accessed meanwhile
+        if conn.execute('DELETE FROM concs WHERE name=? AND atime=?',
+                        (name, atime)).rowcount:
+            remove_conc_files(_cache_dir, name)
+            freed += nbytes
+    return used, freed
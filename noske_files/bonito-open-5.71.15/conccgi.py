@@ -2,12 +2,11 @@
 
 from CGIPublisher import correct_types
 from usercgi import UserCGI
-import corplib, conclib
+import corplib, conclib, corpcatalog, conccache, rendercache
 from corplib import corpconf_pairs
 import os
 import re
 import sys
-import gdex
 import manatee
 from pyconc import PyConc
 from manatee import regexp_pattern
@@ -15,11 +14,9 @@ import time
 import glob
 from collections import defaultdict
 from butils import escape, escape_nonwild
-from annotlib import Annotation
 from conclib import strkwiclines
-
-
-USER_SCOPED_CORPORA_SEP = "----"
+from regcatalog import USER_SCOPED_CORPORA_SEP
+import timings
 
 
 def onelevelcrit (prefix, attr, ctx, pos, fcode, icase, bward='', empty=''):
@@ -112,6 +109,12 @@ def sentence(s):
     return whitespace(specific(s))
 
 
+def Annotation (*args, **kwargs):
+    "annotlib.Annotation, annotlib (sqlite3 etc.) is imported on first use only"
+    from annotlib import Annotation
+    return Annotation(*args, **kwargs)
+
+
 def gdex_examples(corp, query, number):
     """
     GDEX query
@@ -120,6 +123,7 @@ def gdex_examples(corp, query, number):
     :param number: int
     :return: GDEX result object
     """
+    import gdex # imports yaml, only needed here
     gdex_engine = gdex.GDEX(corp)
     cc = PyConc(corp, 'q', query)
     cc.sync()
@@ -245,6 +249,9 @@ class ConcCGI (UserCGI):
     subcname = ''
     subcpath = []
     _conc_dir = ''
+    _concd_socket = '' # default: concd.sock next to _cache_dir
+    _conc_cache_quota = 0 # bytes of saved concordances, 0: unlimited
+    _reformat_lines = False # Lines in the format of the concordance API
     annotation_group = ''
     _home_url = '../index.html'
     files_path = '..'
@@ -322,6 +329,12 @@ class ConcCGI (UserCGI):
         self.cm = corplib.CorpusManager (self.corplist, self.subcpath,
                                          self.gdexpath, self._job,
                                          abs_corpname=self.abs_corpname)
+        self.cm.catalog_dir = os.path.join(self._cache_dir, '.corpcatalog')
+        self.cm.ttindex_dir = os.path.join(self._cache_dir, '.ttindex')
+        self.cm.corpinfo_dir = os.path.join(self._cache_dir, '.corpinfo')
+        if not self._concd_socket: # outside of _cache_dir, which gets wiped
+            self._concd_socket = os.path.join(os.path.dirname(
+                    os.path.abspath(self._cache_dir)), 'concd.sock')
         self._curr_corpus = None
 
     def corpora(self):
@@ -350,26 +363,27 @@ class ConcCGI (UserCGI):
         for c in self.corplist:
             o = dict(defs)
             try:
-                mc = conclib.manatee.Corpus(self.abs_corpname(c))
-                sizes, _ = corplib.parse_sizes(mc.get_sizes())
+                entry = corpcatalog.get_entry(self.abs_corpname(c),
+                                              self.cm.catalog_dir)
+                conf, sizes = entry['conf'], entry['sizes']
                 o.update({
                     'corpname': c,
-                    'language_id': mc.get_conf('LANGUAGE'),
-                    'language_name': mc.get_conf('LANGUAGE'),
+                    'language_id': conf['LANGUAGE'],
+                    'language_name': conf['LANGUAGE'],
                     'sizes': sizes,
                     'compilation_status': sizes and 'COMPILED' or 'READY',
-                    'new_version': mc.get_conf('NEWVERSION'),
-                    'name': mc.get_conf('NAME'),
-                    'info': mc.get_conf('INFO'),
-                    'handle': mc.get_conf('HANDLE') or None,
-                    'institution': mc.get_conf('INSTITUTION') or None,
-                    'wsdef': mc.get_conf('WSDEF'),
-                    'termdef': mc.get_conf('TERMDEF'),
-                    'diachronic': bool(mc.get_conf('DIACHRONIC')),
-                    'aligned': mc.get_conf('ALIGNED').split(',') if mc.get_conf('ALIGNED') else [],
-                    'docstructure': mc.get_conf('DOCSTRUCTURE')
+                    'new_version': conf['NEWVERSION'],
+                    'name': conf['NAME'],
+                    'info': conf['INFO'],
+                    'handle': conf['HANDLE'] or None,
+                    'institution': conf['INSTITUTION'] or None,
+                    'wsdef': conf['WSDEF'],
+                    'termdef': conf['TERMDEF'],
+                    'diachronic': bool(conf['DIACHRONIC']),
+                    'aligned': conf['ALIGNED'].split(',') if conf['ALIGNED'] else [],
+                    'docstructure': conf['DOCSTRUCTURE']
                 })
-                o.update({'wsinfo': corplib.get_ws_info(mc)})
+                o.update({'wsinfo': entry['wsinfo']})
                 if USER_SCOPED_CORPORA_SEP in c:
                     owner_name = c.split(USER_SCOPED_CORPORA_SEP, 1)[0]
                     o.update({
@@ -385,8 +399,8 @@ class ConcCGI (UserCGI):
         langs = set()
         for c in self.corplist:
             try:
-                mc = conclib.manatee.Corpus(self.abs_corpname(c))
-                lang = mc.get_conf('LANGUAGE')
+                lang = corpcatalog.get_entry(self.abs_corpname(c),
+                                    self.cm.catalog_dir)['conf']['LANGUAGE']
             except corplib.manatee.CorpInfoNotFound:
                 continue
             langs.add(lang)
@@ -415,13 +429,18 @@ class ConcCGI (UserCGI):
     def _corp (self):
         if (not self._curr_corpus or
             (self.usesubcorp and not hasattr(self._curr_corpus, 'subcname'))):
-            self._curr_corpus = self.cm.get_Corpus (self.corpname,
-                                         self.usesubcorp, self.complement_subc)
+            with timings.phase('_corp'):
+                self._curr_corpus = self.cm.get_Corpus (
+                        self.corpname, self.usesubcorp, self.complement_subc)
             if self.cm.obsolete_subcorp:
                 self.obsolete_subcorp = self.cm.obsolete_subcorp
                 self.obsolete_has_subcdef = self.cm.obsolete_has_subcdef
                 if self.obsolete_has_subcdef:
                     self.rebuild_subc(self.usesubcorp)
+                    self.cm.obsolete_subcorp = ''
+                    self.cm.obsolete_has_subcdef = False
+                    self._curr_corpus = self.cm.get_Corpus (
+                            self.corpname, self.usesubcorp, self.complement_subc)
             if self.cm.missing_subc_error:
                 self.usesubcorp = ''
                 raise RuntimeError(self.cm.missing_subc_error)
@@ -485,24 +504,16 @@ class ConcCGI (UserCGI):
     refs_up = 0
 
     def set_default_refs (self):
+        if 'refs' in self.__dict__ and 'reflinks' in self.__dict__:
+            return
+        ref_table = conclib.get_ref_table(self._corp())
         if 'refs' not in self.__dict__:
-            if self._corp().get_conf('SHORTREF'):
-                self.refs = self._corp().get_conf('SHORTREF')
-            else:
-                sal = self._corp().get_conf('STRUCTATTRLIST').split(',')
-                docs = self._corp().get_conf('DOCSTRUCTURE')
-                if docs + '.urldomain' in sal:
-                    self.refs = '=' + docs + '.urldomain'
-                else:
-                    self.refs = '#'
+            self.refs = ref_table['refs']
         if 'reflinks' not in self.__dict__:
-            c = self._corp()
-            sal = c.get_conf('STRUCTATTRLIST').split(',')
-            for sa in sal:
-                if sa and c.get_conf(sa + '.URLTEMPLATE'):
-                    self.reflinks.append(sa)
+            self.reflinks = list(ref_table['reflinks'])
 
     reflinks = []
+    kwic_format = '' # concordance: 'columnar' for parallel lists per line
     concordance_query = []
 
     def process_concordance_query(self):
@@ -592,16 +603,36 @@ class ConcCGI (UserCGI):
         self.format = self.format or 'json'
         self.process_concordance_query()
         self.gdex_enabled = 0 # fix for Crystal, might be removed later
+        self._reformat_lines = True # reformat the output
         out = self.view()
         if 'error' in out:
             out.update({'concsize': 0, 'fullsize': 0, 'Lines': []})
-            return out
-        for line in out['Lines']: # reformat the output
-            self.reformat_conc_line(line)
-            for aligned_line in line.get('Align', []):
-                self.reformat_conc_line(aligned_line)
         return out
 
+    def concordance_stream (self, interval=0.5):
+        """concordance as server-sent events (sse=1): the first page as soon
+        as enough lines are available (see concordance), then the sizes
+        (concsize, fullsize, relsize, finished) whenever they change until
+        the concordance is finished, instead of polling get_conc_sizes"""
+        try:
+            out = self.concordance()
+        except Exception as e:
+            out = {'error': str(e)}
+        yield out
+        if 'error' in out or out.get('finished', 1):
+            return
+        corp = self._corp()
+        last = (out['concsize'], out['fullsize'])
+        for cs in conclib.conc_size_updates(corp, self.q, self._cache_dir,
+                                            self._concd_socket,
+                                            max(0.1, interval)):
+            if (cs['concsize'], cs['fullsize']) == last and not cs['finished']:
+                continue
+            last = (cs['concsize'], cs['fullsize'])
+            yield {'concsize': cs['concsize'], 'fullsize': cs['fullsize'],
+                   'relsize': round(cs['relconcsize'], 2),
+                   'finished': int(cs['finished'])}
+
     def view (self):
         "kwic view"
 
@@ -666,19 +697,41 @@ class ConcCGI (UserCGI):
         elif self._wordlist_max_size > 0:
             self.pagesize = min(self.pagesize, concordance_size_limit)
         alignlist = [self.cm.get_Corpus(c) for c in self.align.split(',') if c]
-        out = self.call_function(conclib.kwicpage, (conc,), labelmap=labelmap,
-                                 pagesize=self.pagesize,
-                                 alignlist=alignlist,
-                                 tbl_template=self.tbl_template,
-                                 reflinks=self.reflinks)
+        kwic_format = ''
+        if self._reformat_lines and self.kwic_format == 'columnar' \
+                and self.format == 'json': # not for exports
+            kwic_format = 'columnar'
+        render_key = not self.annotconc and self._render_key(conc, kwic_format)
+        out = render_key and rendercache.render_cache.get(render_key)
+        if not out:
+            out = self.call_function(conclib.kwicpage, (conc,),
+                                     labelmap=labelmap,
+                                     pagesize=self.pagesize,
+                                     alignlist=alignlist,
+                                     tbl_template=self.tbl_template,
+                                     reflinks=self.reflinks,
+                                     kwic_format=kwic_format)
+            if self._reformat_lines and not kwic_format:
+                for line in out['Lines']:
+                    self.reformat_conc_line(line)
+                    for aligned_line in line.get('Align', []):
+                        self.reformat_conc_line(aligned_line)
+            if self.annotconc:
+                out['Sort_idx'] = []
+            else:
+                out['Sort_idx'] = self.call_function (conclib.get_sort_idx,
+                                        (conc,), enc=self.self_encoding())
+            if render_key:
+                rendercache.render_cache.put(render_key, out)
         out['concordance_size_limit'] = concordance_size_limit
-        if self.annotconc:
-            out['Sort_idx'] = []
-        else:
-            out['Sort_idx'] = self.call_function (conclib.get_sort_idx, (conc,),
-                                                      enc=self.self_encoding())
         out['righttoleft'] = self.righttoleft
-        out['Aligned_rtl'] = [x.get_conf('RIGHTTOLEFT') == "1" for x in alignlist]
+        al_labels = {}
+        if self._corp().get_conf('ALIGNED'):
+            al_labels = corplib.get_aligned_labels(self._corp())
+        out['Aligned_rtl'] = [al_labels[c]['rtl'] if c in al_labels
+                              else x.get_conf('RIGHTTOLEFT') == "1"
+                              for c, x in zip([c for c in self.align.split(',')
+                                               if c], alignlist)]
         out['numofcolls'] = conc.numofcolls()
         # get sizes
         relsize = float(1000000) * conc.fullsize() / conc.corp().search_size()
@@ -689,15 +742,15 @@ class ConcCGI (UserCGI):
         docstruct = conc.corp().get_conf("DOCSTRUCTURE")
         starattr = conc.corp().get_conf("STARATTR")
         if docstruct and starattr and conc.finished():
-            star, docf = conclib.manatee.calc_average_structattr(conc.corp(), docstruct, starattr, conc.RS())
+            with timings.phase('calc_average_structattr'):
+                star, docf = conclib.manatee.calc_average_structattr(conc.corp(), docstruct, starattr, conc.RS())
             sc = self.cm.get_Corpus (self.corpname, self.usesubcorp)
             size = sc.get_struct(sc.get_conf("DOCSTRUCTURE")).search_size()
             out.update({"star": star, "docf": docf, 'reldocf': round(docf * 100 / size, 5)})
-        if self._corp().get_conf ('ALIGNED'):
-            out['Aligned'] = [{'n': w,
-                               'label': conclib.manatee.Corpus(w).get_conf(
-                                                                  'NAME') or w }
-                         for w in self._corp().get_conf ('ALIGNED').split(',')]
+        if al_labels:
+            out['Aligned'] = [{'n': w, 'label': al_labels[w]['label']}
+                              for w in self._corp().get_conf('ALIGNED').split(',')
+                              if w in al_labels]
         if self.align and not self.maincorp:
             self.maincorp = os.path.basename(self.corpname)
         out['q'] = self.q
@@ -709,6 +762,24 @@ class ConcCGI (UserCGI):
         return out
 
 
+    def _render_key (self, conc, kwic_format=''):
+        """render cache key of the current page of conc, None unless conc
+        is finished and saved in the concordance cache"""
+        if not conc.finished():
+            return None
+        corp = self._corp()
+        cache_dir = self._cache_dir + '/' + corp.corpname + '/'
+        cached = conccache.get_from_map(cache_dir,
+                                        getattr(corp, 'subchash', None), self.q)
+        if not cached or cached[1] == -1:
+            return None
+        return rendercache.page_key(cache_dir + cached[0] + '.conc',
+                (str(self.fromp), self.pagesize, self.attrs, self.ctxattrs,
+                 self.structs, self.refs, self.viewmode, self.leftctx,
+                 self.rightctx, self.align, self.tbl_template, self.hidenone,
+                 self.righttoleft, tuple(self.reflinks), self._reformat_lines,
+                 kwic_format))
+
     def struct_attr_values(self, struct, attr):
         try:
             a = self._corp().get_struct(struct).get_attr(attr)
@@ -718,9 +789,10 @@ class ConcCGI (UserCGI):
 
 
     def get_conc_sizes (self, q=[], port=0):
+        "port is kept for compatibility, sizes come from the concordance daemon"
         self._headers['Content-Type']= 'text/plain'
         cs = self.call_function (conclib.get_conc_sizes, (self._corp(),),
-                                 q=q or self.q, server_port=port)
+                                 q=q or self.q)
         return "\n".join(map(str,[cs["finished"], cs["concsize"],
                                   cs["relconcsize"], cs["fullsize"]]))
 
@@ -1135,11 +1207,13 @@ class ConcCGI (UserCGI):
                 subcpath = getattr(self._corp(), 'spath', '')
                 return corplib.compute_norms(self._corp(), self._user,
                                   attr.split('.')[0], subcpath, self.get_url())
+        with timings.phase('xfreq_dist'):
+            blocks = [conc.xfreq_dist (cr, flimit, freq_sort, ml,
+                      self.ftt_include_empty, self.wlmaxfreq) for cr in fcrit]
         result = {'fcrit': self.urlencode ([('fcrit', self.rec_recode(cr))
                                             for cr in fcrit]),
                   'FCrit': [{'fcrit': cr} for cr in fcrit],
-                  'Blocks': [conc.xfreq_dist (cr, flimit, freq_sort, ml,
-                             self.ftt_include_empty, self.wlmaxfreq) for cr in fcrit],
+                  'Blocks': blocks,
                   'paging': 0,
                   'concsize':conc.size(),
                   'fullsize':conc.fullsize(),
@@ -1365,7 +1439,7 @@ class ConcCGI (UserCGI):
         "list collocations"
         corp = self._corp() # !! must precede manatee.Corpus(maincorp)
         if self.maincorp:
-            corp = conclib.manatee.Corpus(self.abs_corpname(self.maincorp))
+            corp = corplib.open_corpus(self.abs_corpname(self.maincorp))
         if usesubcorp and not corplib.are_subcorp_stats_compiled (corp, cattr):
             out = corplib.compute_freqfile (self._user, corp, cattr,
                                             self.wlnums, self.get_url())
@@ -1429,6 +1503,29 @@ class ConcCGI (UserCGI):
         "display a full reference"
         return self.call_function (conclib.get_full_ref, (self._corp(), pos))
 
+    _batchctx_max_hits = 10000
+    def batchctx (self, pos=[], fromline=0, toline=0, context='wide',
+                  struct='doc', fullrefs=0):
+        """detail contexts (context: wide, struct or empty) and/or full
+        references of many hits: positions pos (of length hitlen) or lines
+        fromline..toline of the concordance"""
+        if toline > fromline:
+            self.process_concordance_query()
+            conc = self.call_function(conclib.get_conc, (self._corp(),),
+                                      asyn=0)
+            toline = min(toline, conc.size())
+            hits = [(conc.beg_at(i), conc.end_at(i) - conc.beg_at(i))
+                    for i in range(fromline, toline)]
+        else:
+            hits = [(int(p), self.hitlen or 1) for p in pos]
+        if len(hits) > self._batchctx_max_hits:
+            raise RuntimeError('You are allowed to request at most %d hits.'
+                               % self._batchctx_max_hits)
+        if context not in ('wide', 'struct', ''):
+            raise RuntimeError('Unknown context: %s' % context)
+        return {'Hits': self.call_function(conclib.get_detail_batch,
+                                           (self._corp(), hits))}
+
     def freq_distrib(self, fcrit='', flimit=0, res=100, ampl=101, format='', normalize=1):
         "get data for frequency distribution graph"
         self.process_concordance_query()
@@ -1842,7 +1939,9 @@ class ConcCGI (UserCGI):
 
     subcnorm = 'freq'
 
-    def texttypes_with_norms(self, subcorpattrs='', list_all=False, ret_nums=True):
+    def texttypes_with_norms(self, subcorpattrs='', list_all=False, ret_nums=True,
+                             ttfrom=0, ttmaxitems=0):
+        import ttindex
         corp = self._corp()
         if not os.path.exists(os.path.join(corp.get_conf('PATH'), 'sizes')):
             # corpus not compiled
@@ -1852,14 +1951,14 @@ class ConcCGI (UserCGI):
                                or corp.get_conf ('FULLREF')
         if not subcorpattrs or subcorpattrs == '#':
             return {'Normslist': [], 'Blocks': []}
-        tt = corplib.texttype_values(corp, subcorpattrs, list_all, self.hidenone)
+        tt = corplib.texttype_values(corp, subcorpattrs, list_all, self.hidenone,
+                                     ttfrom, ttmaxitems)
         if not ret_nums: return {'Blocks': tt, 'Normslist': []}
         basestructname = subcorpattrs.split('.')[0]
         struct = corp.get_struct (basestructname)
-        normvals = {}
         if self.subcnorm not in ('freq', 'tokens'):
             try:
-                nas = struct.get_attr (self.subcnorm).pos2str
+                struct.get_attr (self.subcnorm)
             except conclib.manatee.AttrNotFound as e:
                 self.error = str(e)
                 self.subcnorm = 'freq'
@@ -1870,29 +1969,20 @@ class ConcCGI (UserCGI):
                 if not col['name'].startswith(basestructname + '.'): # new structure
                     basestructname = col['name'].split('.')[0]
                     struct = corp.get_struct (basestructname)
-                    normvals = {}
                     if self.subcnorm not in ('freq', 'tokens'):
                         try:
-                            nas = struct.get_attr (self.subcnorm).pos2str
+                            struct.get_attr (self.subcnorm)
                         except conclib.manatee.AttrNotFound as e:
                             self.error = str(e)
                             self.subcnorm = 'freq'
-                attr = struct.get_attr(col['name'].split('.')[-1])
-                p2i = attr.pos2id
-                xcnt_dict = dict([(i, 0) for i in range(attr.id_range())])
-                if self.subcnorm == 'freq':
-                    for vid in range(attr.id_range()):
-                        xcnt_dict[vid] = attr.freq(vid)
-                elif self.subcnorm == 'tokens':
-                    for sid in range(struct.size()):
-                        vid = p2i(sid)
-                        xcnt_dict[vid] += struct.end(sid) - struct.beg(sid)
-                else:
-                    for vid in range(attr.id_range()):
-                        xcnt_dict[vid] = attr.norm(vid)
                 if not col.get('hierarchical', ''):
-                    for val in col['Values']:
-                        val['xcnt'] = xcnt_dict.get(attr.str2id(str(val['v'])), 0)
+                    table = ttindex.get_table(corp, col['name'],
+                                              self.cm.ttindex_dir)
+                    counts = table.counts(self.subcnorm in ('freq', 'tokens')
+                                          and self.subcnorm or 'norm')
+                    ids = table.ids(self.hidenone, ttfrom, ttmaxitems)
+                    for val, vid in zip(col['Values'], ids):
+                        val['xcnt'] = counts[vid]
         return {'Blocks': tt, 'Normslist': self.get_normslist(basestructname)}
 
     def get_normslist(self, structname):
@@ -1947,6 +2037,7 @@ class ConcCGI (UserCGI):
         if delete:
             base = os.path.join (self.subcpath[-1], self.corpname,
                                  self.urlencode(subcname))
+            self.cm.unregister_subcorp_file (self.corpname, base + '.subc')
             for e in glob.glob(base + '.*'):
                 if os.path.isfile(e):
                     os.unlink(e)
@@ -1978,6 +2069,8 @@ class ConcCGI (UserCGI):
             s = self._curr_corpus.get_struct(struct)
             cs = conclib.manatee.create_subcorpus (path, conc.RS(), s)
             if cs:
+                corplib.save_subchash(path)
+                self.cm.register_subcorp_file (basecorpname, path)
                 corplib.save_subcdef(path, subcname,
                                 struct or '--NONE--', 'Q:' + '\v'.join(self.q))
                 return {'subcorp': subcname, 'message': "Subcorpus saved."}
@@ -1990,6 +2083,7 @@ class ConcCGI (UserCGI):
             if conclib.manatee.create_subcorpus(path, self._curr_corpus,
                     structname, subquery):
                 subcdeff = None
+                corplib.save_subchash(path)
                 if instantSubCorp:
                     existing_path = self.cm.find_same_subcorp_file(basecorpname, path, "###INSTANT###", None, None, self.urlencode("###") + "*" + self.urlencode("###"))
                     if existing_path:
@@ -1997,7 +2091,9 @@ class ConcCGI (UserCGI):
                         subcname = unquote_plus(os.path.splitext(os.path.basename(existing_path))[0])
                         subcdeff = existing_path + "def"
                         os.unlink(path)
+                        os.unlink(path + "hash")
                 if not subcdeff: # save subc def file if necessary
+                    self.cm.register_subcorp_file (basecorpname, path)
                     subcdeff = path + "def"
                     if not os.path.isfile(subcdeff):
                         subcdeff = corplib.save_subcdef(path,
@@ -2024,12 +2120,12 @@ class ConcCGI (UserCGI):
         subcp = os.path.join(self.subcpath[-1], self.corpname,
                 qsubcname + '.subcdef')
         subcn, subcs, subcq = corplib.parse_subcdef(subcname, subcp)
+        self.cm.unregister_subcorp_file (self.corpname, subcp[:-3])
         for e in glob.glob(subcp.replace('.subcdef', '.*')):
             if os.path.isfile(e) and not e.endswith('.subcdef'):
                 os.unlink(e)
         if all([subcn, subcs, subcq]):
             subcs = subcs.replace('--NONE--', '')
-            self._curr_corpus.spath = subcp[:-3]
             if subcq.startswith('Q:'):
                 self.q = subcq[2:].split('\v')
                 return self.subcorp(subcname, False, True, subcq[2:], subcs, '')
@@ -2068,11 +2164,13 @@ class ConcCGI (UserCGI):
         self.set_user_options(options={'subcorp_id2name': current_names}, corpus=self.corpname)
         return {'status': 'OK', 'corpus': self.corpname, 'subcorp_id2name': current_names}
 
-    def attr_vals(self, avattr='', avpat='.*', avmaxitems=20, avfrom=0, icase=1):
+    def attr_vals(self, avattr='', avpat='.*', avmaxitems=20, avfrom=0, icase=1,
+                  avcursor=''):
         if not avattr:
             return {'error': 'Parameter avattr is required'}
         return corplib.attr_vals(self.abs_corpname(self.corpname), avattr,
-                avpat, avmaxitems, avfrom, icase)
+                avpat, avmaxitems, avfrom, icase, avcursor,
+                os.path.join(self._cache_dir, '.avindex'))
 
     def annot_download(self):
         "get list of all queries and labels"
@@ -2238,6 +2336,8 @@ class ConcCGI (UserCGI):
         return out
 
 
+    _fcs_result_set_ttl = conclib.FCS_RESULT_SET_TTL
+    _fcs_result_set_ttl_max = 3600
     def fcs(self, operation='explain', version='', recordPacking='xml',
             extraRequestData='', query='', startRecord='', responsePosition='',
             recordSchema='', maximumRecords='', scanClause='', maximumTerms='',
@@ -2374,9 +2474,18 @@ class ConcCGI (UserCGI):
                     if corpname in self.corplist:
                         self._curr_corpus = None
                         self.corpname = corpname
-                out['result'] = conclib.fcs_search(self._corp(), query,
-                        maximumRecords_, startRecord_ -1)
-                out['numberOfRecords'] = len(out['result'])
+                ttl = self._fcs_result_set_ttl
+                if getattr(self, 'resultSetTTL', ''):
+                    try:
+                        ttl = min(int(self.resultSetTTL),
+                                  self._fcs_result_set_ttl_max)
+                    except ValueError:
+                        fcs_err = Exception(6, 'resultSetTTL',
+                                            'Unsupported parameter value')
+                out['result'], out['numberOfRecords'] = self.call_function(
+                        conclib.fcs_search, (self._corp(), query,
+                        maximumRecords_, startRecord_ -1), ttl=ttl)
+                out['resultSetTTL'] = ttl
 
             # unsupported operation
             else:
@@ -2619,7 +2728,8 @@ class ConcCGI (UserCGI):
         else:
             return {'error': 'Empty bilingual dictionary'}
 
-    def biterms(self, corpname='', l2_corpname='', limit=100, alnum=0, onealpha=1, wlpat='.*', examples_no=0):
+    def biterms(self, corpname='', l2_corpname='', limit=100, alnum=0, onealpha=1, wlpat='.*', examples_no=0,
+                bfrom=0):
 
         note = ''
         if limit > self._keyword_max_size:
@@ -2628,24 +2738,22 @@ class ConcCGI (UserCGI):
 
         corp_locale = self._corp().get_conf('DEFAULTLOCALE')
         corp_encoding = self._corp().get_conf('ENCODING')
-        def can_return(word_1, word_2, filters):
-            for f in filters:
-                pattern = regexp_pattern(f, corp_locale, corp_encoding)
-                if not bool(pattern.match(word_1) and pattern.match(word_2)):
-                    return False
-            return True
 
         filters = [wlpat]
         if alnum:
             filters.append(self.re_alnum_terms)
         if onealpha:
             filters.append(self.re_onealpha)
+        patterns = [regexp_pattern(f, corp_locale, corp_encoding) for f in filters]
 
         try:
-            bitgen = corplib.get_biterms(
+            bitlist = corplib.get_biterms(
                 self._corp(),
                 l2_corp=self.cm.get_Corpus(l2_corpname),
                 limit=limit,
+                start=bfrom,
+                patterns=patterns,
+                index_dir=os.path.join(self._cache_dir, '.biterms'),
             )
         except Exception as e:
             return {
@@ -2654,17 +2762,17 @@ class ConcCGI (UserCGI):
             }
         lexicon_list = []
         lexicon_dict = defaultdict(list)
-        for b in bitgen:
-            if can_return(b[0], b[1], filters):
-                if b[0] not in lexicon_dict:
-                    lexicon_list.append(b[0])
-                lexicon_dict[b[0]].append(b)
+        for b in bitlist:
+            if b[0] not in lexicon_dict:
+                lexicon_list.append(b[0])
+            lexicon_dict[b[0]].append(b)
 
         return {
             "aligned_corpname": l2_corpname,
             "Biterms": lexicon_list,
             "BitermsDict": lexicon_dict,
             "limit": limit,
+            "bfrom": bfrom,
             "note": note,
         }
 
@@ -2800,10 +2908,13 @@ class ConcCGI (UserCGI):
                 dif = pickle.load(file_dif)
         except FileNotFoundError:
             # Check if corpnames are valid and attribute exist in both corpora
-            manatee.Corpus(corpname).get_attr(attr)
-            manatee.Corpus(corpname2).get_attr(attr)
+            c1 = manatee.Corpus(corpname)
+            c2 = manatee.Corpus(corpname2)
+            c1.get_attr(attr)
+            c2.get_attr(attr)
 
-            return corplib.run_bgjob(self._user, self._corp(), "compare_only.py -c1 %s -c2 %s -a1 %s -a2 %s" % (corpname, corpname2, attr, attr2), "[IGNORE THIS] Attr %s and %s compare on %s and %s" % (attr, attr2, corpname, corpname2), self.get_url())
+            return corplib.run_bgjob(self._user, self._corp(), "compare_only.py -c1 %s -c2 %s -a1 %s -a2 %s" % (corpname, corpname2, attr, attr2), "[IGNORE THIS] Attr %s and %s compare on %s and %s" % (attr, attr2, corpname, corpname2), self.get_url(), batch=True,
+                    extra_files=corplib.corpus_files(c1) + corplib.corpus_files(c2))
 
         dif["order"] = [corpname, corpname2]
         return dif
@@ -2824,7 +2935,8 @@ class ConcCGI (UserCGI):
             if s1.size() != s2.size():
                 raise Exception("Corpora are not aligned.")
 
-            return corplib.run_bgjob(self._user, self._corp(), "compare_token.py -c1 %s -c2 %s" % (corpname, corpname2), "[IGNORE THIS] Token compare on %s and %s" % (corpname, corpname2), self.get_url())
+            return corplib.run_bgjob(self._user, self._corp(), "compare_token.py -c1 %s -c2 %s" % (corpname, corpname2), "[IGNORE THIS] Token compare on %s and %s" % (corpname, corpname2), self.get_url(), batch=True,
+                    extra_files=corplib.corpus_files(c1) + corplib.corpus_files(c2))
         except Exception as e:
             return str(e)
         return {"order": [corpname, corpname2], "result": dif_token}
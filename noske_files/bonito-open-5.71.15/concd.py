@@ -0,0 +1,395 @@
+#!/usr/bin/python3
+# Shared concordance computation daemon
+#
+# Concordances which are saved in the concordance cache are computed by one
+# daemon per Bonito instance instead of a forked process (with its own HTTP
+# server on an ephemeral port) per query. Bonito processes connect to a local
+# Unix socket (started on first use, see start_daemon) and send one JSON line
+# per connection:
+#
+#   {"cmd": "conc", "corpus": <registry file>, "spath": <subcorpus file>,
+#    "complement": .., "conc_dir": .., "cache_dir": <cache dir of corpus>,
+#    "subchash": <hex or null>, "q": [<first query>], "samplesize": .., "fullsize": ..,
+#    "minsize": .., "create": ..}
+#       computes the concordance (or joins the computation of the same
+#       (cache_dir, subchash, q)), waits until it has minsize lines (-1: is
+#       finished) and replies with a JSON line, {"cachefile": ..} if it is
+#       finished and saved, otherwise {"id": ..} followed by the concordance
+#       data (as concsrv sent it); with "create": false it only joins a
+#       running computation, {"unknown": true} otherwise
+#   {"cmd": "sizes", ...}
+#       {"finished": .., "concsize": .., "fullsize": ..} of a running
+#       computation, {"unknown": true} otherwise
+#
+# At most pool_size computations run at a time, others wait for a free
+# worker. Results are registered in the concordance cache map (-1 while
+# being computed) and saved to the cache files as before. Every
+# EVICT_INTERVAL seconds the concordances under the "cache_root" of the
+# requests are evicted down to their "cache_quota" (bytes, see
+# conccache.evict_cache).
+
+import os, sys, json, time, socket, fcntl
+from subprocess import Popen, PIPE, DEVNULL
+
+IDLE_TIMEOUT = 3600 # seconds without requests and computations until exit
+MAX_POLL = 0.5 # seconds between checks of a running computation
+EVICT_INTERVAL = 300 # seconds between cache evictions
+
+
+def _read_line (sock):
+    "one line from sock, read byte by byte so that no data after it is lost"
+    line = bytearray()
+    while True:
+        c = sock.recv(1)
+        if not c or c == b'\n':
+            return bytes(line)
+        line += c
+
+
+def _connect (socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def start_daemon (socket_path, pool_size=0):
+    "starts the daemon unless it is running already"
+    with open(socket_path + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            _connect(socket_path).close()
+            return # started by another process meanwhile
+        except OSError:
+            pass
+        proc = Popen([sys.executable, os.path.abspath(__file__), '--socket',
+                      socket_path, '--pool-size', str(pool_size)],
+                     stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL,
+                     start_new_session=True)
+        # wait for "STARTED" confirming the daemon listens on the socket
+        line = proc.stdout.readline()
+        proc.stdout.close()
+        proc.wait()
+        if not line.startswith(b'STARTED'):
+            raise RuntimeError('Failed to start concordance daemon at %s'
+                               % socket_path)
+
+
+def _request (socket_path, request, autostart=True):
+    "returns socket and reply header, None if the daemon is not running"
+    try:
+        sock = _connect(socket_path)
+    except OSError:
+        if not autostart:
+            return None, None
+        start_daemon(socket_path)
+        sock = _connect(socket_path)
+    sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+    reply = _read_line(sock)
+    if not reply:
+        sock.close()
+        raise RuntimeError('Concordance daemon failed')
+    return sock, json.loads(reply)
+
+
+def _conc_request (corp, subchash, q, cache_dir, **kwargs):
+    if isinstance(subchash, bytes): # see corplib.get_subchash
+        subchash = subchash.hex()
+    request = {'corpus': corp.get_confpath(), 'spath': getattr(corp, 'spath', ''),
+               'complement': getattr(corp, 'complement', False),
+               'conc_dir': getattr(corp, '_conc_dir', ''),
+               'cache_dir': cache_dir, 'subchash': subchash, 'q': list(q[:1])}
+    request.update(kwargs)
+    return request
+
+
+def get_conc (socket_path, corp, subchash, q, cache_dir, samplesize=0,
+              fullsize=-1, minsize=-1, create=True, cache_root='',
+              cache_quota=0):
+    """PyConc of the first query of q computed by the daemon, as soon as it
+    has minsize lines (-1: is finished); with create false None unless the
+    computation is running"""
+    from pyconc import PyConc
+    sock, reply = _request(socket_path, _conc_request(corp, subchash, q,
+            cache_dir, cmd='conc', samplesize=samplesize, fullsize=fullsize,
+            minsize=minsize, create=create, cache_root=cache_root,
+            cache_quota=cache_quota), autostart=create)
+    if not sock:
+        return None
+    try:
+        if reply.get('unknown'):
+            return None
+        if 'error' in reply:
+            raise Exception(reply['error'])
+        if 'cachefile' in reply:
+            return PyConc(corp, 'l', reply['cachefile'])
+        sock.setblocking(True)
+        conc = PyConc(corp, 'l', sock.fileno())
+        conc.port = reply['id'] # non-zero while being computed
+        return conc
+    finally:
+        sock.close()
+
+
+def get_conc_sizes (socket_path, corp, q, cache_dir):
+    "(finished, concsize, fullsize) of a running computation, None otherwise"
+    try:
+        sock, reply = _request(socket_path, _conc_request(corp,
+                getattr(corp, 'subchash', None), q, cache_dir, cmd='sizes'),
+                autostart=False)
+    except (OSError, RuntimeError, ValueError):
+        return None
+    if not sock:
+        return None
+    sock.close()
+    if reply.get('unknown'):
+        return None
+    return reply['finished'], reply['concsize'], reply['fullsize']
+
+
+class _Job:
+    def __init__ (self, id, key, request):
+        import threading
+        self.id = id
+        self.key = key
+        self.request = request
+        self.conc = None
+        self.cachefile = None
+        self.error = None
+        self.lock = threading.Lock() # serialises access to conc
+        self.done = threading.Event()
+
+    def wait (self, minsize=-1):
+        "until the concordance has minsize lines (-1: is finished) or failed"
+        delay = 0.01
+        while not self.done.is_set():
+            if self.conc is not None:
+                with self.lock:
+                    if self.conc.finished() or \
+                            (minsize != -1 and self.conc.size() >= minsize):
+                        return
+            time.sleep(delay)
+            delay = min(2 * delay, MAX_POLL)
+
+
+class ConcDaemon:
+    def __init__ (self, pool_size=0):
+        import threading
+        if not pool_size:
+            try:
+                pool_size = len(os.sched_getaffinity(0))
+            except AttributeError:
+                pool_size = os.cpu_count() or 1
+        self.pool_size = pool_size
+        self.workers = threading.BoundedSemaphore(pool_size)
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.last_id = 0
+        self.last_request = time.time()
+        self.quotas = {} # cache root: byte budget
+
+    def job (self, request, create=True):
+        "running job of request, started if create is true"
+        import threading
+        subchash = request['subchash'] and bytes.fromhex(request['subchash'])
+        key = (request['cache_dir'], subchash or None, tuple(request['q']))
+        with self.lock:
+            self.last_request = time.time()
+            job = self.jobs.get(key)
+            if job or not create:
+                return job
+            self.last_id += 1
+            job = self.jobs[key] = _Job(self.last_id, key, request)
+        threading.Thread(target=self._run, args=(job,), daemon=True).start()
+        return job
+
+    def _corpus (self, request):
+        import manatee, corplib
+        with self.lock:
+            corp = corplib.open_corpus(request['corpus'])
+            manatee.setEncoding(corp.get_conf('ENCODING'))
+            if request['spath']:
+                key = (request['corpus'], request['spath'],
+                       request['complement'])
+                subc = corplib.corpus_pool.get(key)
+                if subc is None:
+                    subc = manatee.SubCorpus(corp, request['spath'],
+                                             request['complement'])
+                    subc.corp = corp
+                    corplib.corpus_pool.put(key, subc,
+                            corplib.corpus_files(corp) + [request['spath']])
+                corp = subc
+            corp = corplib.CorpusView(corp)
+            corp._conc_dir = request['conc_dir']
+        return corp
+
+    def _run (self, job):
+        from conccache import add_to_map, del_from_map, get_from_map
+        from conclib import compute_conc
+        from pyconc import PyConc
+        cache_dir, subchash, q = job.key
+        request = job.request
+        try:
+            corp = self._corpus(request)
+            fullsize = request.get('fullsize', -1)
+            if q[0][0] == "R" and fullsize == -1: # online sample
+                # original concordance first, outside of the worker pool
+                base = self.job(dict(request, q=[q[0][1:]], fullsize=-1))
+                base.wait()
+                if base.error:
+                    raise RuntimeError(base.error)
+                fullsize = base.conc.fullsize()
+            os.makedirs(cache_dir, exist_ok=True)
+            with self.workers:
+                started = time.time()
+                cached = get_from_map(cache_dir, subchash, q)
+                cachefile = add_to_map(cache_dir, subchash, q, -1)[0]
+                if cached and cached[1] != -1 and os.path.exists(cachefile):
+                    conc = PyConc(corp, 'l', cachefile) # computed meanwhile
+                else:
+                    conc = compute_conc(corp, q, request.get('samplesize', 0),
+                                        fullsize)
+                job.conc = conc
+                delay = 0.01
+                while True:
+                    with job.lock:
+                        if conc.finished():
+                            conc.save(cachefile)
+                            break
+                    time.sleep(delay)
+                    delay = min(2 * delay, MAX_POLL)
+            add_to_map(cache_dir, subchash, q, conc.size(),
+                       time.time() - started) # update size
+            job.cachefile = cachefile
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            job.error = str(e) or e.__class__.__name__
+            del_from_map(cache_dir, subchash, q)
+        finally:
+            job.done.set()
+            with self.lock:
+                del self.jobs[job.key]
+
+    def serve_conc (self, sock, request):
+        if request.get('cache_root') and request.get('cache_quota'):
+            with self.lock:
+                self.quotas[request['cache_root']] = request['cache_quota']
+        job = self.job(request, request.get('create', True))
+        if not job:
+            return self._reply(sock, {'unknown': True})
+        job.wait(request.get('minsize', -1))
+        if job.error:
+            return self._reply(sock, {'error': job.error})
+        if job.cachefile:
+            return self._reply(sock, {'cachefile': job.cachefile})
+        self._reply(sock, {'id': job.id})
+        with job.lock:
+            job.conc.save(sock.fileno(), False, True) # partial
+
+    def serve_sizes (self, sock, request):
+        job = self.job(request, False)
+        if not job or job.conc is None:
+            return self._reply(sock, {'unknown': True})
+        with job.lock:
+            self._reply(sock, {'finished': int(job.conc.finished()),
+                               'concsize': job.conc.size(),
+                               'fullsize': job.conc.fullsize()})
+
+    @staticmethod
+    def _reply (sock, reply):
+        sock.sendall(json.dumps(reply).encode('utf-8') + b'\n')
+
+    def evict (self):
+        from conccache import evict_cache
+        with self.lock:
+            quotas = list(self.quotas.items())
+        for cache_root, quota in quotas:
+            try:
+                used, freed = evict_cache(cache_root, quota)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                continue
+            if freed:
+                sys.stderr.write('[%s] %s: %d MB used, %d MB evicted\n'
+                                 % (time.strftime('%Y-%m-%d %H:%M:%S'),
+                                    cache_root, used // 1048576,
+                                    freed // 1048576))
+
+    def idle (self, timeout=IDLE_TIMEOUT):
+        with self.lock:
+            return not self.jobs and time.time() - self.last_request > timeout
+
+
+def serve (socket_path, pool_size=0, idle_timeout=IDLE_TIMEOUT):
+    "binds socket_path, reports STARTED on stdout, detaches and serves"
+    import socketserver, threading
+    from butils import set_proctitle
+    daemon = ConcDaemon(pool_size)
+
+    class Handler (socketserver.StreamRequestHandler):
+        def handle (self):
+            try:
+                request = json.loads(self.rfile.readline())
+            except ValueError:
+                return
+            if request.get('cmd') == 'conc':
+                daemon.serve_conc(self.connection, request)
+            elif request.get('cmd') == 'sizes':
+                daemon.serve_sizes(self.connection, request)
+
+    class Server (socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+    try:
+        os.unlink(socket_path) # stale socket, start_daemon holds the lock
+    except OSError:
+        pass
+    server = Server(socket_path, Handler)
+    os.chmod(socket_path, 0o660)
+    if os.fork():
+        sys.stdout.write('STARTED\n')
+        sys.stdout.flush()
+        os._exit(0)
+    set_proctitle('concd;%s;' % socket_path)
+    log = open(socket_path + '.log', 'a', 1)
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    sys.stderr.write('[%s] started, %d workers\n'
+                     % (time.strftime('%Y-%m-%d %H:%M:%S'), daemon.pool_size))
+
+    def watchdog ():
+        last_evict = time.time()
+        while not daemon.idle(idle_timeout):
+            time.sleep(60)
+            if time.time() - last_evict > EVICT_INTERVAL:
+                daemon.evict()
+                last_evict = time.time()
+        server.shutdown()
+    threading.Thread(target=watchdog, daemon=True).start()
+    server.serve_forever()
+    try:
+        if os.stat(socket_path).st_ino == os.fstat(server.fileno()).st_ino:
+            os.unlink(socket_path)
+    except OSError:
+        pass
+
+
+def main ():
+    import argparse
+    parser = argparse.ArgumentParser(description='Bonito concordance daemon')
+    parser.add_argument('--socket', required=True, help='Unix socket path')
+    parser.add_argument('--pool-size', type=int, default=0,
+                        help='concurrent computations (default: cores)')
+    parser.add_argument('--idle-timeout', type=int, default=IDLE_TIMEOUT,
+                        help='exit after idle seconds (default: %(default)s)')
+    args = parser.parse_args()
+    serve(args.socket, args.pool_size, args.idle_timeout)
+
+
+if __name__ == '__main__':
+    main()
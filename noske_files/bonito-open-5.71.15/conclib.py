@@ -3,10 +3,10 @@
 #                          Milos Husak, Vit Baisa
 
 import manatee
-import os, re, sys
-from butils import set_proctitle
-from conccache import add_to_map, del_from_map, load_map, get_cached_conc,\
-                      get_existing_conc, get_existing_conc_sizes
+import os, re, sys, time
+import concd
+from conccache import add_to_map, get_from_map, get_cached_conc,\
+                      get_existing_conc_sizes, keep_in_map
 from pyconc import PyConc
 
 def tokens2strclass (tokens):
@@ -14,6 +14,29 @@ def tokens2strclass (tokens):
             for i in range(0, len(tokens), 2)]
 
 
+def tokens2columns (tokens, classes, split=False):
+    """KWICLines token stream (string, class, string, class, ...) as
+    parallel lists of strings, attribute values and class codes (indexes
+    into the list of distinct classes, collected in classes {class: code});
+    attribute values (class attr) belong to the preceding string, with
+    split each whitespace separated token gets its own entry (whitespace
+    only strings none, as in reformat_conc_line)"""
+    strs, attrs, codes = [], [], []
+    for i in range(0, len(tokens), 2):
+        string, cls = tokens[i], tokens[i+1].strip ('{}')
+        if cls == 'attr' and strs:
+            attrs[-1] = string
+            continue
+        code = classes.get(cls)
+        if code is None:
+            code = classes[cls] = len(classes)
+        for part in string.split() if split else [string]:
+            strs.append(part)
+            attrs.append('')
+            codes.append(code)
+    return {'str': strs, 'attr': attrs, 'cls': codes}
+
+
 def printkwic (conc, froml=0, tol=5, leftctx='15#', rightctx='15#',
                attrs='word', refs='#', maxcontext=0):
     def strip_tags (tokens):
@@ -41,7 +64,8 @@ def pos_ctxs (min_hitlen, max_hitlen, max_ctx=3):
 def kwicpage (conc, fromp=1, leftctx='40#', rightctx='40#', attrs='word',
               ctxattrs='word', refs='#', structs='p', pagesize=20,
               labelmap={}, righttoleft=False, alignlist=[],
-              tbl_template='none', hidenone=0, viewmode='kwic', reflinks=[]):
+              tbl_template='none', hidenone=0, viewmode='kwic', reflinks=[],
+              kwic_format=''):
     try:
         fromp = int(fromp)
         if fromp < 1:
@@ -53,15 +77,19 @@ def kwicpage (conc, fromp=1, leftctx='40#', rightctx='40#', attrs='word',
     if not conc.orig_corp.get_conffile() in corps_with_colls:
         kwcl = kwiclines (conc, (fromp -1) * pagesize, fromp * pagesize,
                           '0', '0', 'word', '', refs, structs,
-                          labelmap, righttoleft, viewmode, reflinks)
+                          labelmap, righttoleft, viewmode, reflinks,
+                          kwic_format)
     else:
         kwcl = kwiclines (conc, (fromp -1) * pagesize, fromp * pagesize,
                           leftctx, rightctx, attrs, ctxattrs, refs, structs,
-                          labelmap, righttoleft, viewmode, reflinks)
+                          labelmap, righttoleft, viewmode, reflinks,
+                          kwic_format)
     out = {'Lines': kwcl}
+    if kwic_format:
+        out['kwic_format'] = kwic_format
     add_aligns(out, conc,(fromp -1) * pagesize, fromp * pagesize,
                leftctx, rightctx, attrs, ctxattrs, refs, structs,
-               labelmap, righttoleft, alignlist)
+               labelmap, righttoleft, alignlist, kwic_format)
     if tbl_template != 'none':
         try:
             from tbl_settings import tbl_refs, tbl_structs
@@ -84,49 +112,154 @@ def kwicpage (conc, fromp=1, leftctx='40#', rightctx='40#', attrs='word',
     if hidenone:
         for line in out['Lines']:
             for part in ('Kwic', 'Left', 'Right'):
+                if kwic_format == 'columnar':
+                    line[part]['str'] = [x.replace('===NONE===', '')
+                                         for x in line[part]['str']]
+                    continue
                 for item in line[part]:
                     item['str'] = item['str'].replace('===NONE===', '')
     return out
 
+ALIGN_WORKERS = 0 # aligned corpora rendered at a time, 0: number of cores
+
+def fork_map (func, items, workers=0):
+    """[func(item) for item in items], each computed in a forked process
+    (a copy of all state, e.g. of a concordance), at most workers (0: number
+    of cores) at a time; results are pickled back, exceptions re-raised"""
+    import pickle, traceback
+    workers = workers or os.cpu_count() or 1
+    results = []
+    running = []
+    def reap ():
+        pid, r = running.pop(0)
+        with os.fdopen(r, 'rb') as f:
+            data = f.read()
+        os.waitpid(pid, 0)
+        if not data:
+            raise RuntimeError('Worker process failed')
+        ok, value = pickle.loads(data)
+        if not ok:
+            raise Exception(value)
+        results.append(value)
+    try:
+        for item in items:
+            if len(running) >= workers:
+                reap()
+            r, w = os.pipe()
+            pid = os.fork()
+            if pid == 0: # child
+                os.close(r)
+                try:
+                    data = pickle.dumps((True, func(item)),
+                                        pickle.HIGHEST_PROTOCOL)
+                except Exception as e:
+                    data = pickle.dumps((False, str(e) or
+                                                traceback.format_exc()))
+                with os.fdopen(w, 'wb') as f:
+                    f.write(data)
+                os._exit(0)
+            os.close(w)
+            running.append((pid, r))
+        while running:
+            reap()
+    finally: # after a failure
+        for pid, r in running:
+            os.close(r)
+            os.waitpid(pid, 0)
+    return results
+
 def add_aligns(result, conc, fromline, toline, leftctx='40#', rightctx='40#',
                attrs='word', ctxattrs='word', refs='#', structs='p',
-               labelmap={}, righttoleft=False, alignlist=[]):
+               labelmap={}, righttoleft=False, alignlist=[], kwic_format=''):
     if not alignlist: return
     al_lctx = leftctx.endswith('#') and '0' or leftctx
     al_rctx = rightctx.endswith('#') and '0' or rightctx
-    al_lines = []
     corps_with_colls = manatee.StrVector()
     conc.get_aligned(corps_with_colls)
-    for al_corp in alignlist:
+    corps_with_colls = list(corps_with_colls)
+    def aligned_lines (al_corp):
         al_corpname = al_corp.get_conffile()
         if al_corpname in corps_with_colls:
             conc.switch_aligned (al_corp.get_conffile())
-            al_lines.append (kwiclines (conc, fromline, toline, leftctx,
-                                        rightctx, attrs, ctxattrs, refs,
-                                        structs, labelmap,
-                                        al_corp.get_conf('RIGHTTOLEFT') == '1'))
-        else:
-            conc.switch_aligned(conc.orig_corp.get_conffile())
-            conc.add_aligned(al_corp.get_conffile())
-            conc.switch_aligned (al_corp.get_conffile())
-            al_lines.append (kwiclines (conc, fromline, toline, al_lctx,
-                                        al_rctx, attrs, '', refs, structs,
-                                        labelmap,
-                                        al_corp.get_conf('RIGHTTOLEFT') == '1'))
-            for al_line in al_lines[-1]:
-                al_line['has_no_kwic'] = True
+            return kwiclines (conc, fromline, toline, leftctx, rightctx,
+                              attrs, ctxattrs, refs, structs, labelmap,
+                              al_corp.get_conf('RIGHTTOLEFT') == '1',
+                              kwic_format=kwic_format)
+        conc.switch_aligned(conc.orig_corp.get_conffile())
+        conc.add_aligned(al_corp.get_conffile())
+        conc.switch_aligned (al_corp.get_conffile())
+        lines = kwiclines (conc, fromline, toline, al_lctx, al_rctx, attrs,
+                           '', refs, structs, labelmap,
+                           al_corp.get_conf('RIGHTTOLEFT') == '1',
+                           kwic_format=kwic_format)
+        for al_line in lines:
+            al_line['has_no_kwic'] = True
+        return lines
+    if len(alignlist) > 1 and ALIGN_WORKERS != 1 and conc.finished():
+        # each aligned corpus in its own process and copy of conc
+        # (forking while conc is computed would leave the copy without
+        # its computing thread)
+        al_lines = fork_map(aligned_lines, alignlist, ALIGN_WORKERS)
+    else:
+        curr_corpname = conc.corp().get_conffile()
+        al_lines = [aligned_lines(al_corp) for al_corp in alignlist]
+        conc.switch_aligned(curr_corpname)
     aligns = list(zip(*al_lines))
     for i, line in enumerate(result['Lines']):
         line['Align'] = aligns[i]
 
+_ref_tables = {} # registry file: (modification time, table)
+
+def get_ref_table (corp):
+    """reference settings of corp, read once per version of its registry file:
+    'refs' the default references (SHORTREF, DOCSTRUCTURE.urldomain or #),
+    'reflinks' {structattr: (URLTEMPLATE, MEDIATYPE, INFO)} of the structure
+    attributes with an URLTEMPLATE, in the STRUCTATTRLIST order"""
+    path = corp.get_confpath()
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        mtime = None
+    entry = _ref_tables.get(path)
+    if entry and entry[0] == mtime:
+        return entry[1]
+    sal = corp.get_conf('STRUCTATTRLIST').split(',')
+    docs = corp.get_conf('DOCSTRUCTURE')
+    if corp.get_conf('SHORTREF'):
+        refs = corp.get_conf('SHORTREF')
+    elif docs + '.urldomain' in sal:
+        refs = '=' + docs + '.urldomain'
+    else:
+        refs = '#'
+    reflinks = {}
+    for sa in sal:
+        if sa and corp.get_conf(sa + '.URLTEMPLATE'):
+            reflinks[sa] = (corp.get_conf(sa + '.URLTEMPLATE'),
+                            corp.get_conf(sa + '.MEDIATYPE'),
+                            corp.get_conf(sa + '.INFO') or None)
+    table = {'refs': refs, 'reflinks': reflinks}
+    _ref_tables[path] = (mtime, table)
+    return table
+
 def kwiclines (conc, fromline, toline, leftctx='40#', rightctx='40#',
                attrs='word', ctxattrs='word', refs='#', structs='p',
-               labelmap={}, righttoleft=False, viewmode='kwic', reflinks=[]):
+               labelmap={}, righttoleft=False, viewmode='kwic', reflinks=[],
+               kwic_format=''):
+    """KWIC lines, Left/Kwic/Right are lists of {'str', 'class'} segments;
+    with kwic_format 'columnar' they are parallel lists instead (see
+    tokens2columns), class codes index the 'Classes' of each line"""
     lines = []
+    columnar = kwic_format == 'columnar'
     # TODO: should be probably refs and refs.count(',') + 1 or 0
     refslen = refs.count(',') + 1
     if len(reflinks):
         refs = refs + ',=' + ',='.join(reflinks)
+        reflink_table = get_ref_table(conc.corp())['reflinks']
+        linkinfo = [reflink_table.get(sa) or
+                    (conc.corp().get_conf(sa + '.URLTEMPLATE'),
+                     conc.corp().get_conf(sa + '.MEDIATYPE'),
+                     conc.corp().get_conf(sa + '.INFO') or None)
+                    for sa in reflinks]
     leftlabel, rightlabel = 'Left', 'Right'
     if righttoleft:
         if viewmode == 'kwic':
@@ -144,9 +277,13 @@ def kwiclines (conc, fromline, toline, leftctx='40#', rightctx='40#',
     while kl.nextline():
         linegroup = kl.get_linegroup() or 0
         linegroup = labelmap.get(linegroup, '_')
-        leftwords = tokens2strclass (kl.get_left())
-        rightwords = tokens2strclass (kl.get_right())
-        kwicwords = tokens2strclass (kl.get_kwic())
+        if columnar and not righttoleft:
+            leftwords, kwicwords, rightwords = \
+                    kl.get_left(), kl.get_kwic(), kl.get_right()
+        else:
+            leftwords = tokens2strclass (kl.get_left())
+            rightwords = tokens2strclass (kl.get_right())
+            kwicwords = tokens2strclass (kl.get_kwic())
         if righttoleft and kwicwords:
             # change order for "English" context of "English" keywords
             if isengword(kwicwords[0]):
@@ -172,32 +309,42 @@ def kwiclines (conc, fromline, toline, leftctx='40#', rightctx='40#',
 
                 leftwords = leftwords + moveright
                 rightwords = moveleft + rightwords
+        if columnar:
+            if righttoleft: # back to the token stream
+                leftwords, kwicwords, rightwords = [
+                        [x for sc in words for x in (sc['str'], sc['class'])]
+                        for words in (leftwords, kwicwords, rightwords)]
+            classes = {}
+            split_ctx = ',' not in ctxattrs
+            leftwords = tokens2columns (leftwords, classes, split_ctx)
+            kwicwords = tokens2columns (kwicwords, classes, ',' not in attrs)
+            rightwords = tokens2columns (rightwords, classes, split_ctx)
 
         reflist = list(kl.get_ref_list())
         links = []
         for i, ref in enumerate(reflist[refslen:]):
             if ref in ('', '===NONE==='):
                 continue
-            link_tmpl = conc.corp().get_conf(reflinks[i] + '.URLTEMPLATE')
-            mtype = conc.corp().get_conf(reflinks[i] + '.MEDIATYPE')
-            info = conc.corp().get_conf(reflinks[i] + '.INFO')
-            struct_attr = reflinks[i]
+            link_tmpl, mtype, info = linkinfo[i]
             links.append({'url': link_tmpl % ref,
                           'mediatype': mtype,
-                          'struct_attr': struct_attr,
-                          'info': info or None
+                          'struct_attr': reflinks[i],
+                          'info': info
                           })
-        lines.append ({'toknum': kl.get_pos(),
-                       'hitlen': kl.get_kwiclen(),
-                       'Refs': reflist[:refslen],
-                       'Tbl_refs': reflist[:refslen],
-                       leftlabel: leftwords,
-                       'Kwic': kwicwords,
-                       rightlabel: rightwords,
-                       'Links': links,
-                       'linegroup': linegroup,
-                       'linegroup_id': kl.get_linegroup() or 0
-                       })
+        line = {'toknum': kl.get_pos(),
+                'hitlen': kl.get_kwiclen(),
+                'Refs': reflist[:refslen],
+                'Tbl_refs': reflist[:refslen],
+                leftlabel: leftwords,
+                'Kwic': kwicwords,
+                rightlabel: rightwords,
+                'Links': links,
+                'linegroup': linegroup,
+                'linegroup_id': kl.get_linegroup() or 0
+                }
+        if columnar:
+            line['Classes'] = sorted(classes, key=classes.get)
+        lines.append (line)
     return lines
 
 
@@ -231,123 +378,48 @@ def get_sort_idx (conc, q=[], pagesize=20, enc='latin1'):
         out = result
     return [{'pos': p, 'label': v} for v, p in out]
 
-def get_conc_sizes (corp, q=[], _cache_dir="cache", server_port=None):
-    return get_existing_conc_sizes (corp, q, _cache_dir, server_port)
+def get_conc_sizes (corp, q=[], _cache_dir="cache", _concd_socket=''):
+    return get_existing_conc_sizes (corp, q, _cache_dir, _concd_socket)
+
+def conc_size_updates (corp, q=[], _cache_dir="cache", _concd_socket='',
+                       interval=0.5, max_interval=5.0):
+    """yields get_conc_sizes whenever the sizes change until the concordance
+    is finished (the last one), polling less often while nothing changes"""
+    last = None
+    wait = interval
+    while True:
+        sizes = get_conc_sizes (corp, q, _cache_dir, _concd_socket)
+        if sizes != last:
+            yield sizes
+            last = sizes
+            wait = interval
+        else:
+            wait = min(2 * wait, max_interval)
+        if sizes['finished']:
+            return
+        time.sleep(wait)
 
-def compute_conc (corp, q, _cache_dir, subchash, samplesize, fullsize, pid_dir,
-                  save):
+def compute_conc (corp, q, samplesize, fullsize):
     q = tuple (q)
     if q[0][0] == "R": # online sample
         if fullsize == -1: # need to compute original conc first
             q_copy = list(q)
             q_copy[0] = q[0][1:]
-            q_copy = tuple(q_copy)
-            conc = get_sync_conc (corp, q_copy, save, _cache_dir, pid_dir,
-                                  subchash, samplesize, fullsize)
+            conc = get_sync_conc (corp, q_copy, samplesize, fullsize)
             fullsize = conc.fullsize()
         return PyConc (corp, q[0][1], q[0][2:], samplesize, fullsize)
     else:
         return PyConc (corp, q[0][0], q[0][1:], samplesize)
 
-def get_sync_conc (corp, q, save, _cache_dir, pid_dir, subchash, samplesize,
-                   fullsize):
-    conc = None
-    if save: # save=0 => processes entirely independent
-        cachefile, pidfile, server = add_to_map (_cache_dir, pid_dir,
-                                                 subchash, q[:1], -1)
-        if type(server) == int: # computation got started meanwhile
-            conc = get_existing_conc (corp, subchash, q[:1], _cache_dir,
-                                      pid_dir, -1, server)
-    if not conc:
-        try:
-            conc = compute_conc (corp, q, _cache_dir, subchash, samplesize,
-                                 fullsize, pid_dir, save)
-            if save:
-                server.timeout = 1
-                server.conc = conc
-                while True:
-                    server.handle_request()
-                    if conc.finished():
-                        conc.save (cachefile)
-                        add_to_map (_cache_dir, pid_dir, subchash, q[:1],
-                                    conc.size()) # update size in map file
-                        os.remove (pidfile.encode("utf-8"))
-                        break
-            else:
-                conc.sync()
-        except:
-            del_from_map (_cache_dir, subchash, q[:1])
-            raise
+def get_sync_conc (corp, q, samplesize, fullsize):
+    "computes the first query of q without saving it to the cache"
+    conc = compute_conc (corp, q, samplesize, fullsize)
+    conc.sync()
     return conc
 
-def get_async_conc (corp, q, save, _cache_dir, pid_dir, subchash, samplesize,
-                    fullsize, minsize):
-    r, w = os.pipe()
-    r, w = os.fdopen(r,'rb'), os.fdopen(w,'wb')
-    if os.fork() == 0: # child
-        r.close() # child writes
-        title = "conc;%s;%s;%s;" % (corp.get_conffile(), q[0][0], q[0][1:])
-        set_proctitle(title)
-        # close stdin/stdout/stderr so that the webserver closes
-        # connection to client when parent ends, comment for debugging
-        os.close(0); os.close(1); os.close(2)
-        try:
-            cachefile, pidfile, server = add_to_map(_cache_dir, pid_dir,
-                                                    subchash, q, -1)
-            if type(server) == int:
-                # conc got started meanwhile by another process
-                w.write (str(server).encode())
-                w.close()
-                os._exit(0)
-            sys.stderr = server.logfile
-            conc = compute_conc (corp, q, _cache_dir, subchash,
-                                 samplesize, fullsize, pid_dir, save)
-            w.write (str(server.server_port).encode())
-            w.close()
-            server.timeout = 5
-            server.conc = conc
-            while True:
-                server.handle_request()
-                if conc.finished():
-                    conc.save (cachefile)
-                    break
-            # update size in map file
-            add_to_map (_cache_dir, pid_dir, subchash, q, conc.size())
-            os.remove (pidfile)
-            os._exit(0)
-        except Exception as e:
-            import traceback, pickle
-            if not w.closed:
-                stack = traceback.format_exception(*sys.exc_info())
-                e = (e, stack)
-                w.write (pickle.dumps(e))
-                w.close()
-            traceback.print_exc (None, open(pidfile, "a"))
-            del_from_map (_cache_dir, subchash, q)
-            os._exit(0)
-    else: # parent
-        w.close() # parent reads
-        server_port = r.read()
-        try:
-            server_port = int (server_port.decode())
-        except ValueError as msg:
-            if not server_port:
-                raise ValueError('Error while computing concordance')
-            else:
-                import pickle
-                e = pickle.loads (server_port)
-                args = ' '.join(e[0].args)
-                if len(args) < 3:
-                    args = args + '\n' + ''.join(e[1])
-                raise Exception(args)
-        r.close()
-        conc = get_existing_conc (corp, subchash, q, _cache_dir, pid_dir,
-                                  minsize, server_port)
-        conc.port = server_port
-        return conc
-
 def get_conc (corp, minsize=None, q=[], fromp=0, pagesize=0, asyn=0, save=0, \
-              _cache_dir='cache', samplesize=0, debug=False):
+              _cache_dir='cache', samplesize=0, debug=False, _concd_socket='',
+              _conc_cache_quota=0):
     if not q:
         return None
     q = tuple (q)
@@ -357,8 +429,8 @@ def get_conc (corp, minsize=None, q=[], fromp=0, pagesize=0, asyn=0, save=0, \
             minsize = -1
         else:
             minsize = fromp * pagesize
+    cache_root = _cache_dir
     _cache_dir = _cache_dir + '/' + corp.corpname + '/'
-    pid_dir = _cache_dir + "/run/"
     subchash = getattr(corp, 'subchash', None)
     conc = None
     fullsize = -1
@@ -366,14 +438,14 @@ def get_conc (corp, minsize=None, q=[], fromp=0, pagesize=0, asyn=0, save=0, \
     # try to locate concordance in cache
     if save:
         toprocess, conc = get_cached_conc(corp, subchash, q, _cache_dir,
-                                          pid_dir, minsize)
+                                          minsize, _concd_socket)
         if toprocess == len(q):
             save = 0
         if not conc and q[0][0] == "R": # online sample
             q_copy = list(q)
             q_copy[0] = q[0][1:]
-            t, c = get_cached_conc (corp, subchash, q_copy, _cache_dir,
-                                    pid_dir, -1)
+            t, c = get_cached_conc (corp, subchash, q_copy, _cache_dir, -1,
+                                    _concd_socket)
             if c:
                 fullsize = c.fullsize()
     else:
@@ -382,26 +454,27 @@ def get_conc (corp, minsize=None, q=[], fromp=0, pagesize=0, asyn=0, save=0, \
     # cache miss or not used
     if not conc:
         toprocess = 1
-        if asyn and len(q) == 1: # asynchronous processing
-            conc = get_async_conc (corp, q, save, _cache_dir, pid_dir,
-                                   subchash, samplesize, fullsize, minsize)
-        else: # synchronous processing
-            conc = get_sync_conc (corp, q, save, _cache_dir, pid_dir,
-                                  subchash, samplesize, fullsize)
+        if save: # computed (or joined) by the concordance daemon
+            conc = concd.get_conc (_concd_socket, corp, subchash, q[:1],
+                                   _cache_dir, samplesize, fullsize,
+                                   minsize if asyn and len(q) == 1 else -1,
+                                   cache_root=cache_root,
+                                   cache_quota=_conc_cache_quota)
+        else: # save=0 => processes entirely independent
+            conc = get_sync_conc (corp, q, samplesize, fullsize)
 
     # process subsequent concordance actions
     for act in range(toprocess, len(q)):
         command = q[act][0]
+        started = time.time()
         getattr (conc, 'command_' + command) (q[act][1:]) # call command_*(query) from pyconc
         if command in 'gaLE':# user specific/volatile actions, cannot save
             save = 0
         if save:
-            cachefile, pidfile, server = add_to_map (_cache_dir, pid_dir,
-                                                     subchash, q[:act + 1],
-                                                     conc.size())
-            if type(server) != int: # nobody started the computation yet
+            cachefile, new = add_to_map (_cache_dir, subchash, q[:act + 1],
+                                         conc.size(), time.time() - started)
+            if new: # nobody saved it yet
                 conc.save (cachefile)
-                os.remove (pidfile)
     return conc
 
 
@@ -431,11 +504,11 @@ def get_conc_desc (q=[], _cache_dir='cache', corpname='', subchash=None):
              'r': ('reduce_form', 'rlines'),
              }
     desc = []
-    saved = load_map (_cache_dir + '/' + corpname + '/')
+    _cache_dir = _cache_dir + '/' + corpname + '/'
     q = tuple (q)
 
     for i in range (len(q)):
-        size = saved.get ((subchash, q[:i+1]), ('',''))[1]
+        size = (get_from_map (_cache_dir, subchash, q[:i+1]) or ('',''))[1]
         # TODO: L operation is missing size
         opid = q[i][0]
         if opid == 'L':
@@ -466,23 +539,29 @@ def get_conc_desc (q=[], _cache_dir='cache', corpname='', subchash=None):
             desc.append ((op, args, url1p, url2p, size, formname[0], da))
     return desc
 
-def get_full_ref (corp, pos):
-    data = {}
+def full_ref_handles (corp):
+    "FULLREF attributes and structures of corp opened for get_full_ref"
     fullref = corp.get_conf('FULLREF').split(',')
     ds = corp.get_conf('DOCSTRUCTURE')
-    refs = [(n, str(pos) if n == '#' else corp.get_attr(n).pos2str(pos))
-            for n in fullref]
-    data['Refs'] = [{'name': n == '#' and 'Token number'
-                             or corp.get_conf (n+'.LABEL') or n,
-                     'id': n,
-                     'val': v}
-                    for n,v in refs]
-    if ds + '#' not in fullref:
+    attrs = [(n, None if n == '#' else corp.get_attr(n)) for n in fullref]
+    labels = [n == '#' and 'Token number' or corp.get_conf (n+'.LABEL') or n
+              for n in fullref]
+    docstruct = None if ds + '#' in fullref else corp.get_struct(ds)
+    return attrs, labels, ds, docstruct
+
+
+def get_full_ref (corp, pos, handles=None):
+    data = {}
+    attrs, labels, ds, docstruct = handles or full_ref_handles(corp)
+    refs = [(n, str(pos) if a is None else a.pos2str(pos)) for n, a in attrs]
+    data['Refs'] = [{'name': l, 'id': n, 'val': v}
+                    for (n,v), l in zip(refs, labels)]
+    if docstruct is not None:
         data['Refs'].insert(0, {
             'name': 'Document number',
             'id': ds + '#',
-            'val': str(corp.get_struct(ds).num_at_pos(pos))})
-    if '#' not in fullref:
+            'val': str(docstruct.num_at_pos(pos))})
+    if '#' not in [n for n, a in attrs]:
         data['Refs'].insert(0, {
             'name': 'Token number',
             'id': '#',
@@ -492,9 +571,9 @@ def get_full_ref (corp, pos):
     return data
 
 
-def get_detail_context (corp, pos, hitlen=1,
-                        detail_left_ctx=40, detail_right_ctx=40,
-                        addattrs=[], structs='', detail_ctx_incr=60):
+def detail_region (corp, addattrs=[], structs=''):
+    """CorpRegion for get_detail_context and the data common to all detail
+    contexts of corp"""
     data = {}
     wrapdetail = corp.get_conf ('WRAPDETAIL')
     if wrapdetail:
@@ -509,6 +588,19 @@ def get_detail_context (corp, pos, hitlen=1,
         maxdetail = 0
     if corp.corpname.startswith('user/'):
         maxdetail = 0
+    if corp.get_conf('RIGHTTOLEFT') == '1': data['righttoleft'] = True
+    data['maxcontext'] = maxdetail
+    attrs = ','.join(['word'] + addattrs)
+    return manatee.CorpRegion(corp, attrs, structs), data
+
+
+def get_detail_context (corp, pos, hitlen=1,
+                        detail_left_ctx=40, detail_right_ctx=40,
+                        addattrs=[], structs='', detail_ctx_incr=60,
+                        region=None):
+    cr, common = region or detail_region(corp, addattrs, structs)
+    data = dict(common)
+    maxdetail = data['maxcontext']
     if maxdetail:
         if detail_left_ctx > maxdetail:
             detail_left_ctx = maxdetail
@@ -516,8 +608,6 @@ def get_detail_context (corp, pos, hitlen=1,
             detail_right_ctx = maxdetail
     if detail_left_ctx > pos:
         detail_left_ctx = pos
-    attrs = ','.join(['word'] + addattrs)
-    cr = manatee.CorpRegion(corp, attrs, structs)
     region_left = tokens2strclass (cr.region (pos - detail_left_ctx, pos))
     region_kwic = tokens2strclass (cr.region (pos, pos + hitlen))
     region_right = tokens2strclass (cr.region(pos + hitlen,
@@ -543,14 +633,46 @@ def get_detail_context (corp, pos, hitlen=1,
     data['rightlink'] = refbase + ('detail_left_ctx=%i;detail_right_ctx=%i'
                                    % (detail_left_ctx,
                                       detail_right_ctx + detail_ctx_incr))
-    if corp.get_conf('RIGHTTOLEFT') == '1': data['righttoleft'] = True
     data['pos'] = pos
-    data['maxcontext'] = maxdetail
     return data
 
 
-def fcs_search(corp, fcs_query, max_rec, start):
-    "aux function for federated content search: operation=searchRetrieve"
+def get_detail_batch (corp, hits, context='wide', struct='doc', fullrefs=0,
+                      detail_left_ctx=40, detail_right_ctx=40,
+                      addattrs=[], structs='', detail_ctx_incr=60):
+    """detail contexts (context='wide' as widectx, 'struct' as structctx,
+    '' none) and/or full references (fullrefs) of hits [(pos, hitlen)],
+    in the order of hits; positions are visited in ascending order with
+    one CorpRegion and one set of attribute handles"""
+    region = context and detail_region(corp, addattrs, structs)
+    handles = fullrefs and full_ref_handles(corp)
+    s = context == 'struct' and corp.get_struct(struct)
+    done = {}
+    for pos, hitlen in sorted(set(hits)):
+        item = {'pos': pos, 'hitlen': hitlen}
+        if context:
+            left, right = detail_left_ctx, detail_right_ctx
+            if s:
+                struct_id = s.num_at_pos(pos)
+                left = pos - s.beg(struct_id)
+                right = s.end(struct_id) - pos - 1
+            item['context'] = get_detail_context(corp, pos, hitlen, left,
+                    right, detail_ctx_incr=detail_ctx_incr, region=region)
+            if s:
+                item['context']['no_display_links'] = True
+        if fullrefs:
+            item['fullref'] = get_full_ref(corp, pos, handles)
+        done[pos, hitlen] = item
+    return [done[hit] for hit in hits]
+
+
+FCS_RESULT_SET_TTL = 300 # seconds a searchRetrieve result set is kept
+
+def fcs_search(corp, fcs_query, max_rec, start, ttl=FCS_RESULT_SET_TTL,
+               _cache_dir='cache', _concd_socket='', _conc_cache_quota=0):
+    """aux function for federated content search: operation=searchRetrieve;
+    returns max_rec records from start and the number of all records, the
+    concordance stays in the cache for ttl seconds for further pages"""
     if not fcs_query:
         raise Exception(7, 'fcs_query', 'Mandatory parameter not supplied')
     query = fcs_query.replace('+', ' ') # convert URL spaces
@@ -602,17 +724,22 @@ def fcs_search(corp, fcs_query, max_rec, start):
         raise Exception(10, query, 'Query syntax error')
     if not attr in corp.get_conf('ATTRLIST'):
         raise Exception(16, attr, 'Unsupported index')
+    q = ['q' + rq]
     try: # try to get concordance
-        conc = get_conc(corp, q=['q' + rq])
+        conc = get_conc(corp, q=q, save=1, _cache_dir=_cache_dir,
+                        _concd_socket=_concd_socket,
+                        _conc_cache_quota=_conc_cache_quota)
     except Exception as e:
         raise Exception(10, repr(e), 'Query syntax error')
-    page = kwicpage(conc) # convert concordance
-    if len(page['Lines']) < start:
+    if ttl > 0:
+        keep_in_map(_cache_dir + '/' + corp.corpname + '/',
+                    getattr(corp, 'subchash', None), q, ttl)
+    if conc.size() < start:
         raise Exception(61, 'startRecord', 'First record position out of range')
-
+    lines = kwiclines(conc, start, min(start + max_rec, conc.size()))
     return [(kwicline['Left'][0]['str'], kwicline['Kwic'][0]['str'],
             kwicline['Right'][0]['str'], kwicline['Refs'])
-            for kwicline in page['Lines']][start:][:max_rec]
+            for kwicline in lines], conc.size()
 
 
 def fcs_scan(corpname, scan_query, max_ter, start):
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+# Catalog of corpus metadata for the corpus list endpoints
+#
+# /corpora, /languages and the FCS resource scan need a few configuration
+# values and the sizes of every corpus. Instead of opening each corpus with
+# manatee on every request, the values are materialised into a small JSON
+# file per corpus (and kept in memory in persistent processes). An entry is
+# valid as long as the modification times of the registry file and the
+# `sizes` file of the corpus do not change.
+
+import os, json
+from urllib.parse import quote
+import corplib
+
+CONF_KEYS = ['NAME', 'LANGUAGE', 'INFO', 'HANDLE', 'INSTITUTION',
+             'NEWVERSION', 'WSDEF', 'TERMDEF', 'DIACHRONIC', 'ALIGNED',
+             'DOCSTRUCTURE', 'DESCRIPTION', 'INFOHREF', 'WSMFW', 'WSMFWF']
+
+_entries = {}
+
+
+def _mtime (path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _is_current (entry):
+    return all(_mtime(path) == mtime for path, mtime in entry['files'])
+
+
+def _entry_file (corpname, catalog_dir):
+    return os.path.join(catalog_dir, quote(corpname, safe='') + '.json')
+
+
+def build_entry (corpname):
+    "collect metadata of corpus, raises manatee.CorpInfoNotFound"
+    corp = corplib.open_corpus(corpname)
+    sizes, _ = corplib.parse_sizes(corp.get_sizes())
+    return {
+        'corpname': corpname,
+        'files': [(path, _mtime(path)) for path in corplib.corpus_files(corp)],
+        'conf': dict((key, corp.get_conf(key)) for key in CONF_KEYS),
+        'sizes': sizes,
+        'wsinfo': corplib.get_ws_info(corp),
+    }
+
+
+def _read_entry (path, corpname):
+    try:
+        with open(path) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(entry, dict) or entry.get('corpname') != corpname:
+        return None
+    return entry
+
+
+def _write_entry (path, entry):
+    tmp_path = '%s.%d' % (path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def get_entry (corpname, catalog_dir=None):
+    """metadata of corpus: {'conf': {KEY: value}, 'sizes': {...},
+    'wsinfo': {...}}, rebuilt if the corpus changed"""
+    entry = _entries.get(corpname)
+    if entry and _is_current(entry):
+        return entry
+    path = catalog_dir and _entry_file(corpname, catalog_dir)
+    entry = path and _read_entry(path, corpname)
+    if not entry or not _is_current(entry):
+        entry = build_entry(corpname)
+        if path:
+            _write_entry(path, entry)
+    _entries[corpname] = entry
+    return entry
+
+
+def get_conf (corpname, entry, key):
+    "configuration value from catalog entry, opens the corpus for other keys"
+    if key in entry['conf']:
+        return entry['conf'][key]
+    return corplib.open_corpus(corpname).get_conf(key)
@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+# Cache of corp_info sections
+#
+# Crystal calls corp_info on every corpus switch. The response is composed
+# of sections which are computed once and kept in memory and in a JSON file
+# per corpus and section (<cache_dir>/<registry file>/<section>.json):
+#
+#   base               configuration values, attributes, sizes
+#   struct_attr_stats  sizes of structures and structure attributes
+#   gramrels           grammatical relations (walks the word sketch WMap)
+#   aligned_details    details of aligned corpora
+#   registry           registry dump and text
+#   last_corpcheck     result of the last corpcheck run
+#   aligned_labels     names and text directions of aligned corpora (view)
+#
+# Only the sections requested by the flags of a call are computed. A section
+# is valid as long as the modification times of the files it depends on (the
+# registry and `sizes` files of the corpus, plus e.g. the registry files of
+# aligned corpora or the corpcheck logs) do not change.
+
+import os, glob, json
+from urllib.parse import quote
+import corplib, regcatalog
+
+_sections = {}
+
+
+def _mtime (path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _is_current (entry):
+    return all(_mtime(path) == mtime for path, mtime in entry['files'])
+
+
+def _section_file (cache_dir, corp, name):
+    return os.path.join(cache_dir, quote(corp.get_confpath(), safe=''),
+                        name + '.json')
+
+
+def _read_entry (path):
+    try:
+        with open(path) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(entry, dict) or 'files' not in entry:
+        return None
+    return entry
+
+
+def _write_entry (path, entry):
+    tmp_path = '%s.%d' % (path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def get_section (corp, name, build, files, cache_dir=None):
+    """value of section name of corpus, computed by build() unless cached
+    for the same modification times of files"""
+    key = (corp.get_confpath(), name)
+    entry = _sections.get(key)
+    if entry and _is_current(entry):
+        return entry['value']
+    path = cache_dir and _section_file(cache_dir, corp, name)
+    entry = path and _read_entry(path)
+    if not entry or not _is_current(entry):
+        # modification times first, a file changing while building
+        # invalidates the entry
+        files = [(p, _mtime(p)) for p in files]
+        entry = {'files': files, 'value': build()}
+        if path:
+            _write_entry(path, entry)
+    _sections[key] = entry
+    return entry['value']
+
+
+def get_corp_info (corp, registry=0, gramrels=0, corpcheck=0,
+                   struct_attr_stats=0, cache_dir=None):
+    files = corplib.corpus_files(corp)
+    result = dict(get_section(corp, 'base',
+            lambda: corplib.corp_info_base(corp),
+            files + [corp.get_conf('TERMBASE') + '.fsa'], cache_dir))
+    compiled = bool(result['compiled'])
+    result['structures'] = [dict(s, attributes=[dict(a) for a in s['attributes']])
+                            for s in result['structures']]
+    if compiled and struct_attr_stats:
+        stats = get_section(corp, 'struct_attr_stats',
+                lambda: corplib.corp_info_struct_attr_stats(corp),
+                files, cache_dir)
+        for structure in result['structures']:
+            structure['size'] = stats.get(structure['name'], '')
+            for attribute in structure['attributes']:
+                attribute['size'] = stats.get('%s.%s' % (structure['name'],
+                                              attribute['name']), '')
+            structure['attributes'].sort(key=lambda x: x['size'], reverse=True)
+        result['structures'].sort(key=lambda x: x['size'], reverse=True)
+    if gramrels and result['wsdef']:
+        wsdir = os.path.dirname(corp.get_conf('WSBASE'))
+        result['gramrels'] = get_section(corp, 'gramrels',
+                lambda: corplib.corp_info_gramrels(corp),
+                files + [wsdir], cache_dir)
+    if corpcheck:
+        logdir = os.path.join(corp.get_conf('PATH'), 'log')
+        logs = sorted(glob.glob(os.path.join(logdir, '*.log')))
+        if logs:
+            result['last_corpcheck'] = get_section(corp, 'last_corpcheck',
+                    lambda: corplib.corp_info_last_corpcheck(logs[-1]),
+                    [logdir, logs[-1]], cache_dir)
+    if registry:
+        result.update(get_section(corp, 'registry',
+                lambda: corplib.corp_info_registry(corp), files, cache_dir))
+    if result['aligned']:
+        aligned_files = list(files)
+        for al in result['aligned']:
+            try:
+                aligned_files.extend(corplib.corpus_files(
+                        corplib.open_corpus(corp.cm.abs_corpname(al))))
+            except Exception: # reported by get_Corpus below
+                pass
+        result['aligned_details'] = get_section(corp, 'aligned_details',
+                lambda: corplib.corp_info_aligned_details(corp, result['aligned']),
+                aligned_files, cache_dir)
+    return result
+
+
+def get_aligned_labels (corp, cache_dir=None):
+    # labels come from the registry files only, aligned corpora are opened
+    # just to rebuild the section
+    files = corplib.corpus_files(corp) + \
+            [regcatalog.registry_file(al)
+             for al in corp.get_conf('ALIGNED').split(',') if al]
+    return get_section(corp, 'aligned_labels',
+            lambda: corplib.corp_info_aligned_labels(corp), files, cache_dir)
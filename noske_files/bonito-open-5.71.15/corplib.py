@@ -3,9 +3,12 @@
 #                          Milos Husak, Vit Baisa
 
 import manatee
-import os, sys, glob
+import os, sys, glob, stat
 import time
+import atexit
+from collections import OrderedDict
 from manatee import regexp_pattern
+import timings
 
 try:
     from hashlib import md5
@@ -14,6 +17,115 @@ except ImportError:
 from butils import *
 
 DEFAULTMAXLISTSIZE = 150
+CORPUS_POOL_SIZE = 32
+
+def _mtime_ns (path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+class CorpusPool:
+    """Bounded LRU pool of opened manatee.Corpus and SubCorpus objects
+
+    Entries are keyed by (corpus name, subcorpus file, complement) and are
+    valid as long as the modification times of the files they were opened
+    from (registry file, sizes file, subcorpus file) do not change, i.e. a
+    recompiled corpus or rebuilt subcorpus is opened again.
+    """
+    def __init__ (self, size=CORPUS_POOL_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get (self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            obj, files, mtimes = entry
+            if [_mtime_ns(f) for f in files] == mtimes:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return obj
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def put (self, key, obj, files):
+        self.entries[key] = (obj, files, [_mtime_ns(f) for f in files])
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear (self):
+        self.entries.clear()
+
+    def stats (self):
+        return {'entries': len(self.entries), 'hits': self.hits,
+                'misses': self.misses}
+
+corpus_pool = CorpusPool()
+
+class CorpusView:
+    """Per-request handle of a pooled corpus object
+
+    Attributes set on a view (corpname, cm, _conc_dir, subcname, ...) stay
+    with it, everything else is looked up in the pooled object, which is
+    shared by all requests of a process and must not carry request state.
+    manatee functions accept a view in place of the corpus, SWIG takes the
+    object pointer from its "this" attribute.
+    """
+    def __init__ (self, pooled):
+        self.__dict__['pooled'] = pooled
+        self.__dict__['this'] = pooled.this
+
+    def __getattr__ (self, name):
+        return getattr(self.pooled, name)
+timings.register_counters('corpus_pool', corpus_pool.stats)
+
+def corpus_files (corp):
+    "files a corpus object depends on: registry file and sizes"
+    return [corp.get_confpath(), os.path.join(corp.get_conf('PATH'), 'sizes')]
+
+def open_corpus (corpname):
+    "manatee.Corpus(corpname), shared through the corpus pool"
+    corp = corpus_pool.get((corpname, '', False))
+    if corp is None:
+        corp = manatee.Corpus (corpname)
+        corpus_pool.put((corpname, '', False), corp, corpus_files(corp))
+    return corp
+
+SUBC_USED_INTERVAL = 300 # seconds
+
+_subc_access = {}
+_subc_access_flushed = time.time()
+
+def track_subcorp_access (spath):
+    """remember access to subcorpus, recorded (as modification time of
+    its .used file) by flush_subcorp_access"""
+    _subc_access[spath] = time.time()
+    if time.time() - _subc_access_flushed > SUBC_USED_INTERVAL:
+        flush_subcorp_access()
+
+def flush_subcorp_access ():
+    """update .used files of accessed subcorpora, unless recorded less than
+    SUBC_USED_INTERVAL seconds ago (so mostly a stat call only)"""
+    global _subc_access_flushed
+    for spath, atime in list(_subc_access.items()):
+        used = spath[:-4] + 'used'
+        try:
+            if atime - os.stat(used).st_mtime < SUBC_USED_INTERVAL:
+                continue
+            os.utime(used, (atime, atime))
+        except FileNotFoundError:
+            try: open(used, 'w').close()
+            except OSError: pass
+        except OSError:
+            pass
+    _subc_access.clear()
+    _subc_access_flushed = time.time()
+
+atexit.register(flush_subcorp_access)
 
 class CorpusManager:
     def __init__ (self, corplist=['susanne'], subcpath=[], gdexpath=[],
@@ -27,6 +139,9 @@ class CorpusManager:
         self.obsolete_subcorp = ''
         self.obsolete_has_subcdef = False
         self.abs_corpname = abs_corpname
+        self.catalog_dir = None
+        self.ttindex_dir = None
+        self.corpinfo_dir = None
 
     def get_gdex_conf_path(self, conf):
         if not self.user_gdex_path:
@@ -42,7 +157,8 @@ class CorpusManager:
     def get_Corpus (self, corpname, subcname='', complement=False):
         if ':' in corpname:
             corpname, subcname = corpname.split(':',1)
-        corp = manatee.Corpus (self.abs_corpname(corpname))
+        abs_corpname = self.abs_corpname(corpname)
+        corp = CorpusView(open_corpus (abs_corpname))
         manatee.setEncoding(corp.get_conf('ENCODING'))
         corp.corpname = str(corpname) # never unicode (paths)
         corp.cm = self
@@ -56,19 +172,27 @@ class CorpusManager:
                     spath = os.path.join (sp, qsubcname + '.subc')
                 else:
                     spath = os.path.join (sp, corpname, qsubcname + '.subc')
-                if os.path.isfile (spath):
-                    sctime = time.gmtime(os.stat(spath).st_mtime)
-                    dafile = os.path.join(corp.get_conf('PATH'),
-                            corp.get_conf('DEFAULTATTR') + '.lex')
-                    if user_subcpath in spath and sctime < time.gmtime(os.stat(dafile).st_mtime):
+                try:
+                    st = os.stat (spath)
+                except OSError:
+                    st = None
+                if st and stat.S_ISREG (st.st_mode):
+                    sctime = time.gmtime(st.st_mtime)
+                    if user_subcpath in spath and sctime < time.gmtime(lex_mtime(corp)):
                         self.obsolete_subcorp = subcname
                         if os.path.exists(spath + 'def'):
                             self.obsolete_has_subcdef = True
-                    subc = manatee.SubCorpus (corp, spath, complement)
-                    subc.corp = corp
-                    subc.spath = spath
-                    try: open(spath[:-4] + 'used', 'w')
-                    except: pass
+                    subc = corpus_pool.get((abs_corpname, spath, complement))
+                    if subc is None:
+                        subc = manatee.SubCorpus (corp, spath, complement)
+                        subc.corp = corp.pooled
+                        subc.subchash = get_subchash (spath, complement, st)
+                        subc.spath = spath
+                        subc.complement = complement
+                        corpus_pool.put((abs_corpname, spath, complement), subc,
+                                        corpus_files(corp) + [spath])
+                    subc = CorpusView(subc)
+                    track_subcorp_access (spath)
                     subc.corpname = str(corpname) # never unicode (paths)
                     subc.subcname = subcname
                     subc.cm = self
@@ -76,8 +200,6 @@ class CorpusManager:
                         subc.subcdef = parse_subcdef(qsubcname, spath + 'def')
                     else:
                         subc.subcdef = [qsubcname, "", ""]
-                    compl = complement and b'1' or b''
-                    subc.subchash = md5(open(spath, 'rb').read()+compl).digest()
                     return subc
                 elif os.path.exists(spath + 'def'):
                     self.obsolete_subcorp = subcname
@@ -93,13 +215,16 @@ class CorpusManager:
     def corplist_with_names (self, conf_options=[]):
         """conf_options
            -- list of options to be extracted from corpus configure files"""
+        import corpcatalog
         cl = []
         for c in self.corplist:
             try:
-                mc = manatee.Corpus(self.abs_corpname(c))
+                corpname = self.abs_corpname(c)
+                entry = corpcatalog.get_entry(corpname, self.catalog_dir)
                 cinf = {'id': c,
-                        'name': mc.get_conf('NAME') or c}
-                cinf.update([(o.lower(), mc.get_conf(o)) for o in conf_options])
+                        'name': entry['conf']['NAME'] or c}
+                cinf.update([(o.lower(), corpcatalog.get_conf(corpname, entry, o))
+                             for o in conf_options])
             except:
                 cinf = {'id': c, 'name': c}
             cl.append (cinf)
@@ -128,26 +253,38 @@ class CorpusManager:
                 out.append({'n': subc_id, 'name': name, 'user': s[1]})
         return sorted(out, key=lambda x:x['n'])
 
+    @property
+    def subc_index_dir (self):
+        "directory of the subcorpus content index (see subcindex)"
+        return os.path.join(os.path.dirname(self.subcpath[-1].rstrip('/')),
+                            '.subcindex')
+
+    def register_subcorp_file (self, corpname, scpath, suffixes=()):
+        """add subcorpus file (and derived files with given suffixes) to the
+        content index, call after save_subchash"""
+        import subcindex
+        subcindex.add(self.subc_index_dir, corpname, scpath,
+                      get_subchash(scpath).hex(), suffixes)
+
+    def unregister_subcorp_file (self, corpname, scpath):
+        "remove subcorpus file from the content index before deleting it"
+        import subcindex
+        try:
+            digest = get_subchash(scpath).hex()
+        except OSError:
+            return
+        subcindex.remove(self.subc_index_dir, corpname, scpath, digest)
+
     def find_same_subcorp_file (self, corpname, scpath, user="**", attr=None, frqtype=None, subcfilter="*"):
+        import subcindex
         basedir = os.path.dirname (self.subcpath[-1].rstrip('/'))
-        scsize = os.path.getsize (scpath)
-        scdata = open(scpath, "rb").read()
+        suffix = ''
         if frqtype:
-            frqtype = frqtype.split(":")[0]
-
-        for f in glob.glob (basedir + '/%s/%s/%s.subc' % (user, corpname, subcfilter), recursive=True):
-            if f == scpath: continue
-            if os.path.getsize(f) != scsize: continue
-            if frqtype:
-                filename = f[:-4] + attr + '.' + frqtype
-            else:
-                filename = f
-            if not os.path.isfile(filename):
-                continue
-            # now, f has same size and the required freq file exists
-            if open(f, "rb").read() == scdata:
-                return f
-        return None
+            suffix = attr + '.' + frqtype.split(":")[0]
+        return subcindex.find(self.subc_index_dir, corpname, scpath,
+                get_subchash(scpath).hex(),
+                basedir + '/%s/%s/%s.subc' % (user, corpname, subcfilter),
+                suffix, lambda path: get_subchash(path).hex())
 
 def corpconf_pairs (corp, label):
     val = corp.get_conf(label)
@@ -225,11 +362,34 @@ def get_alt_lposes(corp, lemma, wsattr):
         return result
     return []
 
-def attr_vals (corpname, avattr, avpattern, avmaxitems, avfrom, icase=1):
-    c = manatee.Corpus (corpname)
+def attr_vals (corpname, avattr, avpattern, avmaxitems, avfrom, icase=1,
+               cursor='', index_dir=None):
+    """values of avattr matching avpattern, from the autocomplete index
+    (most frequent first, see avindex) if the pattern is simple enough;
+    cursor returned with each page continues after it (instead of avfrom)"""
+    import avindex
+    c = open_corpus (corpname)
+    kind, literal = avindex.parse_pattern (avpattern.strip())
+    index = kind and avindex.get_index (c, avattr, index_dir)
+    if index and not cursor.startswith('n'):
+        try:
+            after = int(cursor[1:])
+            avfrom = 0
+        except ValueError:
+            after = -1
+        found, no_more = index.search (kind, literal, icase,
+                                       avfrom + avmaxitems, after)
+        found = found[avfrom:]
+        return {'query': avpattern,
+                'suggestions': [v for r, v in found],
+                'no_more_values': no_more,
+                'cursor': not no_more and found and 'i%d' % found[-1][0] or ''}
+    if cursor.startswith('n'):
+        avfrom = int(cursor[1:])
     attr = c.get_attr (avattr, True)
     gen = attr.regexp2ids (avpattern.strip(), icase)
     items = []
+    skipped = avfrom
     while not gen.end() and avmaxitems > 0:
         if avfrom > 0:
             gen.next()
@@ -239,10 +399,17 @@ def attr_vals (corpname, avattr, avpattern, avmaxitems, avfrom, icase=1):
         avmaxitems -= 1
     return {'query': avpattern,
             'suggestions': items,
-            'no_more_values': gen.end()}
+            'no_more_values': gen.end(),
+            'cursor': not gen.end() and 'n%d' % (skipped + len(items)) or ''}
 
-def texttype_values (corp, subcorpattrs, list_all=False, hidenone=True):
+def texttype_values (corp, subcorpattrs, list_all=False, hidenone=True,
+                     ttfrom=0, ttmaxitems=0):
+    """values of text type attributes, from the text type index (see
+    ttindex), ttfrom and ttmaxitems page through the values of each
+    attribute (ttmaxitems=0: all values)"""
+    import ttindex
     if subcorpattrs == '#': return []
+    index_dir = getattr(getattr(corp, 'cm', None), 'ttindex_dir', None)
     attrlines = []
     for subcorpline in subcorpattrs.split(','):
         attrvals = []
@@ -253,7 +420,6 @@ def texttype_values (corp, subcorpattrs, list_all=False, hidenone=True):
             if n.startswith('*'):
                 n = n[1:]
                 slurp = 1
-            attr = corp.get_attr (n)
 
             attr_doc = corp.get_conf(n+'.ATTRDOC')
             if attr_doc and os.path.exists(attr_doc):
@@ -273,44 +439,22 @@ def texttype_values (corp, subcorpattrs, list_all=False, hidenone=True):
             except ValueError:
                 maxlistsize = DEFAULTMAXLISTSIZE
             hsep = corp.get_conf(n+'.HIERARCHICAL')
-            multisep = ''
-            if corp.get_conf(n+'.MULTIVALUE').startswith(('y', 'Y', '1')):
-                multisep = corp.get_conf(n+'.MULTISEP')
             if not hsep and not list_all \
                                 and (corp.get_conf (n+'.TEXTBOXLENGTH')
-                                      or attr.id_range() > maxlistsize):
+                                      or corp.get_attr (n).id_range() > maxlistsize):
                 attrval ['textboxlength'] = (corp.get_conf (n+'.TEXTBOXLENGTH')
                                              or 24)
+                attrvals.append (attrval)
+                continue
+            table = ttindex.get_table (corp, n, index_dir)
+            if hsep: # hierarchical
+                attrval ['hierarchical'] = hsep
+                attrval ['Values'] = table.hierarchy[hidenone and 1 or 0]
             else: # list of values
-                if corp.get_conf(n+'.NUMERIC'):
-                    vals = []
-                    for i in range(attr.id_range()):
-                        import re
-                        val = attr.id2str(i)
-                        numstr = re.match('\\D*(\\d*)', val).group(1)
-                        num = 999999999999
-                        if numstr:
-                            num = int(numstr)
-                        vals.append({'v': val, 'sort': num})
-                elif hsep: # hierarchical
-                    vals = [{'v': attr.id2str(i)}
-                                  for i in range(attr.id_range())
-                                  if not multisep in attr.id2str(i)]
-                else:
-                    vals = [{'v': attr.id2str(i)}
-                            for i in range(attr.id_range())
-                            if not (multisep and multisep in attr.id2str(i))]
-                if hidenone: # hide empty + ===NONE===
-                    i = 0
-                    while i < len(vals):
-                        if vals[i]['v'] in ('', '===NONE==='): del vals[i]
-                        else: i += 1
-                if hsep: # hierarchical
-                    attrval ['hierarchical'] = hsep
-                    attrval ['Values'] = get_attr_hierarchy(vals, hsep)
-                else:
-                    vals.sort(key=lambda x: (x.get('sort', 0), x['v']))
-                    attrval ['Values'] = vals
+                attrval ['Values'] = table.values(hidenone, ttfrom, ttmaxitems)
+                if ttmaxitems:
+                    attrval ['no_more_values'] = \
+                        ttfrom + ttmaxitems >= table.total(hidenone)
             attrvals.append (attrval)
         attrlines.append ({'Line': attrvals})
     return attrlines
@@ -339,9 +483,19 @@ def get_freqpath (c, attrname):
         return subcpath + attrname
     return c.get_conf('PATH') + attrname
 
+def link_file (src, dst):
+    "hardlink src to dst (statistics shared by identical subcorpora)"
+    try:
+        os.link (src, dst)
+    except FileExistsError:
+        pass
+    except OSError: # e.g. different file systems
+        from shutil import copyfile
+        copyfile (src, dst)
+
 def create_mkstats_cmd (corp, attrname, freqtype):
     outfilename = get_freqpath (corp, attrname)
-    if os.path.isfile (outfilename + "." + freqtype): # XXX this is not enough, the computation can finish anytime after this call and before jobrunner checks for it, needs to be handled in jobrunner
+    if os.path.isfile (outfilename + "." + freqtype): # XXX this is not enough, the computation can finish anytime after this call and before the job is queued, needs to be handled in jobsched
         return
     path = ""
     if hasattr(corp, 'spath'):
@@ -349,11 +503,12 @@ def create_mkstats_cmd (corp, attrname, freqtype):
         same = corp.cm.find_same_subcorp_file (corp.corpname, corp.spath, attr=attrname, frqtype=freqtype)
         if same:
             same = same[:-4] + attrname
-            from shutil import copyfile
             freqtype = freqtype.split(":")[0] # e.g. star:f
-            copyfile (same + "." + freqtype, outfilename + "." + freqtype)
-            try: copyfile (same + '.frq64', outfilename + '.frq64')
+            link_file (same + "." + freqtype, outfilename + "." + freqtype)
+            try: link_file (same + '.frq64', outfilename + '.frq64')
             except: pass
+            corp.cm.register_subcorp_file (corp.corpname, corp.spath,
+                                           [attrname + "." + freqtype])
             return
     if attrname == "WSCOLLOC":
         cmd = "sortws -q %s" % corp.get_confpath()
@@ -401,21 +556,20 @@ def compute_freqfile (user, corp, attrname, freqtype, url):
     desc = "(Sub)corpus (%s)" % freqdesc
     return run_bgjob (user, corp, cmd, desc, url)
 
-def run_bgjob (user, corp, cmd, desc, url):
+def run_bgjob (user, corp, cmd, desc, url, batch=False, extra_files=()):
+    """queue cmd in the job scheduler (joins the same job on the same data,
+    i.e. files of corp and extra_files, if it is already queued or running),
+    batch jobs run with lower priority"""
     from urllib.parse import unquote_plus
-    job = corp.cm.jobclient.request ("new_job",
-            {"cmd" : cmd, "url" : url,
-             "corpus" : corp.get_conf("NAME"), "desc" : desc})
-    if job[1] == 200: # new process started:
-        return {"progress": '0', "jobid": job[0], "notifyme": False,
-                "esttime": "N/A", "desc": unquote_plus(desc)}
-    else: # already running
-        job = corp.cm.jobclient.request ("job_progress", {"jobid" : job[0]})
-        import json
-        job = json.loads(job[0])
-        return {"progress": job[0]["progress"], "jobid": job[0]["jobid"],
-                "notifyme": job[0].get("notifyme", False),
-                "esttime": job[0]["esttime"], "desc": unquote_plus(desc)}
+    files = corpus_files(corp) + list(extra_files)
+    if hasattr(corp, 'spath'):
+        files.append(corp.spath)
+    job, _new = corp.cm.jobclient.submit (cmd, desc=desc, url=url, user=user,
+            corpus=corp.get_conf("NAME"), files=files,
+            size=corp.search_size(), batch=batch)
+    return {"progress": job["progress"], "jobid": job["jobid"],
+            "notifyme": job["notifyme"], "esttime": job["esttime"],
+            "desc": unquote_plus(desc)}
 
 def get_ws_info(corp):
     info = {
@@ -442,6 +596,31 @@ def parse_sizes(sizes_string):
     return sizes, alsizes
 
 def get_corp_info(corp, registry=0, gramrels=0, corpcheck=0, struct_attr_stats=0):
+    """corpus information for the corp_info API method, composed from
+    sections cached per corpus (see corpinfo)"""
+    import corpinfo
+    cache_dir = getattr(getattr(corp, 'cm', None), 'corpinfo_dir', None)
+    return corpinfo.get_corp_info(corp, registry, gramrels, corpcheck,
+                                  struct_attr_stats, cache_dir)
+
+def get_aligned_labels(corp):
+    """{name: {'label', 'rtl'}} of the corpora aligned with corp, cached
+    per corpus (see corpinfo)"""
+    import corpinfo
+    cache_dir = getattr(getattr(corp, 'cm', None), 'corpinfo_dir', None)
+    return corpinfo.get_aligned_labels(corp, cache_dir)
+
+def corp_info_aligned_labels(corp):
+    labels = {}
+    for al in corp.get_conf('ALIGNED').split(','):
+        if al:
+            c = open_corpus(al)
+            labels[al] = {'label': c.get_conf('NAME') or al,
+                          'rtl': c.get_conf('RIGHTTOLEFT') == '1'}
+    return labels
+
+def corp_info_base(corp):
+    "corp_info without the sections computed by the functions below"
     result = {
             'wposlist': corpconf_pairs(corp, 'WPOSLIST'),
             'lposlist': corpconf_pairs(corp, 'LPOSLIST'),
@@ -506,9 +685,6 @@ def get_corp_info(corp, registry=0, gramrels=0, corpcheck=0, struct_attr_stats=0
             'attributes': [],
             'size': ''
         }
-        if compiled and struct_attr_stats:
-            corps_struct = corp.get_struct(struct_name)
-            structure['size'] = corps_struct.size()
         if struct_name in structattr_dict:
             for attr_name in structattr_dict[struct_name]:
                 attribute = {
@@ -518,38 +694,13 @@ def get_corp_info(corp, registry=0, gramrels=0, corpcheck=0, struct_attr_stats=0
                     'fromattr': corp.get_conf('%s.%s.FROMATTR' % (struct_name, attr_name)),
                     'size': ''
                 }
-                if compiled and struct_attr_stats:
-                    attribute['size'] = corps_struct.get_attr(attr_name).id_range()
                 structure['attributes'].append(attribute)
-        structure['attributes'].sort(key=lambda x: x['size'], reverse=True)
         result['structures'].append(structure)
-    result['structures'].sort(key=lambda x: x['size'], reverse=True)
 
     if 'err' in structlist and 'corr' in structlist:
         result['is_error_corpus'] = True
     attrlist = corp.get_conf('ATTRLIST').split(',')
-    wsdef = corp.get_conf('WSDEF')
     result['gramrels'] = []
-    if gramrels and wsdef:
-        grl = []
-        grspd = {}
-        import wmap
-        try:
-            wsbase = corp.get_conf('WSBASE')
-            ws = wmap.WMap(wsbase, corp)
-            for i in range(ws.id_range()):
-                grn = ws.id2str(i)
-                grsp = ws.seppage(i)
-                if grsp == -1:
-                    grl.append(grn)
-                else:
-                    grspd.setdefault(grsp, [])
-                    grspd[grsp].append(grn)
-            result['gramrels'].extend(sorted(grl))
-            result['gramrels'].extend([x[1] for x in grspd.items()])
-        except RuntimeError:
-            pass
-
     for item in attrlist:
         result['attributes'].append({
             'name': item,
@@ -559,21 +710,59 @@ def get_corp_info(corp, registry=0, gramrels=0, corpcheck=0, struct_attr_stats=0
             'fromattr': corp.get_conf(item + '.FROMATTR')
         })
     result['sizes'], result['alsizes'] = parse_sizes(corp.get_sizes())
-    if corpcheck:
-        from butils import get_last_corpcheck
-        logs = sorted(glob.glob(os.path.join(corp.get_conf('PATH'), 'log/*.log')))
-        if logs:
-            result['last_corpcheck'] = get_last_corpcheck(logs[-1])
-    if registry:
-        result['registry_dump'] = manatee.loadCorpInfo(corp.cm.abs_corpname(corp.corpname))\
-                .dump().replace('\r', '\n')
-        result['registry_text'] = open(corp.get_confpath()).read().replace('\r', '\n')
-    for al in result['aligned']:
+    return result
+
+def corp_info_struct_attr_stats(corp):
+    "{'structure': size, 'structure.attribute': id_range}"
+    stats = {}
+    for struct_name in filter(bool, corp.get_conf('STRUCTLIST').split(',')):
+        stats[struct_name] = corp.get_struct(struct_name).size()
+    for structattr in filter(bool, corp.get_conf('STRUCTATTRLIST').split(',')):
+        struct_name, attr_name = structattr.split('.')
+        stats[structattr] = corp.get_struct(struct_name).get_attr(attr_name).id_range()
+    return stats
+
+def corp_info_gramrels(corp):
+    gramrels = []
+    grl = []
+    grspd = {}
+    import wmap
+    try:
+        wsbase = corp.get_conf('WSBASE')
+        ws = wmap.WMap(wsbase, corp)
+        for i in range(ws.id_range()):
+            grn = ws.id2str(i)
+            grsp = ws.seppage(i)
+            if grsp == -1:
+                grl.append(grn)
+            else:
+                grspd.setdefault(grsp, [])
+                grspd[grsp].append(grn)
+        gramrels.extend(sorted(grl))
+        gramrels.extend([x[1] for x in grspd.items()])
+    except RuntimeError:
+        pass
+    return gramrels
+
+def corp_info_last_corpcheck(logfile):
+    from butils import get_last_corpcheck
+    return get_last_corpcheck(logfile)
+
+def corp_info_registry(corp):
+    return {
+        'registry_dump': manatee.loadCorpInfo(corp.cm.abs_corpname(corp.corpname))\
+                .dump().replace('\r', '\n'),
+        'registry_text': open(corp.get_confpath()).read().replace('\r', '\n'),
+    }
+
+def corp_info_aligned_details(corp, aligned):
+    details = []
+    for al in aligned:
         c = corp.cm.get_Corpus(al)
         attrs = c.get_conf('ATTRLIST').split(',')
         poslist = corpconf_pairs(c, 'WPOSLIST')
         lposlist = 'lempos' in attrs and corpconf_pairs(c, 'LPOSLIST') or poslist
-        result['aligned_details'].append({
+        details.append({
             'name': c.get_conf('NAME'),
             'language_name': c.get_conf('LANGUAGE'),
             'Wposlist': [{'n': x[0], 'v': x[1]} for x in poslist],
@@ -582,33 +771,49 @@ def get_corp_info(corp, registry=0, gramrels=0, corpcheck=0, struct_attr_stats=0
             'has_lemma': 'lempos' in attrs or 'lemma' in attrs,
             'tagsetdoc': c.get_conf('TAGSETDOC')
         })
-    return result
+    return details
 
-def get_biterms(corp, l2_corp=None, limit=1000):
+def get_biterms(corp, l2_corp=None, limit=1000, start=0, patterns=[],
+                index_dir=None):
+    """term pairs of the start-th to (start+limit-1)-th source term from the
+    indexed .biterms file (see bitermsindex), only pairs matching all
+    compiled patterns"""
+    import bitermsindex
     path = corp.get_conf('PATH')
     if not l2_corp.corpname:
         raise Exception('Aligned corpus not specified')
     fname = os.path.join(path, l2_corp.corpname.split('/')[-1] + '.biterms')
     if not os.path.exists(fname):
         raise Exception('No bilingual terminology for' + ' ' + l2_corp.corpname)
-    with open(fname) as f:
-        l1t_set = set()
-        while len(l1t_set) < limit:
-            line = f.readline().strip()
-            if not line:
-                break
-            l1t, l2t, fab, fa, fb, l1s, l2s, ld = line.split('\t')
-            l1str = re.sub('-.$', '', l1t.replace("_", " "))
-            l2str = re.sub('-.$', '', l2t.replace("_", " "))
-            
-            # l1t and l2t - strings from *.biters file
-            yield [l1str, l2str, int(fab), int(fa), int(fb), float(l1s), float(l2s), float(ld), l1t, l2t]
-            l1t_set.add(l1t)
+    index = bitermsindex.get_index(fname, index_dir or os.path.join(path, '.biterms'))
+    rows = index.filter(index.page(start, limit), patterns)
+    return index.to_lists(rows)
+
+def attr_frq_array (corp, attr):
+    """frequencies of attribute by id as a read-only NumPy array mapped from
+    its .frq64 or .frq file (as manatee's get_stat('frq') reads them, for
+    subcorpora the files next to the .subc file), None if there is none or
+    it is computed (complement subcorpora)"""
+    import numpy as np
+    if getattr(corp, 'spath', ''):
+        if getattr(corp, 'complement', False):
+            return None
+        base = corp.spath[:-4] + attr
+    else:
+        base = os.path.join(corp.get_conf('PATH'), attr)
+    for suffix, dtype in (('.frq64', np.uint64), ('.frq', np.uint32)):
+        try:
+            if os.path.getsize(base + suffix):
+                return np.memmap(base + suffix, dtype=dtype, mode='r')
+        except (OSError, ValueError):
+            continue
+    return None
 
 def get_trends(corp, sattr, attr, subcpath, trends_re, sort_by,
         filter_nonwords, filter_capitalized, method,
         maxp, minfreq, trends_max_items, filter_by_trend, trends_order):
     import math
+    import numpy as np
     path = corp.get_conf('PATH')
     corp_locale = corp.get_conf('DEFAULTLOCALE')
     corp_encoding = corp.get_conf('ENCODING')
@@ -626,92 +831,145 @@ def get_trends(corp, sattr, attr, subcpath, trends_re, sort_by,
         if trends_re:
             tre = regexp_pattern(trends_re, corp_locale, corp_encoding)
 
+        data = read_trends_array(fpath)
+        if data is None: # being computed
+            return False, []
+        if not len(data):
+            return [], []
+        # numeric filters on all records, words only for the candidates
+        data = data[data['p'] <= maxp]
+        # angle is a signed byte, same values as math.tan per record
+        tan = np.array([math.tan(angle/180.0*math.pi)
+                        for angle in range(-128, 128)])
+        trend = tan[data['angle'].astype(np.int16) + 128]
+        if filter_by_trend > 0:
+            data, trend = data[trend > 0], trend[trend > 0]
+        elif filter_by_trend < 0:
+            data, trend = data[trend < 0], trend[trend < 0]
         a = corp.get_attr(attr)
-        a_frq = a.get_stat('frq')
-        for _id, angle, p in read_trends_file(fpath):
-            if _id == -1:
-                return False, []
-            if _id == -2:
-                return [], []
+        frq = attr_frq_array(corp, attr)
+        if frq is not None and (not len(data) or data['id'].max() < len(frq)):
+            freq = frq[data['id']].astype(np.int64)
+        else:
+            a_frq = a.get_stat('frq')
+            freq = np.fromiter((a_frq.freq(_id) for _id in data['id'].tolist()),
+                               dtype=np.int64, count=len(data))
+        keep = freq >= minfreq
+        data, trend, freq = data[keep], trend[keep], freq[keep]
+        rev = trends_order == 'desc'
+        if sort_by in ('t', 'p', 'f'):
+            key = {'t': np.abs(trend), 'p': data['p'], 'f': freq}[sort_by]
+            # stable in both directions like list.sort(reverse=...)
+            key = key.astype(np.float64)
+            order = np.argsort(-key if rev else key, kind='stable')
+        else:
+            order = np.arange(len(data))
+        limit = sort_by != 'w' and trends_max_items or len(data)
+        ids, angles, ps = data['id'], trend, data['p']
+        for i in order.tolist():
+            if len(trends_items) >= limit:
+                break
+            _id = int(ids[i])
             w = a.id2str(_id)
-            f = a_frq.freq(_id)
             if not w:
                 continue
-            if minfreq > f or maxp < p:
-                continue
             if filter_nonwords and nwre.search(w):
                 continue
             if filter_capitalized and w[0].lower() != w[0]:
                 continue
             if trends_re and not tre.match(w):
                 continue
-            trend = math.tan(angle/180.0*math.pi)
-            if trend > 1.0:
+            t = float(angles[i])
+            if t > 1.0:
                 simple_trend = 2
-            elif trend > 0.1:
+            elif t > 0.1:
                 simple_trend = 1
-            elif trend > -0.1:
+            elif t > -0.1:
                 simple_trend = 0
-            elif trend > -1.0:
+            elif t > -1.0:
                 simple_trend = -1
             else:
                 simple_trend = -2
-            if filter_by_trend:
-                if filter_by_trend > 0 and trend <= 0:
-                    continue
-                if filter_by_trend < 0 and trend >= 0:
-                    continue
-            trends_items.append([_id, w, trend, p, f, simple_trend])
-        rev = trends_order == 'desc'
+            trends_items.append([_id, w, t, float(ps[i]), int(freq[i]),
+                                 simple_trend])
         if sort_by == 'w':
             trends_items.sort(key=lambda x:x[1], reverse=rev)
-        elif sort_by == 't':
-            trends_items.sort(key=lambda x:abs(x[2]), reverse=rev)
-        elif sort_by == 'p':
-            trends_items.sort(key=lambda x:x[3], reverse=rev)
-        elif sort_by == 'f':
-            trends_items.sort(key=lambda x:x[4], reverse=rev)
         del trends_items[trends_max_items:]
-        if os.path.exists(spath):
-            tids = [x[0] for x in trends_items]
-            for sitem in read_trends_file(spath, True):
-                if sitem[0] in tids:
-                    samples[sitem[0]] = ':'.join(map(str, sitem[1]))
+        if os.path.exists(spath) and trends_items:
+            sdata = read_trends_array(spath, True)
+            if sdata is not None and len(sdata):
+                tids = np.array([x[0] for x in trends_items], dtype=np.uint32)
+                sdata = sdata[np.isin(sdata['id'], tids)]
+                shifts = np.arange(0, 32, 4, dtype=np.uint32)
+                cols = (sdata['v'][:, None] >> shifts) & 15
+                for _id, c in zip(sdata['id'].tolist(), cols.tolist()):
+                    samples[_id] = ':'.join(map(str, c))
     else:
         return None, None
     return trends_items, samples
 
-def read_trends_file(path, samples=False):
-    import struct
-    f = open(path, 'rb')
-    h = f.read(32)
-    if not h: # header empty => computing
-        yield samples and (-1, -1) or (-1, -1, -1)
-    result = []
-    if samples:
-        b = f.read(8)
-        if b == b'':
-            yield (-2, -1) # empty file after header
-        while b != b'':
-            try:
-                _id, v = struct.unpack('<II', b)
-            except:
-                yield (-1, [])
-            cols = [(v >> i & 15) for i in (0, 4, 8, 12, 16, 20, 24, 28)]
-            yield (_id, cols)
-            b = f.read(8)
-    else:
-        #hexdump -s 32 -v -e '1/4 "%i" 1/1 " %5i" 1/4 " %10f" "\n"'
-        b = f.read(9)
-        if b == b'':
-            yield (-2, -1, -1) # empty file after header
-        while b != b'':
-            try:
-                _id, angle, p = struct.unpack('<Ibf', b)
-                yield (_id, angle, p)
-            except Exception as e:
-                yield (-1, -1, -1)
-            b = f.read(9)
+TRENDS_HEADER_SIZE = 32
+TRENDS_DTYPE = [('id', '<u4'), ('angle', 'i1'), ('p', '<f4')]
+MINIGRAPHS_DTYPE = [('id', '<u4'), ('v', '<u4')]
+
+def read_trends_array(path, samples=False):
+    """records of .trends (id, angle, p) or .minigraphs (id, v: eight 4-bit
+    sample values) file as a memory mapped NumPy structured array, None if
+    the file is still being computed (empty header or incomplete record)"""
+    import numpy as np
+    dtype = np.dtype(samples and MINIGRAPHS_DTYPE or TRENDS_DTYPE)
+    size = os.path.getsize(path) - TRENDS_HEADER_SIZE
+    if size < 0 or size % dtype.itemsize:
+        return None
+    if not size:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=TRENDS_HEADER_SIZE,
+                     shape=(size // dtype.itemsize,))
+
+def lex_mtime (corp):
+    """modification time of the default attribute lexicon (cached in the
+    pooled corpus object, i.e. until the corpus is recompiled)"""
+    corp = getattr(corp, 'pooled', corp)
+    if not hasattr(corp, 'lex_mtime'):
+        corp.lex_mtime = os.stat(os.path.join(corp.get_conf('PATH'),
+                                 corp.get_conf('DEFAULTATTR') + '.lex')).st_mtime
+    return corp.lex_mtime
+
+def save_subchash (spath, st=None):
+    """compute MD5 digests of subcorpus file content (without and with the
+    complement flag) and store them in sidecar file spath + 'hash'"""
+    if st is None:
+        st = os.stat(spath)
+    h = md5()
+    with open(spath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    hc = h.copy()
+    hc.update(b'1')
+    digests = (h.hexdigest(), hc.hexdigest())
+    tmp_path = '%shash.%d' % (spath, os.getpid())
+    try:
+        with open(tmp_path, 'w') as f:
+            f.write('%d %d %s %s\n' % ((st.st_size, st.st_mtime_ns) + digests))
+        os.replace(tmp_path, spath + 'hash')
+    except OSError: # e.g. read-only SUBCBASE
+        pass
+    return digests
+
+def get_subchash (spath, complement=False, st=None):
+    """subchash of subcorpus, read from sidecar file if it matches the
+    size and modification time of the subcorpus file"""
+    if st is None:
+        st = os.stat(spath)
+    try:
+        with open(spath + 'hash') as f:
+            size, mtime_ns, plain, compl = f.read().split()
+        if int(size) != st.st_size or int(mtime_ns) != st.st_mtime_ns:
+            raise ValueError('outdated')
+        digests = (plain, compl)
+    except (OSError, ValueError):
+        digests = save_subchash(spath, st)
+    return bytes.fromhex(digests[complement and 1 or 0])
 
 def save_subcdef(path, subcname, structname, subquery):
     scdf = open(path + 'def', 'w')
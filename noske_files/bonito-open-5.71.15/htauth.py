@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+# Basic authentication against an htpasswd file
+#
+# Replaces running `htpasswd -vb` for every request: the htpasswd file is
+# parsed once (and reloaded if it changes), bcrypt and {SHA} hashes are
+# verified in-process and successful verifications are remembered for a short
+# time, so the (intentionally slow) bcrypt check is done once per session and
+# not for every XHR request. Other hash types are still verified by htpasswd.
+#
+# The credential cache stores HMAC digests of (user, password, stored hash)
+# only, the HMAC key is created randomly and kept next to the cache. Changing
+# a password in the htpasswd file invalidates the cached digests of the user.
+
+import os, hmac, hashlib, base64, time, subprocess
+
+try:
+    import bcrypt
+except ImportError:
+    bcrypt = None
+
+CACHE_TTL = 600 # seconds
+_MEMORY_CACHE_SIZE = 1000
+
+
+def check_hash (password, pwhash):
+    "verify password against htpasswd hash, None if hash type is unsupported"
+    if pwhash.startswith(('$2y$', '$2a$', '$2b$')):
+        if bcrypt is None:
+            return None
+        if pwhash.startswith('$2y$'): # same as $2b$
+            pwhash = '$2b$' + pwhash[4:]
+        try:
+            return bcrypt.checkpw(password.encode('utf-8'), pwhash.encode('ascii'))
+        except ValueError:
+            return False
+    if pwhash.startswith('{SHA}'):
+        digest = hashlib.sha1(password.encode('utf-8')).digest()
+        return hmac.compare_digest(base64.b64encode(digest).decode('ascii'),
+                                   pwhash[5:])
+    return None
+
+
+class HtpasswdVerifier:
+    def __init__ (self, htpasswd_file, cache_dir=None, ttl=CACHE_TTL):
+        self.htpasswd_file = htpasswd_file
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self._users = {}
+        self._signature = None
+        self._key = None
+        self._cache = {} # digest -> expiration time
+
+    def _load (self):
+        "(re)load htpasswd file if it changed"
+        try:
+            st = os.stat(self.htpasswd_file)
+        except OSError:
+            self._users, self._signature = {}, None
+            return
+        signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if signature == self._signature:
+            return
+        users = {}
+        with open(self.htpasswd_file, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#') or ':' not in line:
+                    continue
+                user, pwhash = line.split(':', 1)
+                users.setdefault(user, pwhash) # first entry wins (as in Apache)
+        self._users, self._signature = users, signature
+
+    def _get_key (self):
+        if self._key:
+            return self._key
+        if not self.cache_dir:
+            self._key = os.urandom(32)
+            return self._key
+        keyfile = os.path.join(self.cache_dir, '.key')
+        try:
+            with open(keyfile, 'rb') as f:
+                self._key = f.read()
+        except OSError:
+            self._key = b''
+        if len(self._key) != 32:
+            try:
+                self._key = self._create_key(keyfile)
+            except OSError: # no usable cache directory, keep cache in memory
+                self.cache_dir = None
+                self._key = os.urandom(32)
+        return self._key
+
+    def _create_key (self, keyfile):
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        tmpfile = '%s.%d' % (keyfile, os.getpid())
+        fd = os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(os.urandom(32))
+        try:
+            os.link(tmpfile, keyfile) # another process may have been faster
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmpfile)
+        with open(keyfile, 'rb') as f:
+            return f.read()
+
+    def _cache_key (self, user, password, pwhash):
+        msg = b'\0'.join(s.encode('utf-8') for s in (user, password, pwhash))
+        return hmac.new(self._get_key(), msg, hashlib.sha256).hexdigest()
+
+    def _is_cached (self, digest):
+        now = time.time()
+        if self._cache.get(digest, 0) > now:
+            return True
+        if not self.cache_dir:
+            return False
+        try:
+            expires = os.stat(os.path.join(self.cache_dir, digest)).st_mtime + self.ttl
+        except OSError:
+            return False
+        if expires > now:
+            self._cache[digest] = expires
+            return True
+        return False
+
+    def _remember (self, digest):
+        now = time.time()
+        if len(self._cache) >= _MEMORY_CACHE_SIZE:
+            self._cache = dict((d, e) for d, e in self._cache.items() if e > now)
+        self._cache[digest] = now + self.ttl
+        if not self.cache_dir:
+            return
+        try:
+            path = os.path.join(self.cache_dir, digest)
+            with open(path, 'w'):
+                pass
+            os.utime(path)
+            # drop expired entries, only done after a full verification
+            for name in os.listdir(self.cache_dir):
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    if os.stat(path).st_mtime + self.ttl < now:
+                        os.remove(path)
+                except OSError:
+                    pass
+        except OSError:
+            pass
+
+    def _verify_htpasswd (self, user, password):
+        proc = subprocess.run(["htpasswd", "-vb", self.htpasswd_file, user, password],
+                              stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        return proc.returncode == 0
+
+    def verify (self, user, password):
+        "True if user and password match an entry of the htpasswd file"
+        self._load()
+        pwhash = self._users.get(user)
+        if pwhash is None:
+            return False
+        digest = self._cache_key(user, password, pwhash)
+        if self._is_cached(digest):
+            return True
+        valid = check_hash(password, pwhash)
+        if valid is None:
+            valid = self._verify_htpasswd(user, password)
+        if valid:
+            self._remember(digest)
+        return valid
+
+
+_verifiers = {}
+
+def get_verifier (htpasswd_file, cache_dir=None, ttl=CACHE_TTL):
+    "shared verifier instance (keeps its caches in persistent processes)"
+    key = (htpasswd_file, cache_dir, ttl)
+    if key not in _verifiers:
+        _verifiers[key] = HtpasswdVerifier(htpasswd_file, cache_dir, ttl)
+    return _verifiers[key]
@@ -0,0 +1,684 @@
+#!/usr/bin/python3
+# Local scheduler of background jobs
+#
+# Background computations (mkstats, genngr, mktrends, mktokencov, lex2fsa,
+# ngr2fsa, compare scripts) are queued as job files in the job directory and
+# run by detached runner processes (this module run as a script), there is no
+# server to connect to or to keep running:
+#
+#   <job_dir>/<jobid>.job       job state (JSON)
+#   <job_dir>/<jobid>.out/.err  output of the command, progress is the last
+#                               "NN %" line of .err (kept if the job failed)
+#   <job_dir>/runtimes.json     recent runtimes per command type
+#   <job_dir>/jobs.log          event log
+#
+# The job id is a hash of the command and of the size and modification time
+# of its input files (registry, sizes, subcorpus), a request for a job which
+# is queued or running for the same command on the same data joins it. At
+# most pool_size() jobs run at a time (available cores, available memory per
+# JOB_MEMORY), runners start queued jobs when their job finishes, every
+# submission and poll does so as well. Interactive jobs (a user waits for the
+# result) are started before batch jobs, batch jobs run with lowered CPU and
+# I/O priority and leave one slot free for interactive jobs. The remaining
+# time is estimated from the progress of the job and from past runtimes of
+# the same command type (per token of the corpus).
+
+import os, re, sys, json, time, fcntl, shlex, signal, hashlib
+from datetime import datetime, timedelta
+from subprocess import Popen, call, check_output, CalledProcessError
+from subprocess import DEVNULL, STDOUT
+from contextlib import contextmanager
+from urllib.parse import unquote_plus
+
+JOB_MEMORY = 2 << 30 # memory reserved per running job (bytes)
+BATCH_NICE = 10
+BATCH_IONICE = ['-c', '2', '-n', '7'] # lowest best-effort I/O priority
+HISTORY_LENGTH = 20 # runtimes kept per command type
+FINISHED_KEEP = 30 * 86400 # seconds records of finished jobs are kept
+PROXY_TASKS = ('job_progress', 'job_change', 'signal_job', 'nice_job',
+               'ionice_job')
+
+# command argument distinguishing variants of a command type
+_TYPE_ARGS = {'mkstats': 3, 'mktrends': 4}
+_PROGRESS_RE = re.compile(r'^\s*(?:\[[0-9:\-]+\]\s*[a-z]+:\s*)?([0-9]+)(?:\.[0-9]+)?\s*%$')
+
+job_attrs = ["actions", "cgroup", "cpu", "esttime", "ionice", "mem", "nice",
+             "pid", "progress", "retcode", "starttime", "status", "stderr",
+             "stdout", "user", "cmd", "srv", "desc", "corpus", "url", "notify",
+             "endtime"]
+
+
+def _alive (pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _available_memory ():
+    "MemAvailable in bytes, None if unknown"
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def pool_size (running=0, max_jobs=0):
+    "number of jobs which may run at the same time"
+    try:
+        size = len(os.sched_getaffinity(0))
+    except AttributeError:
+        size = os.cpu_count() or 1
+    memory = _available_memory()
+    if memory is not None: # memory of running jobs is already taken
+        size = min(size, running + memory // JOB_MEMORY)
+    if max_jobs:
+        size = min(size, max_jobs)
+    return max(1, size)
+
+
+def command_type (cmd_list):
+    "e.g. genngr, mkstats arf"
+    name = os.path.basename(cmd_list[0])
+    i = _TYPE_ARGS.get(name)
+    if i and len(cmd_list) > i:
+        return '%s %s' % (name, cmd_list[i])
+    return name
+
+
+def fingerprint (files):
+    "[[path, size, mtime], ...] of input files"
+    out = []
+    for path in sorted(set(files)):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        out.append([path, st.st_size, st.st_mtime_ns])
+    return out
+
+
+def format_time (seconds):
+    if seconds is None:
+        return "N/A"
+    return str(timedelta(seconds=int(round(seconds))))
+
+
+def format_timestamp (t):
+    return t and str(datetime.fromtimestamp(t)) or ""
+
+
+class JobScheduler:
+    """Job queue in job_dir, see above
+
+    user, user_email and superuser identify the user of the current request
+    (access to other users' jobs, e-mail notification), like the former
+    JobClient.
+    """
+    def __init__ (self, job_dir, admin_email='root@localhost',
+                  jobprefix='localhost', user_email='', user='',
+                  superuser=False, smtp_servers='localhost', max_jobs=0):
+        self.job_dir = job_dir
+        self.admin_email = admin_email
+        self.jobprefix = jobprefix
+        self.user_email = user_email
+        self.user = user
+        self.superuser = superuser
+        self.smtp_servers = smtp_servers
+        self.max_jobs = max_jobs
+
+    def _path (self, jobid, suffix='.job'):
+        return os.path.join(self.job_dir, jobid + suffix)
+
+    @contextmanager
+    def _lock (self):
+        "exclusive lock on the job queue"
+        with open(os.path.join(self.job_dir, '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read (self, jobid):
+        try:
+            with open(self._path(jobid)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write (self, job):
+        path = self._path(job['jobid'])
+        tmp_path = '%s.%d' % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(job, f)
+        os.replace(tmp_path, path)
+
+    def _jobs (self):
+        jobs = []
+        for name in os.listdir(self.job_dir):
+            if name.endswith('.job'):
+                job = self._read(name[:-4])
+                if job:
+                    jobs.append(job)
+        return jobs
+
+    def _remove (self, jobid):
+        for suffix in ('.job', '.out', '.err'):
+            try:
+                os.unlink(self._path(jobid, suffix))
+            except OSError:
+                pass
+
+    def log_event (self, jobid, message):
+        try:
+            with open(os.path.join(self.job_dir, 'jobs.log'), 'a') as f:
+                f.write('JOBSCHED - - [%s] "JOB %s": %s\n'
+                        % (datetime.now().strftime("%d/%b/%Y %H:%M:%S"),
+                           jobid, message))
+        except OSError:
+            pass
+
+    @staticmethod
+    def is_active (job):
+        "queued, or its runner or command is still alive"
+        if job['status'] == 'queued':
+            return True
+        if job['status'] in ('starting', 'running'):
+            return _alive(job.get('pid')) or _alive(job.get('runner'))
+        return False
+
+    def submit (self, cmd, desc='', corpus='', url='', user=None, files=(),
+                size=0, batch=False):
+        """queue cmd unless the same job is queued or running, returns job
+        info (see job_progress) and whether the job is new"""
+        cmd_list = shlex.split(cmd)
+        files = fingerprint(files)
+        md5 = hashlib.md5()
+        md5.update(json.dumps([cmd_list, files]).encode())
+        jobid = self.jobprefix + ':' + md5.hexdigest()
+        with self._lock():
+            job = self._read(jobid)
+            new = not job or not self.is_active(job)
+            if new:
+                from socket import getfqdn
+                job = {'jobid': jobid, 'cmd': cmd, 'type': command_type(cmd_list),
+                       'user': user or self.user, 'desc': desc,
+                       'corpus': corpus, 'url': url, 'notify': '',
+                       'srv': getfqdn(), 'class': batch and 'batch' or 'interactive',
+                       'files': files, 'size': size, 'status': 'queued',
+                       'submitted': time.time(), 'starttime': None,
+                       'endtime': None, 'pid': None, 'runner': None,
+                       'retcode': None}
+                self._write(job)
+        if new:
+            self.log_event(jobid, 'queued (%s, %s)' % (job['class'], cmd))
+        self.dispatch()
+        return self._progress_info(self._read(jobid) or job), new
+
+    def dispatch (self):
+        "start queued jobs while there are free slots"
+        with self._lock():
+            jobs = self._jobs()
+            now = time.time()
+            running = [j for j in jobs if j['status'] in ('starting', 'running')
+                       and self.is_active(j)]
+            queued = sorted((j for j in jobs if j['status'] == 'queued'),
+                            key=lambda j: (j['class'] != 'interactive',
+                                           j['submitted']))
+            size = pool_size(len(running), self.max_jobs)
+            batch = sum(1 for j in running if j['class'] == 'batch')
+            for job in queued:
+                if len(running) >= size:
+                    break
+                if job['class'] == 'batch':
+                    if size > 1 and batch >= size - 1:
+                        continue
+                    batch += 1
+                job['status'] = 'starting'
+                job['runner'] = self._spawn(job['jobid'])
+                self._write(job)
+                running.append(job)
+            for job in jobs:
+                if job['status'] in ('done', 'failed') and \
+                        now - (job['endtime'] or now) > FINISHED_KEEP:
+                    self._remove(job['jobid'])
+
+    def _spawn (self, jobid):
+        "start a detached runner of jobid, returns its pid"
+        args = [sys.executable, os.path.abspath(__file__), 'run', self.job_dir,
+                jobid, '--email', self.admin_email, '--smtp', self.smtp_servers,
+                '--max-jobs', str(self.max_jobs)]
+        proc = Popen(args, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL,
+                     close_fds=True, start_new_session=True)
+        pid = None
+        # the runner forks and reports the pid of its child on exit
+        proc.wait()
+        try:
+            with open(self._path(jobid, '.runner')) as f:
+                pid = int(f.read())
+            os.unlink(self._path(jobid, '.runner'))
+        except (OSError, ValueError):
+            pass
+        return pid
+
+    def run (self, jobid):
+        "run queued job jobid (in the runner process)"
+        with self._lock():
+            job = self._read(jobid)
+            if not job or job['status'] != 'starting':
+                return
+            cmd_list = shlex.split(job['cmd'])
+            batch = job['class'] == 'batch'
+            out = open(self._path(jobid, '.out'), 'w')
+            err = open(self._path(jobid, '.err'), 'w')
+            try:
+                proc = Popen(cmd_list, stdin=DEVNULL, stdout=out, stderr=err,
+                             close_fds=True, start_new_session=True,
+                             preexec_fn=batch and (lambda: os.nice(BATCH_NICE)) or None)
+            except OSError as e:
+                err.write('%s\n' % e)
+                proc = None
+            out.close()
+            err.close()
+            job.update(status='running', runner=os.getpid(),
+                       pid=proc and proc.pid, starttime=time.time())
+            self._write(job)
+        if not proc:
+            return self._finished(jobid, 127)
+        if batch:
+            call(['ionice'] + BATCH_IONICE + ['-p', str(proc.pid)],
+                 stdout=DEVNULL, stderr=DEVNULL)
+        self.log_event(jobid, 'started (pid=%d,class=%s,cmd=%s)'
+                              % (proc.pid, job['class'], job['cmd']))
+        self._finished(jobid, proc.wait())
+
+    def _finished (self, jobid, retcode):
+        with self._lock():
+            job = self._read(jobid)
+            if not job:
+                return
+            job.update(status=retcode == 0 and 'done' or 'failed',
+                       retcode=retcode, endtime=time.time())
+            self._write(job)
+            if retcode == 0:
+                self._record_runtime(job)
+                for suffix in ('.out', '.err'):
+                    try:
+                        os.unlink(self._path(jobid, suffix))
+                    except OSError:
+                        pass
+            else:
+                with open(self._path(jobid, '.err'), 'a') as err:
+                    err.write("\n===== EXIT INFORMATION =====\n")
+                    err.write("Return code: %d\n" % retcode)
+        self.log_event(jobid, 'finished with return code %d' % retcode)
+        self._notify(job)
+        self.dispatch()
+
+    def _history_file (self):
+        return os.path.join(self.job_dir, 'runtimes.json')
+
+    def _history (self):
+        try:
+            with open(self._history_file()) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _record_runtime (self, job):
+        history = self._history()
+        runs = history.setdefault(job['type'], [])
+        runs.append([job['size'], job['endtime'] - job['starttime']])
+        del runs[:-HISTORY_LENGTH]
+        tmp_path = '%s.%d' % (self._history_file(), os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(history, f)
+        os.replace(tmp_path, self._history_file())
+
+    def estimate (self, job, progress=0):
+        "estimated remaining time of job in seconds, None if unknown"
+        elapsed = job['starttime'] and time.time() - job['starttime'] or 0
+        by_progress = None
+        if progress > 0 and elapsed:
+            by_progress = elapsed * (100 - progress) / progress
+        runs = self._history().get(job['type'])
+        by_history = None
+        if runs:
+            if job['size'] and all(size for size, seconds in runs):
+                rates = sorted(seconds / size for size, seconds in runs)
+                total = rates[len(rates) // 2] * job['size']
+            else:
+                total = sorted(seconds for size, seconds in runs)[len(runs) // 2]
+            by_history = max(0, total - elapsed)
+        if by_progress is None or by_history is None:
+            return by_progress if by_history is None else by_history
+        # trust the progress more the further the job is
+        return (progress * by_progress + (100 - progress) * by_history) / 100
+
+    def progress (self, jobid):
+        "last progress percentage the command reported, 0 if none"
+        try:
+            with open(self._path(jobid, '.err'), 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                f.seek(max(0, f.tell() - 4096))
+                tail = f.read().decode('utf-8', 'replace')
+        except OSError:
+            return 0
+        for line in reversed(tail.replace('\r', '\n').split('\n')):
+            m = _PROGRESS_RE.match(line)
+            if m:
+                return min(100, int(m.group(1)))
+        return 0
+
+    def _status (self, job):
+        if job['status'] == 'queued':
+            return ('Q', 'Queued')
+        if job['status'] == 'starting':
+            return ('Q', 'Starting')
+        if job['status'] == 'done':
+            return ('-', 'Completed')
+        if job['status'] == 'failed':
+            return ('err', 'Failed')
+        return None # running, see job_info
+
+    def _progress_info (self, job):
+        progress = job['status'] == 'running' and self.progress(job['jobid']) or 0
+        notifyme = bool(self.user_email) and \
+                   (' %s ' % self.user_email) in job['notify']
+        info = {'progress': str(progress), 'jobid': job['jobid'],
+                'notifyme': notifyme,
+                'esttime': format_time(self.estimate(job, progress)),
+                'status': self._status(job) or ('R', 'Running')}
+        if job['status'] == 'failed' and self.superuser:
+            info['stdout'], info['stderr'] = self._output(job['jobid'])
+        return info
+
+    def _output (self, jobid):
+        try:
+            with open(self._path(jobid, '.out')) as out, \
+                 open(self._path(jobid, '.err')) as err:
+                return out.read(), err.read()
+        except OSError:
+            return "Not available", "Not available"
+
+    def job_info (self, job):
+        "job information in the format of the former jobrunner job list"
+        d = dict((x, "") for x in job_attrs)
+        d.update((k, job[k]) for k in ('jobid', 'user', 'cmd', 'srv', 'desc',
+                                       'corpus', 'url', 'notify'))
+        d['class'] = job['class']
+        d['pid'] = job['pid'] and str(job['pid']) or ""
+        d['starttime'] = format_timestamp(job['starttime'])
+        d['endtime'] = format_timestamp(job['endtime'])
+        d['retcode'] = job['retcode'] is not None and str(job['retcode']) or ""
+        status = self._status(job)
+        if job['status'] in ('done', 'failed'):
+            d['status'] = status
+            if job['status'] == 'failed':
+                d['stdout'], d['stderr'] = self._output(job['jobid'])
+            d['esttime'] = format_time(job['endtime'] - (job['starttime']
+                                                         or job['endtime']))
+            d['progress'] = "100"
+            d['nice'] = d['cgroup'] = d['cpu'] = d['mem'] = d['ionice'] \
+                      = d['actions'] = "N/A"
+            return d
+        d['progress'] = "0"
+        d['esttime'] = format_time(self.estimate(job))
+        if status: # queued, starting
+            d['status'] = status
+            d['actions'] = ['KILL']
+            return d
+        progress = self.progress(job['jobid'])
+        d['progress'] = str(progress)
+        d['esttime'] = format_time(self.estimate(job, progress))
+        try:
+            ps = check_output(['ps', '-o', 's=,nice=,cgroup=,%cpu=,%mem=',
+                               str(job['pid'])], stderr=STDOUT, encoding='utf-8')
+        except (CalledProcessError, OSError):
+            ps = ""
+        ps = (ps or "dead ? ? ? ?").split()
+        helps = {'dead': 'The job is dead but its record was not updated',
+                 'S': 'Interruptible sleep',
+                 'D': 'Uninterruptible sleep',
+                 'R': 'Running',
+                 'T': 'Stopped',
+                 'Z': 'Zombie'}
+        d['status'] = (ps[0], helps.get(ps[0], "?"))
+        if ps[0] == 'dead':
+            d['actions'] = ['PURGE']
+        elif ps[0] == 'T':
+            d['actions'] = ['KILL', 'CONT']
+        else:
+            d['actions'] = ['KILL', 'STOP']
+        d['nice'], d['cgroup'], d['cpu'], d['mem'] = ps[1:5]
+        try:
+            d['ionice'] = check_output(['ionice', '-p', str(job['pid'])],
+                                       stderr=DEVNULL, encoding='utf-8').strip()
+        except (CalledProcessError, OSError):
+            d['ionice'] = "?"
+        return d
+
+    def list_jobs (self, user=None, finished=False):
+        """information about unfinished jobs (and finished ones if
+        finished is true) of user (all users if None)"""
+        self.dispatch()
+        jobs = [j for j in self._jobs() if user is None or j['user'] == user]
+        if finished not in (True, 'true', '1', 1):
+            jobs = [j for j in jobs if j['status'] not in ('done', 'failed')]
+        jobs.sort(key=lambda j: j['submitted'])
+        return [self.job_info(j) for j in jobs]
+
+    def has_access (self, jobid, task=''):
+        job = self._read(jobid)
+        return not job or self.superuser or job['user'] == self.user or \
+               task == 'job_progress'
+
+    def request (self, task, params):
+        """job management task (see PROXY_TASKS) with parameters given as
+        dictionary or query string, returns (message, HTTP code)"""
+        if task not in PROXY_TASKS:
+            return "Unknown task", 400
+        if not isinstance(params, dict):
+            params = dict((p.split('=', 1) + [''])[:2]
+                          for p in re.split('[;&]', params) if p)
+            params = dict((k, unquote_plus(v)) for k, v in params.items())
+        jobid = params.get('jobid')
+        if not jobid:
+            return "Missing jobid", 400
+        if not self.has_access(jobid, task):
+            return "Access denied", 401
+        if task == 'job_progress':
+            self.dispatch()
+            job = self._read(jobid)
+            if not job or job['status'] == 'done':
+                return json.dumps([]), 200
+            return json.dumps([self._progress_info(job)]), 200
+        args = dict((k, v) for k, v in params.items() if k in ('key', 'value',
+                    'signame', 'nice', 'ionice'))
+        return getattr(self, task)(jobid, **args)
+
+    def job_change (self, jobid, key=None, value=None):
+        "notify/notifyrm the current user or change the job description/URL"
+        if key not in ('notify', 'notifyrm', 'desc', 'url'):
+            return "Invalid key", 400
+        with self._lock():
+            job = self._read(jobid)
+            if not job:
+                return value or "", 200 # may have finished meanwhile
+            mark = ' %s ' % self.user_email
+            if key == 'notify' and self.user_email and mark not in job['notify']:
+                job['notify'] += mark
+            elif key == 'notifyrm':
+                job['notify'] = job['notify'].replace(mark, '')
+            elif key in ('desc', 'url'):
+                job[key] = value or ''
+            self._write(job)
+        self.log_event(jobid, "change of key '%s' to value '%s' (success)"
+                              % (key, value))
+        return value or "", 200
+
+    def signal_job (self, jobid, signame=None):
+        "KILL, STOP or CONT a job, PURGE a dead record; KILL dequeues"
+        if signame not in ("KILL", "STOP", "CONT", "PURGE"):
+            return "Invalid signal", 400
+        with self._lock():
+            job = self._read(jobid)
+            if not job:
+                return "No such job", 410
+            if signame == "PURGE" or (signame == "KILL" and
+                                      job['status'] in ('queued', 'starting')):
+                if job['status'] == 'starting' and _alive(job['runner']):
+                    os.kill(job['runner'], signal.SIGKILL)
+                self._remove(jobid)
+                self.log_event(jobid, "%s (success)" % signame.lower())
+                return "Job purged", 200
+        if not _alive(job['pid']):
+            return "No such job", 410
+        try:
+            os.killpg(job['pid'], getattr(signal, "SIG%s" % signame))
+        except OSError:
+            self.log_event(jobid, "signal %s (failed)" % signame)
+            return "Failed to signal", 500
+        self.log_event(jobid, "signal %s (success)" % signame)
+        return "Job signaled", 200
+
+    def nice_job (self, jobid, nice=None):
+        "min/max/minus/plus CPU priority of a running job"
+        if nice not in ("min", "max", "minus", "plus"):
+            return "Invalid nice", 400
+        job = self._read(jobid)
+        if not job or not _alive(job['pid']):
+            return "No such job", 410
+        curr_nice = os.getpriority(os.PRIO_PROCESS, job['pid'])
+        new_nice = {'minus': min(19, curr_nice + 1), 'plus': max(-20, curr_nice - 1),
+                    'min': 19, 'max': -20}[nice]
+        if new_nice == curr_nice:
+            return "Nothing to do", 304
+        try:
+            os.setpriority(os.PRIO_PROCESS, job['pid'], new_nice)
+        except OSError:
+            self.log_event(jobid, "nice %d (failed)" % new_nice)
+            return "Failed to nice", 500
+        self.log_event(jobid, "nice %d (success)" % new_nice)
+        return "Job niced", 200
+
+    def ionice_job (self, jobid, ionice=None):
+        "min/max/minus/plus I/O priority of a running job"
+        if ionice not in ("min", "max", "minus", "plus"):
+            return "Invalid ionice", 400
+        job = self._read(jobid)
+        if not job or not _alive(job['pid']):
+            return "No such job", 410
+        try:
+            curr = check_output(['ionice', '-p', str(job['pid'])],
+                                stderr=DEVNULL, encoding='utf-8').split()
+        except (CalledProcessError, OSError):
+            return "Failed to ionice", 500
+        cls = curr[0].rstrip(':')
+        level = cls != 'idle' and curr[-1].isdigit() and int(curr[-1]) or 4
+        if ionice == "max":
+            args = ['-c', '2', '-n', '0']
+        elif ionice == "min":
+            args = ['-c', '3']
+        elif ionice == "plus" and cls == "idle":
+            args = ['-c', '2', '-n', '7']
+        elif ionice == "plus" and level > 0:
+            args = ['-c', '2', '-n', str(level - 1)]
+        elif ionice == "minus" and cls != "idle":
+            args = level < 7 and ['-c', '2', '-n', str(level + 1)] or ['-c', '3']
+        else:
+            return "Nothing to do", 204
+        if call(['ionice'] + args + ['-p', str(job['pid'])], stderr=DEVNULL):
+            self.log_event(jobid, "ionice %s (failed)" % ' '.join(args))
+            return "Failed to ionice", 500
+        self.log_event(jobid, "ionice %s (success)" % ' '.join(args))
+        return "Job ioniced", 200
+
+    def _notify (self, job):
+        "e-mail users who asked for it (and the admin if the job failed)"
+        failed = job['status'] == 'failed'
+        recipients = job['notify'].split()
+        if not recipients and not failed:
+            return
+        import smtplib
+        from email.mime.text import MIMEText
+        messages = []
+        if failed:
+            subject = "Your computation in Sketch Engine has failed"
+            text = ("Automatic notification from Sketch Engine:\n\n"
+                    "Your background computation\n'%s'\nhas failed. We are "
+                    "currently working on fixing the problem. Please try again "
+                    "later or contact support." % job['desc'])
+            out, err = self._output(job['jobid'])
+            messages.append((self.admin_email,
+                    "Computation '%s' in Sketch Engine has failed" % job['desc'],
+                    "Dear administrator,\nthe background computation\n'%s'\n"
+                    "in Sketch Engine has failed.\nId: %s\nUser: %s (%s was/were "
+                    "notified)\nServer: %s\nCommand: %s\nReturn code: %d\n"
+                    "stdout: %s\n\nstderr: %s\n"
+                    % (job['desc'], job['jobid'], job['user'],
+                       job['notify'] or "no e-mail", job['srv'], job['cmd'],
+                       job['retcode'], out, err)))
+        else:
+            subject = "Your computation in Sketch Engine has finished"
+            text = ("Automatic notification from Sketch Engine:\n\n"
+                    "Your background computation\n'%s'\nhas finished "
+                    "successfully. You can access the results at the link "
+                    "below:\n\n%s" % (job['desc'], job['url']))
+        messages += [(r, subject, text) for r in recipients]
+        for server in self.smtp_servers.split():
+            try:
+                smtp = smtplib.SMTP(server)
+                break
+            except Exception as e:
+                self.log_event(job['jobid'], "Failed to initialize SMTP server "
+                                             "'%s' with error: %s" % (server, e))
+        else:
+            return
+        try:
+            for recipient, subject, text in messages:
+                msg = MIMEText(text)
+                msg['From'] = self.admin_email
+                msg['To'] = recipient
+                msg['Subject'] = subject
+                smtp.sendmail(self.admin_email, [recipient], msg.as_string())
+            self.log_event(job['jobid'], "notified %s"
+                           % ", ".join(r for r, s, t in messages))
+        except Exception as e:
+            self.log_event(job['jobid'], "notification failed: %s" % e)
+        finally:
+            smtp.quit()
+
+
+def main ():
+    import argparse
+    parser = argparse.ArgumentParser(description='Run a queued Bonito job')
+    parser.add_argument('action', choices=['run'])
+    parser.add_argument('job_dir')
+    parser.add_argument('jobid')
+    parser.add_argument('--email', default='root@localhost')
+    parser.add_argument('--smtp', default='localhost')
+    parser.add_argument('--max-jobs', type=int, default=0)
+    args = parser.parse_args()
+    scheduler = JobScheduler(args.job_dir, args.email, smtp_servers=args.smtp,
+                             max_jobs=args.max_jobs)
+    pid = os.fork()
+    if pid: # detach from the submitting process, which waits for us
+        with open(scheduler._path(args.jobid, '.runner'), 'w') as f:
+            f.write(str(pid))
+        os._exit(0)
+    scheduler.run(args.jobid)
+
+
+if __name__ == '__main__':
+    main()
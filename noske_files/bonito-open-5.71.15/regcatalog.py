@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+# Catalog of the corpora in the Manatee registry
+#
+# Listing the registry (and all user scope subdirectories) costs a stat call
+# per registry file. The catalog keeps the result in the process and in an
+# index file and only rescans the registry if the modification time of the
+# registry directory or one of the scope directories changed (i.e. if a
+# registry file was added, removed or renamed).
+
+import os, json
+
+USER_SCOPED_CORPORA_SEP = "----"
+
+_catalogs = {}
+
+
+def _mtime (path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _owner (corpname):
+    if USER_SCOPED_CORPORA_SEP in corpname:
+        return corpname.split(USER_SCOPED_CORPORA_SEP, 1)[0]
+    return None
+
+
+def _is_current (catalog):
+    registry = catalog['registry']
+    for scope, mtime in catalog['mtimes'].items():
+        if _mtime(os.path.join(registry, scope)) != mtime:
+            return False
+    return True
+
+
+def scan_registry (registry):
+    "list corpora in registry, returns catalog dictionary"
+    mtimes = {'': _mtime(registry)}
+    corpora = []
+    scoped = []
+    for name in os.listdir(registry):
+        if name.endswith(".disabled"):
+            continue
+        path = os.path.join(registry, name)
+        if os.path.isfile(path):
+            corpora.append(name)
+        elif os.path.isdir(path):
+            mtimes[name] = _mtime(path)
+            for corp_name in os.listdir(path):
+                if os.path.isfile(os.path.join(path, corp_name)):
+                    scoped.append(os.path.join(name, corp_name))
+    return {
+        'registry': registry,
+        'mtimes': mtimes,
+        'corpora': [(c, _owner(c)) for c in corpora + scoped],
+    }
+
+
+def _read_index (index_file, registry):
+    try:
+        with open(index_file) as f:
+            catalog = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(catalog, dict) or catalog.get('registry') != registry:
+        return None
+    return catalog
+
+
+def _write_index (index_file, catalog):
+    tmp_file = '%s.%d' % (index_file, os.getpid())
+    try:
+        with open(tmp_file, 'w') as f:
+            json.dump(catalog, f)
+        os.replace(tmp_file, index_file)
+    except OSError:
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+
+
+def get_catalog (registry, index_file=None):
+    "return up-to-date catalog of registry, rescan only if it changed"
+    catalog = _catalogs.get(registry)
+    if catalog and _is_current(catalog):
+        return catalog
+    if index_file:
+        catalog = _read_index(index_file, registry)
+        if catalog and _is_current(catalog):
+            _catalogs[registry] = catalog
+            return catalog
+    catalog = scan_registry(registry)
+    if index_file:
+        _write_index(index_file, catalog)
+    _catalogs[registry] = catalog
+    return catalog
+
+
+def get_corplist (registry, index_file=None):
+    "names of all corpora in registry"
+    return [c for c, owner in get_catalog(registry, index_file)['corpora']]
+
+
+def registry_file (corpname, registry=None):
+    """path of the registry file of corpname (absolute or relative to one
+    of the directories of MANATEE_REGISTRY, as manatee resolves it), the
+    path in the first directory if there is none"""
+    if os.path.isabs(corpname):
+        return corpname
+    if registry is None:
+        registry = os.environ.get('MANATEE_REGISTRY', '')
+    dirs = [d for d in registry.split(':') if d] or ['.']
+    for d in dirs:
+        path = os.path.join(d, corpname)
+        if os.path.isfile(path):
+            return path
+    return os.path.join(dirs[0], corpname)
+
+
+def get_user_corplist (registry, user, superuser=False, anonymous=True,
+                       index_file=None):
+    "names of corpora visible to user: public corpora and the user's own"
+    return [c for c, owner in get_catalog(registry, index_file)['corpora']
+            # free, public corpora
+            if owner is None
+            # being superuser
+            or superuser
+            # or only my corpora if not anonymous
+            or (not anonymous and owner == user)]
@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+# Cache of rendered concordance pages
+#
+# Rendering a page of a concordance (KWICLines, reference links, reformatting
+# for the concordance API, sort index) gives the same result as long as the
+# saved concordance and the view parameters do not change. Pages are pickled
+# and compressed next to the concordance they were rendered from,
+#
+#   <cache>/<corpus>/<name>.pages/<hash of view parameters>
+#
+# together with the inode and modification time of <name>.conc, so a page is
+# never served for a concordance which was recomputed meanwhile. The pages
+# directory is removed with the concordance (see conccache.remove_conc_files,
+# used by evict_cache, which counts its size in the cache budget). Persistent worker processes (bonito-scgi.py) also
+# keep recently used pages in a bounded in-memory LRU.
+
+import os, pickle, shutil, zlib
+from collections import OrderedDict
+from hashlib import sha1
+import timings
+
+RENDER_CACHE_SIZE = 64 * 1024 * 1024 # bytes of compressed pages in memory
+MAX_PAGE_SIZE = 16 * 1024 * 1024 # larger compressed pages are not cached
+
+
+class RenderCache:
+    def __init__ (self, size=RENDER_CACHE_SIZE):
+        self.size = size
+        self.used = 0
+        self.entries = OrderedDict() # key: compressed page file contents
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get (self, key):
+        "page stored under key, None if missing or its concordance changed"
+        data = self.entries.get(key)
+        if data is not None:
+            if _file_id(key[0]) == key[1]:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return pickle.loads(zlib.decompress(data))[2]
+            self._remove(key)
+        try:
+            with open(_page_file(key), 'rb') as f:
+                data = f.read()
+            file_id, params, page = pickle.loads(zlib.decompress(data))
+        except (OSError, ValueError, EOFError, zlib.error, pickle.PickleError):
+            self.misses += 1
+            return None
+        if (file_id, params) != key[1:] or _file_id(key[0]) != key[1]:
+            self.misses += 1
+            return None
+        self.disk_hits += 1
+        self._remember(key, data)
+        return page
+
+    def put (self, key, page):
+        data = zlib.compress(pickle.dumps(key[1:] + (page,),
+                                          pickle.HIGHEST_PROTOCOL), 1)
+        if len(data) > MAX_PAGE_SIZE:
+            return
+        self._remember(key, data)
+        path = _page_file(key)
+        tmp_path = '%s.%d' % (path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def _remember (self, key, data):
+        if len(data) > self.size // 4: # would push out too much
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = data
+        self.used += len(data)
+        while self.used > self.size:
+            self._remove(next(iter(self.entries)))
+
+    def _remove (self, key):
+        self.used -= len(self.entries.pop(key))
+
+    def clear (self):
+        self.entries.clear()
+        self.used = 0
+
+    def stats (self):
+        return {'entries': len(self.entries), 'bytes': self.used,
+                'hits': self.hits, 'disk_hits': self.disk_hits,
+                'misses': self.misses}
+
+
+def _file_id (path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns)
+
+
+def _pages_dir (cachefile):
+    return cachefile[:-len('.conc')] + '.pages'
+
+
+def _page_file (key):
+    cachefile, file_id, params = key
+    return os.path.join(_pages_dir(cachefile),
+                        sha1(repr(params).encode('utf-8')).hexdigest())
+
+
+def page_key (cachefile, params):
+    "key of a page of the concordance saved in cachefile, None if not saved"
+    file_id = _file_id(cachefile)
+    return file_id and (cachefile, file_id, params)
+
+
+def pages_size (cachefile):
+    "bytes of the pages rendered from the concordance saved in cachefile"
+    size = 0
+    try:
+        with os.scandir(_pages_dir(cachefile)) as entries:
+            for entry in entries:
+                try:
+                    size += entry.stat().st_size
+                except OSError: # removed meanwhile
+                    pass
+    except OSError:
+        pass
+    return size
+
+
+def remove_pages (cachefile):
+    "removes the pages rendered from the concordance saved in cachefile"
+    shutil.rmtree(_pages_dir(cachefile), ignore_errors=True)
+
+
+render_cache = RenderCache()
+timings.register_counters('render_cache', render_cache.stats)
@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+# Content-addressed index of subcorpus files
+#
+# Identical subcorpora (e.g. instant subcorpora created by many users for the
+# same text types) share their statistics files. Instead of globbing the
+# subcorpus directories of all users and comparing every candidate byte by
+# byte, subcorpora are registered under their content hash (the plain MD5
+# digest also stored in the `.subchash` sidecar file, see
+# corplib.save_subchash) when they are created and unregistered when they are
+# deleted. An entry is one small JSON file per corpus and hash:
+#
+#   <index_dir>/<corpus>/<md5>.json
+#   {"paths": [[<path of .subc file>, [<derived file suffixes>]], ...]}
+#
+# The first path is the canonical one. Derived file suffixes (e.g.
+# `word.frq`) record which statistics files are known to exist next to a
+# subcorpus. Entries are verified on lookup (the candidate must still have
+# the same hash and the statistics file must exist), stale data is dropped.
+# Entries are updated in place under an exclusive flock and never removed.
+
+import os, json, fcntl
+from fnmatch import fnmatch
+from urllib.parse import quote
+
+
+def _entry_file (index_dir, corpname, digest):
+    return os.path.join(index_dir, quote(corpname, safe=''), digest + '.json')
+
+
+def _update (index_dir, corpname, digest, func):
+    "apply func to paths of entry under an exclusive lock"
+    path = _entry_file(index_dir, corpname, digest)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o664)
+    except OSError: # e.g. read-only subcorpus directory
+        return
+    with os.fdopen(fd, 'r+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            paths = json.load(f)['paths']
+        except (ValueError, KeyError, TypeError):
+            paths = []
+        # rewritten in place, never removed: processes waiting for the lock
+        # would update an unlinked file otherwise; an emptied entry is kept
+        f.seek(0)
+        f.truncate()
+        json.dump({'paths': func(paths)}, f)
+
+
+def _read (index_dir, corpname, digest):
+    try:
+        with open(_entry_file(index_dir, corpname, digest)) as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            return json.load(f)['paths']
+    except (OSError, ValueError, KeyError, TypeError):
+        return []
+
+
+def add (index_dir, corpname, spath, digest, suffixes=()):
+    "register subcorpus file spath (and its derived files) under digest"
+    def func (paths):
+        for item in paths:
+            if item[0] == spath:
+                item[1] = sorted(set(item[1]).union(suffixes))
+                return paths
+        return paths + [[spath, sorted(suffixes)]]
+    _update(index_dir, corpname, digest, func)
+
+
+def remove (index_dir, corpname, spath, digest):
+    "unregister subcorpus file spath"
+    _update(index_dir, corpname, digest,
+            lambda paths: [item for item in paths if item[0] != spath])
+
+
+def find (index_dir, corpname, spath, digest, pattern='', suffix='',
+          get_digest=None):
+    """path of a subcorpus with the same content as spath, or None
+
+    pattern -- fnmatch pattern the path has to match
+    suffix -- derived file (spath[:-4] + suffix) which has to exist
+    get_digest -- function returning current hex digest of a path, used
+                  to verify candidates
+    """
+    stale = []
+    found = None
+    paths = _read(index_dir, corpname, digest)
+    # prefer subcorpora with the statistics file already recorded
+    paths.sort(key=lambda item: suffix not in item[1])
+    for path, suffixes in paths:
+        if path == spath or (pattern and not fnmatch(path, pattern)):
+            continue
+        try:
+            if get_digest and get_digest(path) != digest:
+                raise OSError('changed')
+        except OSError:
+            stale.append(path)
+            continue
+        if suffix and not os.path.isfile(path[:-4] + suffix):
+            if suffix in suffixes:
+                _update(index_dir, corpname, digest,
+                        lambda p: [[i[0], [s for s in i[1] if s != suffix]]
+                                   if i[0] == path else i for i in p])
+            continue
+        found = path
+        if suffix and suffix not in suffixes:
+            add(index_dir, corpname, path, digest, [suffix])
+        break
+    if stale:
+        _update(index_dir, corpname, digest,
+                lambda p: [item for item in p if item[0] not in stale])
+    return found
@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+# Per-request phase timings
+#
+# Disabled by default. Enabled for all requests by the BONITO_TIMINGS
+# environment variable, or for a single request by the profile=1 URL
+# parameter (independent of debug=1, so that measuring a request does not
+# change its error handling). If enabled, CGIPublisher adds a "_timings" key to
+# JSON results and writes one structured (JSON) log line per request to
+# stderr, i.e. the Apache error log:
+#
+#   bonito-timings {"method": "view", "total_ms": 12.3,
+#                   "phases": {"get_conc": {"ms": 4.5, "calls": 1}, ...}}
+#
+# Phases are inclusive (the "view" method phase contains "get_conc" etc.),
+# repeated phases are summed up. When disabled, phase() returns a shared
+# no-op context manager, so instrumented code costs a function call only.
+# Modules may register counters (e.g. cache hits and misses) which are
+# reported along with the phases.
+
+import os, sys, json
+from time import perf_counter as clock
+
+enabled = False
+_start = clock()
+_phases = {}
+_counters = {}
+
+
+class _NullPhase:
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc_info):
+        return False
+
+_null_phase = _NullPhase()
+
+
+class _Phase:
+    __slots__ = ('name', 'start')
+
+    def __init__ (self, name):
+        self.name = name
+
+    def __enter__ (self):
+        self.start = clock()
+        return self
+
+    def __exit__ (self, *exc_info):
+        add(self.name, clock() - self.start)
+        return False
+
+
+def _phase_name (name):
+    if isinstance(name, str):
+        return name
+    return getattr(name, '__name__', None) or type(name).__name__
+
+
+def phase (name):
+    "context manager timing a phase, name may be a string or a function"
+    if not enabled:
+        return _null_phase
+    return _Phase(name)
+
+
+def add (name, seconds):
+    name = _phase_name(name)
+    p = _phases.get(name)
+    if p is None:
+        _phases[name] = [seconds, 1]
+    else:
+        p[0] += seconds
+        p[1] += 1
+
+
+def add_since (name, start):
+    "record phase which started at clock() time start"
+    if enabled:
+        add(name, clock() - start)
+
+
+def start_request ():
+    "reset timings, enabled if BONITO_TIMINGS is set"
+    global enabled, _start
+    enabled = bool(os.environ.get('BONITO_TIMINGS'))
+    _phases.clear()
+    _start = clock()
+
+
+def enable ():
+    global enabled
+    enabled = True
+
+
+def register_counters (name, stats):
+    "report stats() (a dictionary) as counters under name"
+    _counters[name] = stats
+
+
+def report ():
+    result = {'total_ms': round((clock() - _start) * 1000, 3),
+              'phases': dict((name, {'ms': round(s * 1000, 3), 'calls': c})
+                             for name, (s, c) in _phases.items())}
+    if _counters:
+        result['counters'] = dict((name, stats())
+                                  for name, stats in _counters.items())
+    return result
+
+
+def log_request (method, **info):
+    "write structured log line for the current request"
+    if not enabled:
+        return
+    record = {'method': method, 'pid': os.getpid()}
+    record.update(info)
+    record.update(report())
+    sys.stderr.write('bonito-timings %s\n' % json.dumps(record))
+    sys.stderr.flush()
@@ -0,0 +1,257 @@
+#!/usr/bin/python3
+# Materialised index of text type values
+#
+# texttype_values and texttypes_with_norms list all values of structure
+# attributes (e.g. doc.genre, doc.url), which means one id2str call per value
+# and another loop over all values (or all structures) to count them. For
+# every structure attribute the values are stored once in a compact binary
+# table (<index_dir>/<registry file>/<attr>.tti): the values themselves,
+# numeric sort keys, the display order and the prebuilt hierarchy of
+# hierarchical attributes. Value counts (documents, tokens, norm) are stored in a separate
+# file per count (<attr>.<count>.ttc) computed when first requested. Tables
+# are valid as long as the registry and `sizes` files of the corpus do not
+# change, i.e. until the corpus is recompiled. bonito-ttindex.py builds them
+# right after compilation.
+
+import os, re, json
+from array import array
+from urllib.parse import quote
+import corplib
+
+NUMERIC_NONE = 999999999999
+COUNTS = ('freq', 'tokens', 'norm')
+_HIDDEN = ('', '===NONE===')
+_NUMBER_RE = re.compile('\\D*(\\d*)')
+
+_tables = {}
+
+
+def _mtime (path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def corpus_mtimes (corp):
+    "[(path, mtime), ...] of the files an index of corp depends on"
+    return [(path, _mtime(path)) for path in corplib.corpus_files(corp)]
+
+
+def is_current (files):
+    return all(_mtime(path) == mtime for path, mtime in files)
+
+
+def read_file (path):
+    "returns header dictionary and binary data of table file"
+    try:
+        with open(path, 'rb') as f:
+            header = json.loads(f.readline())
+            data = f.read()
+    except (OSError, ValueError):
+        return None, None
+    if not isinstance(header, dict) or not is_current(header.get('files', [])):
+        return None, None
+    return header, data
+
+
+def write_file (path, header, arrays):
+    tmp_path = '%s.%d' % (path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            for a in arrays:
+                f.write(a if isinstance(a, bytes) else a.tobytes())
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def unpack (data, typecodes, lengths):
+    "split data into arrays of given typecodes and lengths (None = bytes)"
+    out = []
+    offset = 0
+    for typecode, length in zip(typecodes, lengths):
+        if typecode is None:
+            out.append(data[offset:offset+length])
+            offset += length
+            continue
+        a = array(typecode)
+        a.frombytes(data[offset:offset + length * a.itemsize])
+        offset += length * a.itemsize
+        out.append(a)
+    return out
+
+
+class TextTypeTable:
+    """values of one structure attribute
+
+    values are addressed by lexicon id, `order` lists ids in display order
+    (empty and ===NONE=== values included, see ids())
+    """
+    def __init__ (self, corp, attrname, path=None):
+        self.corp = corp
+        self.attrname = attrname
+        self.path = path
+        self.files = corpus_mtimes(corp)
+        self.conf = self._conf()
+        self._counts = {}
+        self._visible = None
+        header, data = path and read_file(path) or (None, None)
+        if header and header.get('conf') == self.conf:
+            self._load(header, data)
+        else:
+            self._build()
+            if path:
+                self._save()
+
+    def _conf (self):
+        corp, n = self.corp, self.attrname
+        multisep = ''
+        if corp.get_conf(n+'.MULTIVALUE').startswith(('y', 'Y', '1')):
+            multisep = corp.get_conf(n+'.MULTISEP')
+        return {'numeric': bool(corp.get_conf(n+'.NUMERIC')),
+                'hsep': corp.get_conf(n+'.HIERARCHICAL'),
+                'multisep': multisep}
+
+    def _build (self):
+        attr = self.corp.get_attr(self.attrname)
+        numeric, hsep, multisep = (self.conf['numeric'], self.conf['hsep'],
+                                   self.conf['multisep'])
+        id2str = attr.id2str
+        strs = [id2str(i) for i in range(attr.id_range())]
+        self.hidden = [i for i, v in enumerate(strs) if v in _HIDDEN]
+        if numeric:
+            self.sortkeys = array('q', [int(m or NUMERIC_NONE) for m in
+                                        (_NUMBER_RE.match(v).group(1) for v in strs)])
+            ids = range(len(strs))
+        elif hsep:
+            ids = [i for i, v in enumerate(strs) if not multisep in v]
+        else:
+            ids = [i for i, v in enumerate(strs)
+                   if not (multisep and multisep in v)]
+        if numeric:
+            key = lambda i: (self.sortkeys[i], strs[i])
+        else:
+            self.sortkeys = None
+            key = lambda i: strs[i]
+        self.order = array('I', sorted(ids, key=key))
+        blobs = [v.encode('utf-8') for v in strs]
+        self.offsets = array('I', [0])
+        for b in blobs:
+            self.offsets.append(self.offsets[-1] + len(b))
+        self.blob = b''.join(blobs)
+        self.hierarchy = {}
+        if hsep:
+            for hidenone in (0, 1):
+                vals = [{'v': strs[i]} for i in self.ids(hidenone)]
+                self.hierarchy[hidenone] = corplib.get_attr_hierarchy(vals, hsep)
+
+    def _save (self):
+        header = {'files': self.files, 'conf': self.conf,
+                  'lengths': [len(self.offsets), len(self.blob),
+                              len(self.order),
+                              self.sortkeys is not None and len(self.sortkeys) or 0],
+                  'hidden': self.hidden,
+                  'hierarchy': [self.hierarchy.get(0), self.hierarchy.get(1)]}
+        write_file(self.path, header, [self.offsets, self.blob, self.order,
+                                        self.sortkeys or b''])
+
+    def _load (self, header, data):
+        self.offsets, self.blob, self.order, sortkeys = unpack(data,
+                ('I', None, 'I', 'q'), header['lengths'])
+        self.sortkeys = self.conf['numeric'] and sortkeys or None
+        self.hidden = header['hidden']
+        h0, h1 = header['hierarchy']
+        self.hierarchy = self.conf['hsep'] and {0: h0, 1: h1} or {}
+
+    def id_range (self):
+        return len(self.offsets) - 1
+
+    def id2str (self, i):
+        return self.blob[self.offsets[i]:self.offsets[i+1]].decode('utf-8')
+
+    def ids (self, hidenone=True, start=0, count=0):
+        "ids of values in display order, count=0 means all"
+        ids = self.order
+        if hidenone and self.hidden:
+            if self._visible is None:
+                self._visible = array('I', (i for i in ids
+                                            if i not in self.hidden))
+            ids = self._visible
+        if start or count:
+            ids = ids[start:count and start + count or None]
+        return ids
+
+    def total (self, hidenone=True):
+        return len(self.ids(hidenone))
+
+    def values (self, hidenone=True, start=0, count=0):
+        "list of {'v': value} ({'v': value, 'sort': key} for NUMERIC)"
+        if self.sortkeys is not None:
+            return [{'v': self.id2str(i), 'sort': self.sortkeys[i]}
+                    for i in self.ids(hidenone, start, count)]
+        return [{'v': self.id2str(i)} for i in self.ids(hidenone, start, count)]
+
+    def counts (self, name):
+        "array of value counts by id: freq (documents), tokens or norm"
+        if name not in self._counts:
+            path = self.path and '%s.%s.ttc' % (self.path[:-4], name)
+            header, data = path and read_file(path) or (None, None)
+            if header and header.get('length') == self.id_range():
+                counts = unpack(data, ('q',), (header['length'],))[0]
+            else:
+                counts = self._count(name)
+                if path:
+                    write_file(path, {'files': self.files,
+                                       'length': len(counts)}, [counts])
+            self._counts[name] = counts
+        return self._counts[name]
+
+    def _count (self, name):
+        attr = self.corp.get_attr(self.attrname)
+        n = attr.id_range()
+        if name == 'freq':
+            return array('q', [attr.freq(i) for i in range(n)])
+        if name == 'tokens':
+            counts = array('q', bytes(8 * n))
+            struct = self.corp.get_struct(self.attrname.split('.')[0])
+            p2i, beg, end = attr.pos2id, struct.beg, struct.end
+            for sid in range(struct.size()):
+                counts[p2i(sid)] += end(sid) - beg(sid)
+            return counts
+        return array('q', [attr.norm(i) for i in range(n)])
+
+
+def _table_file (index_dir, corp, attrname):
+    return os.path.join(index_dir, quote(corp.get_confpath(), safe=''),
+                        quote(attrname, safe='') + '.tti')
+
+
+def get_table (corp, attrname, index_dir=None):
+    "TextTypeTable of structure attribute, rebuilt if the corpus changed"
+    key = (corp.get_confpath(), attrname)
+    table = _tables.get(key)
+    if table and is_current(table.files):
+        return table
+    path = index_dir and _table_file(index_dir, corp, attrname)
+    table = TextTypeTable(corp, attrname, path)
+    _tables[key] = table
+    return table
+
+
+def build (corp, index_dir, counts=COUNTS):
+    "build tables (and counts) of all structure attributes of corpus"
+    for attrname in corp.get_conf('STRUCTATTRLIST').split(','):
+        if not attrname:
+            continue
+        table = get_table(corp, attrname, index_dir)
+        for name in counts:
+            try:
+                table.counts(name)
+            except Exception: # e.g. no norms
+                pass
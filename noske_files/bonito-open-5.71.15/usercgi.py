@@ -5,7 +5,7 @@ import CGIPublisher
 import os, json
 import re
 from butils import open_exclusive_file_with_wait
-from jobrunner import JobClient
+from jobsched import JobScheduler
 
 def load_opt_file (options, filepath, option_list=[], selector=''):
     if not os.path.isfile (filepath):
@@ -84,10 +84,8 @@ class UserCGI (CGIPublisher.CGIPublisher):
     _admin_email = ''
     _from_email = ''
     _mail_server = 'localhost'
-    _job_server = 'localhost'
-    _job_port = 8333
     _job_dir = ''
-    _job_autostart = True
+    _job_pool_size = 0 # 0: sized to available cores and memory
     _job_smtp_servers = 'localhost'
     _data_dir = ''
     _job_prefix = 'localhost'
@@ -107,9 +105,10 @@ class UserCGI (CGIPublisher.CGIPublisher):
                                              + "/jobs"
         if not os.path.isdir(self._job_dir):
             os.makedirs(self._job_dir)
-        self._job = JobClient (self._job_server, self._job_port, self._job_dir,\
-                               self._admin_email, self._job_prefix,
-                               self._email, self._user, self._superuser, self._job_autostart, self._job_smtp_servers)
+        self._job = JobScheduler (self._job_dir, self._admin_email,
+                                  self._job_prefix, self._email, self._user,
+                                  self._superuser, self._job_smtp_servers,
+                                  self._job_pool_size)
 
     def _user_defaults (self, user):
         pass
@@ -268,9 +267,7 @@ class UserCGI (CGIPublisher.CGIPublisher):
         return {'message': 'ok'}
 
     def jobs (self, finished=False):
-        jobs = self._job.request ("list_user_jobs",
-                                  {"user" : self._user, "finished" : finished})
-        jobs = json.loads(jobs[0])
+        jobs = self._job.list_jobs (self._user, finished)
         out = {'jobs': jobs, 'view_type' : 'user', 'no_corpus_show': 1}
         return out
 
@@ -278,9 +275,7 @@ class UserCGI (CGIPublisher.CGIPublisher):
         if not self._superuser:
             raise Exception('access denied: User "%s" is not a superuser' \
                              % self._user)
-        jobs = self._job.request ("list_all_jobs",
-                                  {"user" : self._user, "finished" : finished})
-        jobs = json.loads(jobs[0])
+        jobs = self._job.list_jobs (None, finished)
         out = {'jobs': jobs, 'view_type' : 'all', 'no_corpus_show': 1}
         return out
 
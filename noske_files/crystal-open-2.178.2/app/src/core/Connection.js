@@ -43,6 +43,61 @@ function addToQuery(query, key, value){
     return query;
 }
 
+function decodeKwicClass(cls){
+    // segment properties of a class of KWIC lines, as in
+    // ConcCGI.reformat_conc_line
+    let props = {}
+    let key = "str"
+    if(cls == "strc"){
+        key = "strc"
+    } else if(cls.includes("coll")){
+        props.coll = 1
+        let m = cls.match(/coll(\d+)/)
+        if(m){
+            props.coll_label = parseInt(m[1])
+        }
+    } else if(cls.includes("#") || cls.includes("conc")){
+        let prefix = cls.includes("#") ? "#" : "conc"
+        let c = cls.split(" ").find(x => x.startsWith(prefix)) || ""
+        props.color = prefix == "#" ? c : c.substring(4)
+        let rem = cls.replace(c, "").trim()
+        if(rem){
+            props.class = rem
+        }
+    }
+    return {key, props}
+}
+
+function expandColumnarLine(line){
+    // line of a columnar concordance (kwic_format=columnar) as lists of
+    // segments ({str, attr, coll, coll_label, color, class, strc})
+    let classes = line.Classes.map(decodeKwicClass)
+    for(let part of ["Left", "Kwic", "Right"]){
+        let cols = line[part]
+        line[part] = cols.str.map((str, i) => {
+            let cls = classes[cols.cls[i]]
+            let segment = Object.assign({}, cls.props)
+            segment[cls.key] = str
+            if(cols.attr[i]){
+                segment.attr = cols.attr[i]
+            }
+            return segment
+        })
+    }
+    delete line.Classes
+    if(line.Align){
+        line.Align.forEach(expandColumnarLine)
+    }
+}
+
+function expandColumnarConcordance(payload){
+    if(payload && payload.kwic_format == "columnar" && payload.Lines){
+        payload.Lines.forEach(expandColumnarLine)
+        delete payload.kwic_format
+    }
+    return payload
+}
+
 function checkSessionAndRedirect(request, payload, callback){
     if(!window.config.URL_RASPI){
         Dispatcher.trigger("ROUTER_GO_TO", "unauthorized")
@@ -90,7 +145,7 @@ class ConnectionClass{
             }
         }
 
-        let xhrParams = this._getXhrParams(request)
+        let xhrParams = this._getXhrParams(request, this._isConcordance(request.url) ? {kwic_format: "columnar"} : {})
 
         let xhr = $.ajax(xhrParams)
             .done(this._onDone.bind(this, request))
@@ -150,7 +205,14 @@ class ConnectionClass{
         }
     }
 
-    _getXhrParams(request){
+    _isConcordance(url){
+        // concordance lines are requested in the compact columnar format
+        // and expanded in _onDone
+        return !!url && (url == window.config.URL_BONITO + "concordance"
+                || url == window.config.URL_BONITO + "concordance_stream")
+    }
+
+    _getXhrParams(request, extraGetData){
         // returns object with params for ajax request
         let xhrParams = request.xhrParams || {}
         let method = "GET"
@@ -158,7 +220,7 @@ class ConnectionClass{
         let postKeys = request.postKeys || []  // key always sent in POST data
         let getKeys = request.getKeys || []  // key always sent in query string
         let postData = {}
-        let getData = {}
+        let getData = Object.assign({}, extraGetData)
         let jsonData = {}
         getKeys.push("corpname", "bim_corpname", "ref_corpname")  //allways in URL. BigBrother uses corpnames in URL to authorize user
         if(this.bonitoNote && request.url.startsWith(window.config.URL_BONITO)){
@@ -212,6 +274,7 @@ class ConnectionClass{
     }
 
     _onDone(request, payload){
+        expandColumnarConcordance(payload)
         this._checkNewBonitoVersion(request, payload)
         request.done && request.done(payload, request)
     }
@@ -294,7 +357,11 @@ class SSEConnectionClass{
             Dispatcher.trigger("LOADING_CHANGED", true, request.loadingId)
         }
 
-        let url = createGETURL(request.url, request.data)
+        let data = request.data
+        if(Connection._isConcordance(request.url)){
+            data = Object.assign({kwic_format: "columnar"}, data)
+        }
+        let url = createGETURL(request.url, data)
 
         const eventSource = new EventSource(url, { withCredentials: true } )
         eventSource.onmessage = this._onMessage.bind(this, request)
@@ -310,7 +377,7 @@ class SSEConnectionClass{
     }
 
     _onMessage(request, payload){
-        request.message && request.message(JSON.parse(payload.data), request)
+        request.message && request.message(expandColumnarConcordance(JSON.parse(payload.data)), request)
     }
 
     _onFail(request, payload){
@@ -0,0 +1,44 @@
+import os, sys, tempfile, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'noske_files', 'bonito-open-5.71.15'))
+import bitermsindex
+
+
+PAIRS = [('a-n', 'x-n'), ('a-n', 'y-n'),
+         ('b-n', 'x-n'), ('b-n', 'y-n'), ('b-n', 'z-n'),
+         ('c-n', 'x-n')]
+
+
+class PageTest (unittest.TestCase):
+    def setUp (self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        fname = os.path.join(self.tmp_dir.name, 'l2.biterms')
+        with open(fname, 'w') as f:
+            for l1t, l2t in PAIRS:
+                f.write('\t'.join([l1t, l2t, '3', '5', '7', '1.5', '2.5',
+                                   '11.0']) + '\n')
+        self.index = bitermsindex.get_index(
+                fname, os.path.join(self.tmp_dir.name, 'index'))
+
+    def tearDown (self):
+        self.tmp_dir.cleanup()
+
+    def pairs (self, rows):
+        return [tuple(r[8:10]) for r in self.index.to_lists(rows)]
+
+    def test_page_holds_whole_terms (self):
+        self.assertEqual(self.pairs(self.index.page(0, 2)), PAIRS[:5])
+        self.assertEqual(self.pairs(self.index.page(2, 2)), PAIRS[5:])
+        self.assertEqual(self.pairs(self.index.page(3, 2)), [])
+
+    def test_pages_cover_all_rows (self):
+        for limit in range(1, 5):
+            pairs = []
+            for start in range(0, 3, limit):
+                pairs += self.pairs(self.index.page(start, limit))
+            self.assertEqual(pairs, PAIRS, 'limit %d' % limit)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import json, os, socket, sys, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'noske_files', 'bonito-open-5.71.15'))
+import concd
+
+
+class FakeCorpus:
+    spath = '/corpora/subcorp/user/bnc/written.subc'
+    complement = False
+    _conc_dir = ''
+
+    def get_confpath (self):
+        return '/corpora/registry/bnc'
+
+
+class FakeConc:
+    def finished (self):
+        return 0
+
+    def size (self):
+        return 10
+
+    def fullsize (self):
+        return 20
+
+
+class SubcorpusRequestTest (unittest.TestCase):
+    subchash = bytes.fromhex('00ff10ab')
+
+    def request (self, **kwargs):
+        request = concd._conc_request(FakeCorpus(), self.subchash,
+                                      ['q[word="x"]'], '/cache/bnc/', **kwargs)
+        # as sent over the socket
+        return json.loads(json.dumps(request))
+
+    def test_subchash_is_serialised (self):
+        self.assertEqual(self.request(cmd='sizes')['subchash'], '00ff10ab')
+
+    def test_sizes_of_subcorpus_job (self):
+        daemon = concd.ConcDaemon(pool_size=1)
+        key = ('/cache/bnc/', self.subchash, ('q[word="x"]',))
+        job = daemon.jobs[key] = concd._Job(1, key, {})
+        job.conc = FakeConc()
+        server, client = socket.socketpair()
+        with server, client:
+            daemon.serve_sizes(server, self.request(cmd='sizes'))
+            reply = json.loads(concd._read_line(client))
+        self.assertEqual(reply, {'finished': 0, 'concsize': 10,
+                                 'fullsize': 20})
+
+    def test_whole_corpus_request (self):
+        request = concd._conc_request(FakeCorpus(), None, ['q[word="x"]'],
+                                      '/cache/bnc/')
+        self.assertIsNone(json.loads(json.dumps(request))['subchash'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,24 @@
+import os, sys, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+import bench_imports
+
+RUNCGI = os.environ.get('BONITO_RUNCGI', bench_imports.RUNCGI)
+
+
+@unittest.skipUnless(os.path.exists(RUNCGI),
+                     'run.cgi not installed, run inside the container')
+class StartupImportTest (unittest.TestCase):
+    @classmethod
+    def setUpClass (cls):
+        cls.times, cls.total_ms = bench_imports.measure(RUNCGI, 3)
+
+    def test_lazy_modules_not_imported (self):
+        self.assertEqual(bench_imports.eager_modules(self.times), [])
+
+    def test_import_time_budget (self):
+        self.assertLessEqual(self.total_ms, bench_imports.default_budget())
+
+
+if __name__ == '__main__':
+    unittest.main()
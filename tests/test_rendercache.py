@@ -0,0 +1,39 @@
+import os, sys, tempfile, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'noske_files', 'bonito-open-5.71.15'))
+import rendercache
+
+
+class PagesTest (unittest.TestCase):
+    def setUp (self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cachefile = os.path.join(self.tmp_dir.name, 'q.conc')
+        with open(self.cachefile, 'wb') as f:
+            f.write(b'conc')
+        self.cache = rendercache.RenderCache()
+
+    def tearDown (self):
+        self.tmp_dir.cleanup()
+
+    def test_page_is_read_from_disk (self):
+        key = rendercache.page_key(self.cachefile, ('fromp', 1))
+        self.cache.put(key, {'Lines': ['a', 'b']})
+        self.assertEqual(rendercache.RenderCache().get(key),
+                         {'Lines': ['a', 'b']})
+
+    def test_pages_size (self):
+        self.assertEqual(rendercache.pages_size(self.cachefile), 0)
+        for fromp in range(1, 4):
+            key = rendercache.page_key(self.cachefile, ('fromp', fromp))
+            self.cache.put(key, {'Lines': ['x' * 1000] * fromp})
+        pages_dir = self.cachefile[:-5] + '.pages'
+        self.assertEqual(rendercache.pages_size(self.cachefile),
+                         sum(os.path.getsize(os.path.join(pages_dir, f))
+                             for f in os.listdir(pages_dir)))
+        rendercache.remove_pages(self.cachefile)
+        self.assertEqual(rendercache.pages_size(self.cachefile), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()